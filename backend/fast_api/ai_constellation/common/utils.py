@@ -10,6 +10,15 @@ import typing
 import yaml
 import re
 
+try:
+    import orjson   # 高速なJSONエンコーダ（インストールされていない場合は標準のjsonを使用）
+except ImportError:
+    orjson = None
+
+
+# Mappableの具象クラスごとの、辞書化の対象となるフィールド名のキャッシュ
+_MAPPABLE_FIELD_NAMES: dict[type, tuple[str, ...]] = {}
+
 
 @dataclasses.dataclass
 class Mappable:
@@ -18,10 +27,16 @@ class Mappable:
     def to_dict(self) -> collections.abc.Mapping[str, typing.Any]:
         """自身のフィールドを辞書に変換する。
 
+        辞書化の対象となるフィールド名はクラスごとに1度だけ求め、キャッシュして使い回す。
+
         Returns:
             Mapping[str, Any]: 自身のフィールドから生成した辞書。フィールド名がキー、フィールドの値がバリュー。
         """
-        return {f.name: getattr(self, f.name) for f in dataclasses.fields(self) if not f.metadata.get('__transient')}
+        field_names = _MAPPABLE_FIELD_NAMES.get(type(self))
+        if field_names is None:
+            field_names = tuple(f.name for f in dataclasses.fields(self) if not f.metadata.get('__transient'))
+            _MAPPABLE_FIELD_NAMES[type(self)] = field_names
+        return {name: getattr(self, name) for name in field_names}
 
 
 def transient_field(
@@ -109,6 +124,22 @@ class CustomJsonEncoder(json.JSONEncoder):
             return super().default(o)           # どれでもない場合、上位クラスのデフォルト変換を実施して返却
 
 
+def json_dumps(obj: typing.Any) -> str:
+    """オブジェクトを、非ASCII文字をエスケープしないJSON文字列にダンプする。
+
+    orjsonがインストールされている場合はorjsonを、そうでない場合は標準のjsonを使用する。
+
+    Args:
+        obj (Any): ダンプ対象のオブジェクト。
+
+    Returns:
+        str: JSON文字列。
+    """
+    if orjson is not None:
+        return orjson.dumps(obj).decode('utf-8')
+    return json.dumps(obj, ensure_ascii=False)
+
+
 class HasLogger:
     """ロギングの機能をクラスに付与するための抽象クラス。"""
 
@@ -2,12 +2,19 @@
 
 抽象クラスとしてBaseLLMClientを定義する。
 """
+import asyncio
 import collections
+import contextlib
+import logging
 import typing
 import openai
 import openai.types.chat
-import asyncio
-from concurrent.futures import ThreadPoolExecutor
+from ai_constellation.llm_clients.completion_cache import CompletionCache
+from ai_constellation.llm_clients.token_counter import ContextLengthExceededError, TokenCounter
+
+
+_LOGGER = logging.getLogger(__name__)
+_LOGGER.addHandler(logging.NullHandler())
 
 
 @typing.runtime_checkable
@@ -16,33 +23,54 @@ class BaseLLMClient(typing.Protocol):
 
     LLMを搭載したサーバにWebAPIリクエストを送信する際、クライアントの役割を担う。
     メッセージをプロンプトとして送信し、応答を得る。
-    リクエストの送受信には、OpenAIのSDKを使用する。
+    リクエストの送受信には、OpenAIのSDKの非同期クライアントを使用する。
 
     Attributes:
         _model_version (str): モデルバージョン。モデル名とモデルのバージョン情報を示すもの。
-        _client (OpenAI): クライアントモジュール。メッセージをLLMに送信する際に使用。
+        _client (AsyncOpenAI): クライアントモジュール。メッセージをLLMに送信する際に使用。
+        _semaphore (asyncio.Semaphore | None): 同時リクエスト数の上限を制御するセマフォ。Noneの場合は上限なし。
+        _request_timeout (float | None): 1リクエストあたりのタイムアウト秒数。Noneの場合はクライアントの設定に従う。
+        _completion_cache (CompletionCache | None): 生成結果のキャッシュ。Noneの場合はキャッシュしない。
+        _cache_nondeterministic (bool): 生成結果が毎回変わりうるリクエスト（temperatureが0でないもの）もキャッシュするか。
+        _max_context_tokens (int | None): モデルのコンテキスト長（トークン数）の上限。Noneの場合は上限なし。
+        _token_counter (TokenCounter): プロンプトのトークン数を数えるモジュール。
     """
     _model_version: str
-    _client: openai.OpenAI
+    _client: openai.AsyncOpenAI
+    _semaphore: asyncio.Semaphore | None
+    _request_timeout: float | None
+    _completion_cache: CompletionCache | None
+    _cache_nondeterministic: bool
+    _max_context_tokens: int | None
+    _token_counter: TokenCounter
 
     async def generate(
         self,
         messages: collections.abc.Iterable[openai.types.chat.ChatCompletionMessageParam],
         temperature: float | None = None,
         top_p: float | None = None,
-        max_tokens: int | None = None
+        max_tokens: int | None = None,
+        timeout: float | None = None
     ) -> openai.types.chat.ChatCompletion:
         """文章を生成する。
 
+        同時リクエスト数の上限に達している場合は、空きができるまで待ってからリクエストを送信する。
+        生成結果のキャッシュがある場合は、同じリクエストの生成結果をキャッシュから返却する。
+        送信前にプロンプトのトークン数を確認する（check_prompt_lengthを参照）。
+
         Args:
             messages (Iterable[ChatCompletionMessageParam]): プロンプトのリスト。
             temperature (float | None): 生成のランダム性の度合。
             top_p (float | None): 核サンプリング。
             max_tokens (int | None): 最大トークン数。
+            timeout (float | None): このリクエストのタイムアウト秒数。Noneの場合は_request_timeoutを使用する。
 
         Returns:
             ChatCompletion: 生成結果。
         """
+        # ジェネレータなどが渡されても、キャッシュのキーの作成やトークン数の確認で消費されないようにリストにする
+        messages = list(messages)
+
         # 引数が設定されている場合は、その値を利用
         create_params = {}
         if temperature is not None:
@@ -51,20 +79,196 @@ class BaseLLMClient(typing.Protocol):
             create_params['top_p'] = top_p
         if max_tokens is not None:
             create_params['max_tokens'] = max_tokens
+        if timeout is None:
+            timeout = self._request_timeout
+        if timeout is not None:
+            create_params['timeout'] = timeout
+
+        # キャッシュにあればそれを返却
+        cache_key = self.get_cache_key(messages, temperature, top_p, max_tokens)
+        if cache_key is not None:
+            content = await self._completion_cache.get(cache_key)
+            if content is not None:
+                return content
+
+        # プロンプトのトークン数を確認
+        self.check_prompt_length(messages, max_tokens)
 
-        # 生成処理を関数化
-        def _create():
-            return self._client.chat.completions.create(
+        # 非同期クライアントで生成（同時リクエスト数の上限がある場合はセマフォで待機）
+        concurrency_limit = self._semaphore if self._semaphore is not None else contextlib.nullcontext()
+        async with concurrency_limit:
+            result = await self._client.chat.completions.create(
                 model=self._model_version,
                 messages=messages,
                 **create_params,
             )
+        content = result.choices[0].message.content  # 結果のテキストのみ取得
+        if cache_key is not None and content is not None:
+            await self._completion_cache.put(cache_key, content)
+        return content
+
+    async def generate_stream(
+        self,
+        messages: collections.abc.Iterable[openai.types.chat.ChatCompletionMessageParam],
+        temperature: float | None = None,
+        top_p: float | None = None,
+        max_tokens: int | None = None,
+        timeout: float | None = None
+    ) -> collections.abc.AsyncIterator[str]:
+        """文章をストリーミングで生成する。
+
+        非同期ジェネレータとして、生成されたテキストの差分を届いた順に返却する。
+        生成結果のキャッシュにある場合は、生成結果全体を1つの差分として返却する。
+
+        Args:
+            messages (Iterable[ChatCompletionMessageParam]): プロンプトのリスト。
+            temperature (float | None): 生成のランダム性の度合。
+            top_p (float | None): 核サンプリング。
+            max_tokens (int | None): 最大トークン数。
+            timeout (float | None): このリクエストのタイムアウト秒数。Noneの場合は_request_timeoutを使用する。
+
+        Yields:
+            str: 生成されたテキストの差分。
+        """
+        # ジェネレータなどが渡されても、キャッシュのキーの作成やトークン数の確認で消費されないようにリストにする
+        messages = list(messages)
+
+        # 引数が設定されている場合は、その値を利用
+        create_params = {}
+        if temperature is not None:
+            create_params['temperature'] = temperature
+        if top_p is not None:
+            create_params['top_p'] = top_p
+        if max_tokens is not None:
+            create_params['max_tokens'] = max_tokens
+        if timeout is None:
+            timeout = self._request_timeout
+        if timeout is not None:
+            create_params['timeout'] = timeout
+
+        # キャッシュにあればそれを返却
+        cache_key = self.get_cache_key(messages, temperature, top_p, max_tokens)
+        if cache_key is not None:
+            content = await self._completion_cache.get(cache_key)
+            if content is not None:
+                yield content
+                return
+
+        # プロンプトのトークン数を確認
+        self.check_prompt_length(messages, max_tokens)
+
+        # 非同期クライアントでストリーミング生成（同時リクエスト数の上限がある場合はセマフォで待機）
+        content = ''
+        concurrency_limit = self._semaphore if self._semaphore is not None else contextlib.nullcontext()
+        async with concurrency_limit:
+            stream = await self._client.chat.completions.create(
+                model=self._model_version,
+                messages=messages,
+                stream=True,
+                **create_params,
+            )
+            async with stream:
+                async for chunk in stream:
+                    if not chunk.choices:
+                        continue
+                    delta = chunk.choices[0].delta.content
+                    if delta:
+                        content += delta
+                        yield delta
+        # 最後まで生成できた場合のみキャッシュに保存
+        if cache_key is not None:
+            await self._completion_cache.put(cache_key, content)
+
+    def get_cache_key(
+        self,
+        messages: collections.abc.Iterable[openai.types.chat.ChatCompletionMessageParam],
+        temperature: float | None,
+        top_p: float | None,
+        max_tokens: int | None
+    ) -> str | None:
+        """リクエストに対応する生成結果のキャッシュのキーを取得する。
+
+        temperatureが0でないリクエスト（省略した場合を含む）は生成結果が毎回変わりうるため、
+        _cache_nondeterministicがFalseの場合はキャッシュしない。
+
+        Args:
+            messages (Iterable[ChatCompletionMessageParam]): プロンプトのリスト。
+            temperature (float | None): 生成のランダム性の度合。
+            top_p (float | None): 核サンプリング。
+            max_tokens (int | None): 最大トークン数。
+
+        Returns:
+            str | None: キャッシュのキー。キャッシュしない場合はNone。
+        """
+        if self._completion_cache is None:
+            return None
+        if temperature != 0 and not self._cache_nondeterministic:
+            return None
+        return CompletionCache.make_key(self._model_version, messages, temperature, top_p, max_tokens)
+
+    def count_tokens(self, text: str) -> int:
+        """このモデルのトークナイザでテキストのトークン数を数える。
+
+        Args:
+            text (str): テキスト。
 
-        # 非同期として生成
-        loop = asyncio.get_running_loop()
-        with ThreadPoolExecutor() as executor:
-            result = await loop.run_in_executor(executor, _create)
-            return result.choices[0].message.content  # 結果のテキストのみ取得して返却
+        Returns:
+            int: トークン数。トークナイザを読み込めない場合は概算。
+        """
+        return self._token_counter.count(text)
+
+    def check_prompt_length(
+        self,
+        messages: collections.abc.Iterable[openai.types.chat.ChatCompletionMessageParam],
+        max_tokens: int | None
+    ) -> int:
+        """リクエストを送信する前に、プロンプトのトークン数を数えて記録し、コンテキスト長の上限を超えていないか確認する。
+
+        トークナイザで数えている場合のみ、上限を超えていれば例外を送出する（概算は多めに見積もるため、記録だけにする）。
+
+        Args:
+            messages (Iterable[ChatCompletionMessageParam]): プロンプトのリスト。
+            max_tokens (int | None): 最大トークン数。上限の確認では、プロンプトにこの値を加える。
+
+        Returns:
+            int: プロンプトのトークン数。
+
+        Raises:
+            ContextLengthExceededError: プロンプトのトークン数が上限を超えている場合。
+        """
+        num_tokens = self._token_counter.count_messages(messages)
+        is_exact = self._token_counter.is_exact
+        _LOGGER.debug(f"prompt tokens: model={self._model_version}, tokens={num_tokens}, exact={is_exact}")
+        if self._max_context_tokens is not None and num_tokens + (max_tokens or 0) > self._max_context_tokens:
+            message = (f"prompt exceeds context length: model={self._model_version}, tokens={num_tokens}, "
+                       f"max_tokens={max_tokens}, max_context_tokens={self._max_context_tokens}")
+            if is_exact:
+                raise ContextLengthExceededError(message)
+            _LOGGER.warning(message)
+        return num_tokens
+
+    def get_max_context_tokens(self) -> int | None:
+        """モデルのコンテキスト長（トークン数）の上限を取得する。
+
+        Returns:
+            int | None: コンテキスト長の上限。Noneの場合は上限なし。
+        """
+        return self._max_context_tokens
+
+    def get_completion_cache(self) -> CompletionCache | None:
+        """生成結果のキャッシュを取得する。
+
+        Returns:
+            CompletionCache | None: 生成結果のキャッシュ。Noneの場合はキャッシュしない。
+        """
+        return self._completion_cache
+
+    async def aclose(self):
+        """クライアントが保持しているコネクションプールを閉じる。
+
+        生成結果のキャッシュは他のクライアントと共有しているため閉じない（LLMClientRegistry.acloseで閉じる）。
+        """
+        await self._client.close()
 
     @staticmethod
     def format_system_message(prompt: str) -> dict[str, str]:
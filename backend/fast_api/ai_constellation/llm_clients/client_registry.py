@@ -0,0 +1,193 @@
+"""LLMクライアントのレジストリのモジュール。
+
+LLMClientRegistryと、プロセス内で共有するレジストリを取得するget_client_registryを定義する。
+"""
+import asyncio
+import logging
+import os
+import pathlib
+import threading
+import yaml
+from ai_constellation.llm_clients.base_client import BaseLLMClient
+from ai_constellation.llm_clients.simple_client import SimpleLLMClient
+from ai_constellation.llm_clients.completion_cache import get_completion_cache
+
+
+_LOGGER = logging.getLogger(__name__)
+_LOGGER.addHandler(logging.NullHandler())
+
+
+# models.ymlの既定のパス
+DEFAULT_MODEL_CONFIG_PATH = './ai_constellation/llm_clients/models.yml'
+
+
+class LLMClientRegistry:
+    """LLMクライアントのレジストリ。
+
+    models.ymlの設定値からLLMクライアントを生成し、モデルタグをキーとして保持する。
+    一度生成したクライアントはプロセス内のすべてのルーム・議論で使い回すため、
+    コネクションプールやTLSセッションが議論をまたいで再利用される。
+    models.ymlが更新された場合は、次回の取得時に設定を読み直し、設定値が変わったクライアントのみ作り直す。
+    作り直す前のクライアントは、実行中の議論が使い続けている可能性があるため、その場では閉じずにacloseでまとめて閉じる。
+    """
+
+    def __init__(self, model_config_path: str = DEFAULT_MODEL_CONFIG_PATH):
+        """コンストラクタ。
+
+        Args:
+            model_config_path (str): models.ymlまでのパス。
+        """
+        self.model_config_path = pathlib.Path(model_config_path)
+        self._lock = threading.Lock()               # 複数スレッドからの同時読み込みを防ぐためのロック
+        self._model_config: dict[str, dict] = {}    # models.ymlの内容
+        self._model_config_mtime: float | None = None  # 最後に読み込んだ時点のmodels.ymlの更新日時
+        self._clients: dict[str, BaseLLMClient] = {}   # モデルタグをキーとしたクライアント
+        self._retired_clients: list[BaseLLMClient] = []  # models.ymlの更新で破棄した、まだ閉じていないクライアント
+
+    def load(self):
+        """models.ymlを読み込み、記載されているすべてのクライアントを生成する。
+
+        アプリケーションの起動時に呼び出すことで、最初の議論でのクライアント生成コストをなくす。
+        トークナイザもここで読み込み、議論中にトークナイザのダウンロードや読み込みで待たないようにする。
+        """
+        self._reload_if_modified()
+        for model_tag in list(self._model_config.keys()):
+            client = self.get_client(model_tag)
+            client.count_tokens('')
+
+    def get_client(self, model_tag: str) -> BaseLLMClient | None:
+        """モデルタグに対応するクライアントを取得する。
+
+        Args:
+            model_tag (str): モデルタグ。models.ymlのキー。
+
+        Returns:
+            BaseLLMClient | None: LLMクライアント。models.ymlにモデルタグが存在しない場合はNone。
+        """
+        self._reload_if_modified()
+        with self._lock:
+            if model_tag in self._clients:
+                return self._clients[model_tag]
+            model_dict = self._model_config.get(model_tag, None)
+            if model_dict is None:
+                return None
+            client = self.create_client(model_tag, model_dict)
+            self._clients[model_tag] = client
+            _LOGGER.info(f"llm client created: model_tag={model_tag}")
+            return client
+
+    def get_clients(self, model_tags: list[str]) -> dict[str, BaseLLMClient]:
+        """複数のモデルタグに対応するクライアントをまとめて取得する。
+
+        models.ymlに存在しないモデルタグは結果に含めない。
+
+        Args:
+            model_tags (list[str]): モデルタグのリスト。
+
+        Returns:
+            dict[str, BaseLLMClient]: モデルタグをキーとしたクライアントの辞書。
+        """
+        clients = {}
+        for model_tag in model_tags:
+            client = self.get_client(model_tag)
+            if client is not None:
+                clients[model_tag] = client
+        return clients
+
+    def get_model_version(self, model_tag: str) -> str | None:
+        """モデルタグに対応するモデルのバージョンを取得する。
+
+        Args:
+            model_tag (str): モデルタグ。models.ymlのキー。
+
+        Returns:
+            str | None: モデルのバージョン。models.ymlにモデルタグが存在しない場合はNone。
+        """
+        self._reload_if_modified()
+        return self._model_config.get(model_tag, {}).get('version')
+
+    async def aclose(self):
+        """保持しているすべてのクライアントと、models.ymlの更新で破棄したクライアントのコネクションプールを閉じる。
+
+        クライアントが使用している生成結果のキャッシュも閉じる（最終使用日時の未更新分はこの時に書き込まれる）。
+        アプリケーションの終了時に呼び出す。
+        """
+        with self._lock:
+            clients = [*self._clients.values(), *self._retired_clients]
+            self._clients.clear()
+            self._retired_clients.clear()
+        caches = {}
+        for client in clients:
+            await client.aclose()
+            cache = client.get_completion_cache()
+            if cache is not None:
+                caches[id(cache)] = cache  # 共有しているキャッシュは1度だけ閉じる
+        for cache in caches.values():
+            await asyncio.to_thread(cache.close)
+
+    @staticmethod
+    def create_client(model_tag: str, model_dict: dict) -> BaseLLMClient:
+        """LLMクライアントを生成する。
+
+        models.ymlの`completion_cache`がfalseでない限り、プロセス内で共有する生成結果のキャッシュを使用する。
+
+        Args:
+            model_tag (str): モデルの種類を示すタグ。
+            model_dict (dict): モデルの情報が格納された辞書。
+
+        Returns:
+            BaseLLMClient: LLMクライアントのインスタンス。
+        """
+        _model_dict = {k: v for k, v in model_dict.items()}  # 副作用を避けて元の辞書からコピーした辞書を使う
+        model_version = _model_dict.pop("version")  # "version"だけ取り出す
+        use_completion_cache = _model_dict.pop("completion_cache", True)  # キャッシュの使用有無はクライアントに渡さない
+        return SimpleLLMClient(
+            model_tag=model_tag,
+            model_version=model_version,
+            completion_cache=get_completion_cache() if use_completion_cache else None,
+            **_model_dict
+        )
+
+    def _reload_if_modified(self):
+        """models.ymlが更新されていれば読み直す。
+
+        設定値が変わったモデルタグ、または削除されたモデルタグのクライアントは破棄する。
+        破棄されたクライアントは、次回の取得時に新しい設定値で生成される。
+        破棄したクライアントはacloseで閉じるために保持する。
+        """
+        if not self.model_config_path.exists():
+            raise FileNotFoundError('models.ymlが見つかりません')
+        mtime = os.path.getmtime(self.model_config_path)
+        if mtime == self._model_config_mtime:
+            return
+        with self._lock:
+            # ロック取得待ちの間に他のスレッドが読み込み済みであれば何もしない
+            if mtime == self._model_config_mtime:
+                return
+            with self.model_config_path.open('r', encoding='utf-8') as f:
+                model_config: dict = yaml.safe_load(f) or {}
+            for model_tag in list(self._clients.keys()):
+                if model_config.get(model_tag) != self._model_config.get(model_tag):
+                    self._retired_clients.append(self._clients.pop(model_tag))
+                    _LOGGER.info(f"llm client discarded by models.yml update: model_tag={model_tag}")
+            self._model_config = model_config
+            self._model_config_mtime = mtime
+            _LOGGER.info(f"models.yml loaded: {self.model_config_path}")
+
+
+# プロセス内で共有するレジストリ
+_CLIENT_REGISTRY: LLMClientRegistry | None = None
+
+
+def get_client_registry() -> LLMClientRegistry:
+    """プロセス内で共有するLLMクライアントのレジストリを取得する。
+
+    初回呼び出し時にレジストリを生成する。
+
+    Returns:
+        LLMClientRegistry: LLMクライアントのレジストリ。
+    """
+    global _CLIENT_REGISTRY
+    if _CLIENT_REGISTRY is None:
+        _CLIENT_REGISTRY = LLMClientRegistry()
+    return _CLIENT_REGISTRY
@@ -0,0 +1,297 @@
+"""LLMの生成結果のキャッシュのモジュール。
+
+CompletionCacheと、プロセス内で共有するキャッシュを取得するget_completion_cacheを定義する。
+"""
+import asyncio
+import collections
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+
+_LOGGER = logging.getLogger(__name__)
+_LOGGER.addHandler(logging.NullHandler())
+
+
+# キャッシュの既定値（環境変数で変更可能）
+DEFAULT_COMPLETION_CACHE_PATH = './cache/completions.sqlite3'
+DEFAULT_COMPLETION_CACHE_MEMORY_ENTRIES = 1024
+DEFAULT_COMPLETION_CACHE_DISK_ENTRIES = 100000
+
+# ディスクのエントリ数を確認する間隔（保存回数）
+_DISK_EVICTION_INTERVAL = 100
+
+# ディスクキャッシュでヒットしたエントリの最終使用日時をまとめて更新する件数
+_DISK_TOUCH_BATCH_SIZE = 64
+
+
+class CompletionCache:
+    """LLMの生成結果のキャッシュ。
+
+    メモリ上のLRUキャッシュと、SQLiteのディスクキャッシュの2段構成とする。
+    メモリになければディスクを参照し、ディスクで見つかった結果はメモリにも載せる。
+    ディスクキャッシュは複数ワーカーやプロセスの再起動をまたいで共有される。
+
+    ディスクキャッシュの読み書きは、他のワーカーの書き込みのロック待ちが起こりうるため、別スレッドで実行してイベントループをブロックしない。
+    ディスクキャッシュでヒットしたエントリの最終使用日時の更新は、次の保存時（または一定件数たまった時）にまとめて書き込む。
+    ディスクキャッシュの読み書きに失敗した場合は、キャッシュになかったものとして扱う。
+
+    Attributes:
+        hits (int): メモリキャッシュでヒットした回数。
+        disk_hits (int): ディスクキャッシュでヒットした回数。
+        misses (int): ヒットしなかった回数。
+    """
+
+    def __init__(
+        self,
+        path: str | None = DEFAULT_COMPLETION_CACHE_PATH,
+        max_memory_entries: int = DEFAULT_COMPLETION_CACHE_MEMORY_ENTRIES,
+        max_disk_entries: int = DEFAULT_COMPLETION_CACHE_DISK_ENTRIES
+    ):
+        """コンストラクタ。
+
+        Args:
+            path (str | None): ディスクキャッシュのSQLiteファイルまでのパス。Noneの場合はメモリキャッシュのみ使用する。
+            max_memory_entries (int): メモリキャッシュのエントリ数の上限。
+            max_disk_entries (int): ディスクキャッシュのエントリ数の上限。
+        """
+        self.path = path
+        self.max_memory_entries = max_memory_entries
+        self.max_disk_entries = max_disk_entries
+        self._lock = threading.Lock()       # メモリキャッシュと統計値のロック（イベントループから取得するため、ディスクの読み書き中は保持しない）
+        self._disk_lock = threading.Lock()  # ディスクキャッシュのロック（別スレッドでのみ取得する）
+        self._pending_touches: dict[str, float] = {}  # 最終使用日時を未更新のディスクキャッシュのキーと、その使用日時
+        self._memory: collections.OrderedDict[str, str] = collections.OrderedDict()
+        self._num_puts = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._conn: sqlite3.Connection | None = None
+        if path is not None:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('PRAGMA synchronous=NORMAL')
+            self._conn.execute('''
+                CREATE TABLE IF NOT EXISTS completions (
+                    key TEXT PRIMARY KEY,
+                    content TEXT NOT NULL,
+                    last_used REAL NOT NULL
+                )
+            ''')
+
+    @staticmethod
+    def make_key(
+        model_version: str,
+        messages: list[dict],
+        temperature: float | None,
+        top_p: float | None,
+        max_tokens: int | None
+    ) -> str:
+        """リクエストの内容からキャッシュのキーを作成する。
+
+        リクエストを正規化したJSONにし、そのハッシュ値をキーとする。
+
+        Args:
+            model_version (str): モデルバージョン。
+            messages (list[dict]): プロンプトのリスト。
+            temperature (float | None): 生成のランダム性の度合。
+            top_p (float | None): 核サンプリング。
+            max_tokens (int | None): 最大トークン数。
+
+        Returns:
+            str: キャッシュのキー(SHA-256の16進数文字列)。
+        """
+        request = {
+            'model_version': model_version,
+            'messages': list(messages),
+            'temperature': temperature,
+            'top_p': top_p,
+            'max_tokens': max_tokens,
+        }
+        canonical = json.dumps(request, ensure_ascii=False, sort_keys=True, separators=(',', ':'))
+        return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+    async def get(self, key: str) -> str | None:
+        """キャッシュから生成結果を取得する。
+
+        Args:
+            key (str): キャッシュのキー。
+
+        Returns:
+            str | None: 生成結果。キャッシュにない場合はNone。
+        """
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                return self._memory[key]
+            if self._conn is None:
+                self.misses += 1
+                return None
+        content = await asyncio.to_thread(self._get_disk, key)
+        with self._lock:
+            if content is None:
+                self.misses += 1
+            else:
+                self._put_memory(key, content)
+                self.disk_hits += 1
+        return content
+
+    async def put(self, key: str, content: str):
+        """生成結果をキャッシュに保存する。
+
+        Args:
+            key (str): キャッシュのキー。
+            content (str): 生成結果。
+        """
+        with self._lock:
+            self._put_memory(key, content)
+        if self._conn is not None:
+            await asyncio.to_thread(self._put_disk, key, content)
+
+    def stats(self) -> dict[str, int | float]:
+        """キャッシュの利用状況を取得する。
+
+        Returns:
+            dict[str, int | float]: ヒット数、ミス数、ヒット率、メモリキャッシュのエントリ数。
+        """
+        with self._lock:
+            total = self.hits + self.disk_hits + self.misses
+            return {
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'hit_rate': (self.hits + self.disk_hits) / total if total > 0 else 0.0,
+                'memory_entries': len(self._memory),
+            }
+
+    def close(self):
+        """最終使用日時の未更新分を書き込み、ディスクキャッシュを閉じる。"""
+        with self._disk_lock:
+            if self._conn is not None:
+                try:
+                    self._write_disk([])
+                except sqlite3.Error:
+                    _LOGGER.warning("completion cache touch flush failed.", exc_info=True)
+                self._conn.close()
+                self._conn = None
+
+    def _get_disk(self, key: str) -> str | None:
+        """ディスクキャッシュから生成結果を取得する。別スレッドで呼び出す。
+
+        Args:
+            key (str): キャッシュのキー。
+
+        Returns:
+            str | None: 生成結果。キャッシュにない場合や、読み込みに失敗した場合はNone。
+        """
+        with self._disk_lock:
+            if self._conn is None:
+                return None
+            try:
+                row = self._conn.execute('SELECT content FROM completions WHERE key = ?', (key,)).fetchone()
+                if row is None:
+                    return None
+                self._pending_touches[key] = time.time()
+                if len(self._pending_touches) >= _DISK_TOUCH_BATCH_SIZE:
+                    self._write_disk([])
+                return row[0]
+            except sqlite3.Error:
+                _LOGGER.warning("completion cache disk read failed.", exc_info=True)
+                return None
+
+    def _put_disk(self, key: str, content: str):
+        """ディスクキャッシュに生成結果を保存する。別スレッドで呼び出す。
+
+        Args:
+            key (str): キャッシュのキー。
+            content (str): 生成結果。
+        """
+        with self._disk_lock:
+            if self._conn is None:
+                return
+            try:
+                self._write_disk([(key, content)])
+                self._num_puts += 1
+                if self._num_puts % _DISK_EVICTION_INTERVAL == 0:
+                    self._evict_disk()
+            except sqlite3.Error:
+                _LOGGER.warning("completion cache disk write failed.", exc_info=True)
+
+    def _write_disk(self, entries: list[tuple[str, str]]):
+        """生成結果の保存と、最終使用日時の未更新分の書き込みを、1つのトランザクションで行う。ディスクのロック取得済みで呼び出す。
+
+        Args:
+            entries (list[tuple[str, str]]): 保存するキャッシュのキーと生成結果の組のリスト。
+        """
+        if not entries and not self._pending_touches:
+            return
+        touches = self._pending_touches
+        self._pending_touches = {}
+        now = time.time()
+        self._conn.execute('BEGIN')
+        try:
+            self._conn.executemany(
+                'UPDATE completions SET last_used = ? WHERE key = ?',
+                [(last_used, key) for key, last_used in touches.items()])
+            self._conn.executemany(
+                'INSERT OR REPLACE INTO completions (key, content, last_used) VALUES (?, ?, ?)',
+                [(key, content, now) for key, content in entries])
+            self._conn.execute('COMMIT')
+        except BaseException:
+            self._conn.execute('ROLLBACK')
+            raise
+
+    def _put_memory(self, key: str, content: str):
+        """メモリキャッシュに保存し、上限を超えた分を最後に使われたのが古いものから削除する。ロック取得済みで呼び出す。
+
+        Args:
+            key (str): キャッシュのキー。
+            content (str): 生成結果。
+        """
+        self._memory[key] = content
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_entries:
+            self._memory.popitem(last=False)
+
+    def _evict_disk(self):
+        """ディスクキャッシュの上限を超えた分を、最後に使われたのが古いものから削除する。ディスクのロック取得済みで呼び出す。"""
+        self._conn.execute('''
+            DELETE FROM completions WHERE key IN (
+                SELECT key FROM completions ORDER BY last_used DESC LIMIT -1 OFFSET ?
+            )
+        ''', (self.max_disk_entries,))
+
+
+# プロセス内で共有するキャッシュ
+_COMPLETION_CACHE: CompletionCache | None = None
+_COMPLETION_CACHE_LOCK = threading.Lock()
+
+
+def get_completion_cache() -> CompletionCache:
+    """プロセス内で共有するLLMの生成結果のキャッシュを取得する。
+
+    初回呼び出し時に、環境変数COMPLETION_CACHE_PATH、COMPLETION_CACHE_MEMORY_ENTRIES、COMPLETION_CACHE_DISK_ENTRIESの設定に従って生成する。
+    COMPLETION_CACHE_PATHが`memory`の場合は、ディスクキャッシュを使用しない。
+
+    Returns:
+        CompletionCache: LLMの生成結果のキャッシュ。
+    """
+    global _COMPLETION_CACHE
+    with _COMPLETION_CACHE_LOCK:
+        if _COMPLETION_CACHE is None:
+            path = os.getenv('COMPLETION_CACHE_PATH', DEFAULT_COMPLETION_CACHE_PATH)
+            _COMPLETION_CACHE = CompletionCache(
+                path=None if path == 'memory' else path,
+                max_memory_entries=int(os.getenv('COMPLETION_CACHE_MEMORY_ENTRIES',
+                                                 DEFAULT_COMPLETION_CACHE_MEMORY_ENTRIES)),
+                max_disk_entries=int(os.getenv('COMPLETION_CACHE_DISK_ENTRIES', DEFAULT_COMPLETION_CACHE_DISK_ENTRIES)),
+            )
+        return _COMPLETION_CACHE
@@ -2,6 +2,7 @@
 
 抽象クラスBaseLLMClientを継承するSimpleLLMClientを定義する。
 """
+import asyncio
 import httpx
 import logging
 import openai
@@ -10,6 +11,8 @@ from openai._types import Timeout, NotGiven
 from openai._constants import DEFAULT_MAX_RETRIES
 from typing import Union, Mapping
 from ai_constellation.llm_clients.base_client import BaseLLMClient
+from ai_constellation.llm_clients.completion_cache import CompletionCache
+from ai_constellation.llm_clients.token_counter import get_token_counter
 from ai_constellation.common.utils import replace_env_variable
 
 
@@ -33,13 +36,21 @@ class SimpleLLMClient(BaseLLMClient):
         max_retries: int = DEFAULT_MAX_RETRIES,
         default_headers: Mapping[str, str] | None = None,
         default_query: Mapping[str, object] | None = None,
-        strict_response_validation: bool = False
+        strict_response_validation: bool = False,
+        max_concurrency: int | None = None,
+        request_timeout: float | None = None,
+        completion_cache: CompletionCache | None = None,
+        cache_nondeterministic: bool = False,
+        max_context_tokens: int | None = None,
+        tokenizer: str | None = None
     ):
         """コンストラクタ。
 
-        OpenAIのSDKからクライアントモジュールを生成する。
+        OpenAIのSDKから非同期のクライアントモジュールを生成する。
         クライアントモジュールには与えられた引数一式をそのまま渡す。
         そのため、多くの引数はOpenAIのSDKの仕様に準拠する。
+        max_concurrencyが指定された場合は、同時リクエスト数とコネクションプールの大きさをその値で制限する。
+        completion_cacheが指定された場合は、生成結果をキャッシュし、同じリクエストにはキャッシュから応答する。
 
         生成したクライアントモジュールは、インスタンス変数として保持し、generateで使用する。
         ユーザが指定したモデルタグや、どのバージョンモデルが使われるかの情報も、同様に保持する。
@@ -56,6 +67,13 @@ class SimpleLLMClient(BaseLLMClient):
             default_headers (Mapping[str, str] | None): HTTPリクエストを送信する際にヘッダーに付与するパラメータ。
             default_query (Mapping[str, str] | None): HTTPリクエストを送信する際のクエリパラメータ。
             strict_response_validation (bool): LLMの応答に厳密なバリデーションチェックを行うか。
+            max_concurrency (int | None): 同時リクエスト数の上限。Noneの場合は上限なし。
+            request_timeout (float | None): 1リクエストあたりのタイムアウト秒数(単位:秒)。Noneの場合はtimeoutに従う。
+            completion_cache (CompletionCache | None): 生成結果のキャッシュ。Noneの場合はキャッシュしない。
+            cache_nondeterministic (bool): 生成結果が毎回変わりうるリクエストもキャッシュするか。
+            max_context_tokens (int | None): モデルのコンテキスト長（トークン数）の上限。パネリストのメッセージログの切り詰めに使用する。
+            tokenizer (str | None): トークン数を数えるトークナイザの指定（TokenCounterを参照）。
+                Noneの場合は、base_urlがなければモデル名からtiktokenを使用し、あれば文字数から概算する。
         """
         # モデルタグ
         self._model_tag = model_tag
@@ -64,8 +82,25 @@ class SimpleLLMClient(BaseLLMClient):
         # APIキーについては、文字列内に含まれてる環境変数を展開
         if api_key is not None:
             api_key = replace_env_variable(api_key)
+        # 同時リクエスト数の上限とタイムアウトをセット
+        self._semaphore = asyncio.Semaphore(max_concurrency) if max_concurrency is not None else None
+        self._request_timeout = request_timeout
+        # 生成結果のキャッシュをセット
+        self._completion_cache = completion_cache
+        self._cache_nondeterministic = cache_nondeterministic
+        # コンテキスト長の上限をセット
+        self._max_context_tokens = max_context_tokens
+        # トークン数を数えるモジュールをセット（トークナイザは最初に数える時に読み込む）
+        self._token_counter = get_token_counter(tokenizer, model_version, str(base_url) if base_url is not None else None)
+        # コネクションプールをセット（同時リクエスト数の上限がある場合は、コネクション数も同じ値で制限する）
+        if max_concurrency is not None:
+            http_client = openai.DefaultAsyncHttpxClient(
+                limits=httpx.Limits(max_connections=max_concurrency, max_keepalive_connections=max_concurrency)
+            )
+        else:
+            http_client = None
         # クライアントをセット
-        self._client = openai.OpenAI(
+        self._client = openai.AsyncOpenAI(
             api_key=api_key,
             organization=organization,
             project=project,
@@ -74,7 +109,7 @@ class SimpleLLMClient(BaseLLMClient):
             max_retries=max_retries,
             default_headers=default_headers,
             default_query=default_query,
-            http_client=None,
+            http_client=http_client,
             _strict_response_validation=strict_response_validation
         )
         # ロガーをセット
@@ -0,0 +1,196 @@
+"""プロンプトのトークン数を数えるモジュール。
+
+TokenCounterと、トークナイザの指定からプロセス内で共有するTokenCounterを取得するget_token_counterを定義する。
+"""
+import collections.abc
+import functools
+import logging
+import threading
+import typing
+try:
+    import tiktoken   # OpenAIのモデルのトークン数を数える場合のみ使用（インストールされていない場合は概算する）
+except ImportError:
+    tiktoken = None
+
+
+_LOGGER = logging.getLogger(__name__)
+_LOGGER.addHandler(logging.NullHandler())
+
+
+# 1メッセージあたりの、ロールや区切りなど本文以外のトークン数の見積もり
+MESSAGE_OVERHEAD_TOKENS = 4
+
+# テキストごとのトークン数をキャッシュする件数（システムプロンプトなど、同じテキストを繰り返し数えるため）
+TOKEN_COUNT_CACHE_SIZE = 4096
+
+
+class ContextLengthExceededError(ValueError):
+    """プロンプトのトークン数がモデルのコンテキスト長の上限を超えている場合の例外。"""
+
+
+def estimate_tokens(text: str) -> int:
+    """文字数からトークン数を概算する。
+
+    トークナイザを使わずに、ASCII文字は4文字で1トークン、それ以外の文字（日本語など）は1文字で1トークンとして数える。
+    多くのトークナイザで実際より多めに見積もられるため、上限の判定に用いても溢れにくい。
+
+    Args:
+        text (str): テキスト。
+
+    Returns:
+        int: トークン数の概算。
+    """
+    num_ascii = sum(1 for c in text if c.isascii())
+    return (num_ascii + 3) // 4 + (len(text) - num_ascii)
+
+
+class TokenCounter:
+    """トークン数を数えるモジュール。
+
+    トークナイザの指定に従い、tiktoken（OpenAIのモデル）またはHugging Faceのトークナイザ（ローカルのモデル）でトークン数を数える。
+    トークナイザは最初に数える時に読み込む。読み込めなかった場合は、文字数から概算する。
+    同じテキストを繰り返し数えないよう、テキストごとのトークン数はキャッシュする。
+
+    トークナイザの指定は以下の形式とする。
+    - `tiktoken:<モデル名またはエンコーディング名>`: tiktokenを使用する。`tiktoken:gpt-4o`、`tiktoken:o200k_base`など。
+    - `hf:<モデルID>`: Hugging Faceのトークナイザを使用する。`hf:elyza/Llama-3-ELYZA-JP-8B`など。
+    - `estimate`: 文字数から概算する。
+
+    Attributes:
+        tokenizer (str): トークナイザの指定。
+        is_exact (bool): トークナイザで数えているか。Falseの場合は概算。最初に数えるまではFalse。
+    """
+
+    def __init__(self, tokenizer: str):
+        """コンストラクタ。
+
+        Args:
+            tokenizer (str): トークナイザの指定。
+        """
+        self.tokenizer = tokenizer
+        self.is_exact = False
+        self._encode: typing.Callable[[str], list] | None = None
+        self._lock = threading.Lock()
+        self._count_cached = functools.lru_cache(maxsize=TOKEN_COUNT_CACHE_SIZE)(self._count)
+
+    def count(self, text: str) -> int:
+        """テキストのトークン数を数える。
+
+        Args:
+            text (str): テキスト。
+
+        Returns:
+            int: トークン数。
+        """
+        if self._encode is None:
+            self._load()
+        return self._count_cached(text)
+
+    def _count(self, text: str) -> int:
+        """読み込んだトークナイザでテキストのトークン数を数える。
+
+        Args:
+            text (str): テキスト。
+
+        Returns:
+            int: トークン数。
+        """
+        if not self.is_exact:
+            return estimate_tokens(text)
+        return len(self._encode(text))
+
+    def count_messages(self, messages: collections.abc.Iterable[dict]) -> int:
+        """API用の形式のメッセージのリストのトークン数を数える。
+
+        Args:
+            messages (Iterable[dict]): API用の形式のメッセージのリスト。
+
+        Returns:
+            int: 本文のトークン数に、メッセージごとの本文以外のトークン数の見積もりを加えたもの。
+        """
+        return sum(self.count(str(message.get('content') or '')) + MESSAGE_OVERHEAD_TOKENS for message in messages)
+
+    def _load(self):
+        """トークナイザを読み込む。読み込めなかった場合は概算に切り替える。"""
+        with self._lock:
+            if self._encode is not None:
+                return
+            kind, _, name = self.tokenizer.partition(':')
+            encode = None
+            try:
+                if kind == 'tiktoken':
+                    encode = self._load_tiktoken(name)
+                elif kind == 'hf':
+                    encode = self._load_hf(name)
+                elif kind != 'estimate':
+                    raise ValueError(f'unknown tokenizer: {self.tokenizer}')
+            except Exception:
+                _LOGGER.warning(f"tokenizer not loaded, estimating tokens instead: tokenizer={self.tokenizer}",
+                                exc_info=True)
+            if encode is not None:
+                self.is_exact = True
+                self._encode = encode
+                _LOGGER.info(f"tokenizer loaded: {self.tokenizer}")
+            else:
+                self._encode = estimate_tokens
+
+    @staticmethod
+    def _load_tiktoken(name: str) -> typing.Callable[[str], list]:
+        """tiktokenのエンコーダを読み込む。
+
+        Args:
+            name (str): モデル名またはエンコーディング名。
+
+        Returns:
+            Callable[[str], list]: テキストをトークンのリストにする関数。
+        """
+        if tiktoken is None:
+            raise ImportError('tiktokenでトークン数を数えるにはtiktokenパッケージをインストールしてください')
+        try:
+            encoding = tiktoken.encoding_for_model(name)
+        except KeyError:
+            encoding = tiktoken.get_encoding(name)
+        return lambda text: encoding.encode(text, disallowed_special=())
+
+    @staticmethod
+    def _load_hf(name: str) -> typing.Callable[[str], list]:
+        """Hugging Faceのトークナイザを読み込む。
+
+        Args:
+            name (str): モデルIDまたはトークナイザのディレクトリまでのパス。
+
+        Returns:
+            Callable[[str], list]: テキストをトークンのリストにする関数。
+        """
+        from transformers import AutoTokenizer  # 読み込みが重いため、使用する時にだけインポート
+        tokenizer = AutoTokenizer.from_pretrained(name)
+        return lambda text: tokenizer.encode(text, add_special_tokens=False)
+
+
+# プロセス内で共有するTokenCounter（トークナイザの指定をキーとする）
+_TOKEN_COUNTERS: dict[str, TokenCounter] = {}
+_TOKEN_COUNTERS_LOCK = threading.Lock()
+
+
+def get_token_counter(tokenizer: str | None, model_version: str, base_url: str | None = None) -> TokenCounter:
+    """トークナイザの指定に対応する、プロセス内で共有するTokenCounterを取得する。
+
+    トークナイザの指定がない場合、OpenAIのAPI（base_urlの指定がないもの）であればモデル名からtiktokenを、
+    それ以外は文字数からの概算を使用する。
+
+    Args:
+        tokenizer (str | None): models.ymlの`tokenizer`に記載したトークナイザの指定。
+        model_version (str): モデル名。
+        base_url (str | None): モデルを配置したサーバのURL。
+
+    Returns:
+        TokenCounter: TokenCounter。
+    """
+    if tokenizer is None:
+        tokenizer = f'tiktoken:{model_version}' if base_url is None else 'estimate'
+    with _TOKEN_COUNTERS_LOCK:
+        counter = _TOKEN_COUNTERS.get(tokenizer)
+        if counter is None:
+            counter = TokenCounter(tokenizer)
+            _TOKEN_COUNTERS[tokenizer] = counter
+        return counter
@@ -0,0 +1,84 @@
+"""AI-Constellationシミュレータのうちのパネリストのメッセージログの管理のモジュール。
+
+ChatContextManagerを定義する。
+"""
+import logging
+from typing import Callable
+from ai_constellation.llm_clients.token_counter import MESSAGE_OVERHEAD_TOKENS, estimate_tokens
+
+
+_LOGGER = logging.getLogger(__name__)
+_LOGGER.addHandler(logging.NullHandler())
+
+
+# 応答の生成のために空けておくトークン数の既定値
+DEFAULT_RESPONSE_RESERVE_TOKENS = 512
+
+
+class ChatContextManager:
+    """パネリストのメッセージログの管理。
+
+    モデルのコンテキスト長（トークン数）の上限に合わせて、メッセージログを古いものから切り詰める（スライディングウィンドウ）。
+    システムプロンプトは常に残し、ユーザプロンプトとアシスタントの応答の組を単位として削除する。
+    切り詰めたメッセージログはそのままパネリストの記憶となるため、議論を重ねてもメモリ使用量とリクエストの大きさは上限を超えない。
+    """
+
+    def __init__(
+        self,
+        max_context_tokens: int | None,
+        reserve_tokens: int = DEFAULT_RESPONSE_RESERVE_TOKENS,
+        count_tokens: Callable[[str], int] = estimate_tokens
+    ):
+        """コンストラクタ。
+
+        Args:
+            max_context_tokens (int | None): モデルのコンテキスト長の上限。Noneの場合は切り詰めない。
+            reserve_tokens (int): 応答の生成のために空けておくトークン数。
+            count_tokens (Callable[[str], int]): テキストのトークン数を数える関数。
+        """
+        self.max_context_tokens = max_context_tokens
+        self.reserve_tokens = reserve_tokens
+        self.count_tokens = count_tokens
+
+    def count_message_tokens(self, message: dict[str, str]) -> int:
+        """1メッセージのトークン数を数える。
+
+        Args:
+            message (dict[str, str]): API用の形式のメッセージ。
+
+        Returns:
+            int: トークン数。
+        """
+        return self.count_tokens(str(message.get('content') or '')) + MESSAGE_OVERHEAD_TOKENS
+
+    def compact(self, chat_log: list[dict[str, str]], user_messages: list[dict[str, str]]) -> int:
+        """メッセージログにユーザプロンプトを加えたリクエストが上限に収まるように、メッセージログを切り詰める。
+
+        ユーザプロンプトが複数ある場合は、最も大きいものに合わせる。
+        システムプロンプトとユーザプロンプトだけで上限を超える場合は、それ以上切り詰められないため、そのままにする。
+
+        Args:
+            chat_log (list[dict[str, str]]): メッセージログ。先頭はシステムプロンプト。直接変更する。
+            user_messages (list[dict[str, str]]): これから送信するユーザプロンプトのメッセージ。
+
+        Returns:
+            int: 削除したメッセージ数。
+        """
+        if self.max_context_tokens is None:
+            return 0
+        budget = self.max_context_tokens - self.reserve_tokens
+        budget -= max((self.count_message_tokens(message) for message in user_messages), default=0)
+        message_tokens = [self.count_message_tokens(message) for message in chat_log]
+        total = sum(message_tokens)
+        # システムプロンプトの次から、ユーザプロンプトと応答の組ごとに古い順に削除
+        num_removed = 0
+        while total > budget and len(chat_log) - num_removed > 1:
+            removing = message_tokens[1 + num_removed:3 + num_removed]
+            total -= sum(removing)
+            num_removed += len(removing)
+        if num_removed > 0:
+            del chat_log[1:1 + num_removed]
+            _LOGGER.info(f"chat log compacted: removed={num_removed}, remaining={len(chat_log)}, tokens={total}")
+        if total > budget:
+            _LOGGER.warning(f"prompt exceeds context budget even after compaction: tokens={total}, budget={budget}")
+        return num_removed
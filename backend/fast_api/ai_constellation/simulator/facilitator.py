@@ -3,6 +3,7 @@
 DebateContextとFaicilitatorを定義する。
 FacilitatorはDebateContextで議論の状態を保持する。
 """
+import asyncio
 import dataclasses
 import json
 import logging
@@ -10,13 +11,12 @@ import pathlib
 import string
 from typing import Any
 import re
-import yaml
 
 from openai.types.chat import ChatCompletion
 
 from ai_constellation.common.utils import Mappable
 from ai_constellation.llm_clients.base_client import BaseLLMClient
-from ai_constellation.llm_clients.simple_client import SimpleLLMClient
+from ai_constellation.llm_clients.client_registry import get_client_registry
 from ai_constellation.simulator.panelist import Panelist
 from ai_constellation.tech.discussion_strategist import DiscussionStrategist
 
@@ -24,6 +24,33 @@ _LOGGER = logging.getLogger(__name__)
 _LOGGER.addHandler(logging.NullHandler())
 
 
+# 議論戦略構成器の設定ファイルのパス
+STRATEGIST_CONFIG_PATH = './ai_constellation/tech/strategist_config.yml'
+
+# 先行して生成を開始する発言数の既定値
+DEFAULT_LOOKAHEAD = 2
+
+# 他のパネリストの発言履歴のプレイスホルダ（これを含むプロンプトは前の発言が揃うまで作成できない）
+OPPONENTS_COMMENTS_PLACEHOLDERS = (
+    '${__opponents_comments_on_last_agenda__}',
+    '${__opponents_comments_on_current_agenda__}',
+)
+
+
+@dataclasses.dataclass
+class TurnGeneration:
+    """生成中のパネリストの発言。
+
+    Attributes:
+        task (asyncio.Task): 発言全体を返す生成のタスク。
+        deltas (asyncio.Queue | None): ストリーミングの場合に、発言の差分を届いた順に溜めるキュー。終端はNone。
+        use_strategy (bool): 議論戦略構成器を使用した生成か否か。
+    """
+    task: asyncio.Task
+    deltas: asyncio.Queue | None = None
+    use_strategy: bool = False
+
+
 @dataclasses.dataclass
 class DiscussionLog(Mappable):
     """議論ログ。
@@ -63,6 +90,7 @@ class DebateContext:
         additional_subsequent_user_prompt (str): 追加議論の2人目以降のユーザプロンプト。
         additional_last_user_prompt (str): 追加議論の最後のユーザプロンプト。
         num_discussion_turn (int): 議論のターン数。
+        lookahead (int): 前の発言に依存しない発言を先行して生成を開始する発言数。0の場合は先行しない。
         agendas (list[str]): 議題リスト。
         use_strategy: 議論戦略構成器を使用するか否か。
         lang: 言語。日本語(ja)か英語(en)か。
@@ -80,6 +108,7 @@ class DebateContext:
     additional_subsequent_user_prompt: str = ''
     additional_last_user_prompt: str = ''
     num_discussion_turn: int = 1
+    lookahead: int = DEFAULT_LOOKAHEAD
     agendas: list[str] = dataclasses.field(default_factory=list)
     use_strategy: bool = False
     lang: str = 'en'
@@ -132,17 +161,18 @@ class Facilitator:
         additional_subsequent_user_prompt: str,
         additional_last_user_prompt: str,
         num_discussion_turn: int,
+        lookahead: int = DEFAULT_LOOKAHEAD,
     ):
         """コンストラクタ。
 
         議論進行に必要な各種モジュールを生成する。
 
-        - LLMクライアント
+        - LLMクライアント（プロセス内で共有しているレジストリから取得）
         - パネリスト
         - DebateContext
-        - 議論戦略構成器
 
         これらをインスタンス変数として保持し、start_discussionで使用する。
+        議論戦略構成器は、使用する議論が開始された時点でget_strategistにより作成する。
 
         Args:
             panelist_personas (list[str]): パネリストのペルソナ一覧。
@@ -156,28 +186,19 @@ class Facilitator:
             additional_subsequent_user_prompt (str): 追加議論の2人目以降のユーザプロンプト。
             additional_last_user_prompt (str): 追加議論の最後のユーザプロンプト。
             num_discussion_turn (int): 議論のターン数。
+            lookahead (int): 先行して生成を開始する発言数。0の場合は先行しない。
+                前の発言に依存しない発言はlookahead人先まで、依存する発言は前の発言が揃った時点で生成を開始する。
         """
         # 出力ファイルを設定
         self.result_dir = pathlib.Path("./logs")
 
-        # モデル情報を取得
-        model_list = list(set(panelist_models))
-        model_config_path = pathlib.Path('./ai_constellation/llm_clients/models.yml')
-        if not model_config_path.exists():
-            raise FileNotFoundError('models.ymlが見つかりません')
-        with model_config_path.open('r', encoding='utf-8') as f:
-            model_config: dict = yaml.safe_load(f)
-
-        # クライアントを作成
-        self.clients: dict[str, BaseLLMClient] = {}
-        for model_tag in model_list:
-            model_dict: dict = model_config.get(model_tag, None)
-            if model_dict is not None:
-                self.clients[model_tag] = self.create_client(model_tag, model_dict)
-
-        # OpenAIのクライアントが無い場合は生成する（議論戦略構成器で使用するため）
+        # クライアントを取得（プロセス内で共有しているレジストリから取得し、議論ごとには生成しない）
+        client_registry = get_client_registry()
+        self.clients: dict[str, BaseLLMClient] = client_registry.get_clients(list(set(panelist_models)))
+
+        # OpenAIのクライアントが無い場合は取得する（議論戦略構成器で使用するため）
         if 'OpenAI' not in self.clients:
-            self.clients['OpenAI'] = self.create_client('OpenAI', model_config.get('OpenAI', None))
+            self.clients['OpenAI'] = client_registry.get_client('OpenAI')
 
         # 設定値を作成
         self.context = DebateContext(
@@ -193,6 +214,7 @@ class Facilitator:
             additional_subsequent_user_prompt=additional_subsequent_user_prompt,
             additional_last_user_prompt=additional_last_user_prompt,
             num_discussion_turn=num_discussion_turn,
+            lookahead=lookahead,
         )
 
         # パネリストを作成し、コンテキストに設定
@@ -216,48 +238,96 @@ class Facilitator:
             )
             self.context.panelists.append(panelist_i)
 
-        # 議論戦略構成器の作成
-        self.strategist = DiscussionStrategist.from_yaml(
-            path='./ai_constellation/tech/strategist_config.yml',
-            llm_client=self.clients['OpenAI'],
-        )
+        # 議論戦略構成器（議論戦略構成器を使用する議論が開始されるまで作成しない）
+        self.strategist: DiscussionStrategist | None = None
+
+    def get_state(self) -> dict:
+        """議論の途中経過を、JSONにダンプできる辞書として取得する。
 
-    # クライアントのインスタンスを生成
-    def create_client(self, model_tag: str, model_dict: dict) -> BaseLLMClient:
-        """LLMクライアントを生成する。
+        議題リスト、議論戦略構成器の使用可否、言語、議論ログ、各パネリストのメッセージログを含む。
+        パネリスト構成やプロンプトなどコンストラクタで与える値は含まない。
+
+        Returns:
+            dict: 議論の途中経過。
+        """
+        return {
+            'agendas': self.context.agendas,
+            'use_strategy': self.context.use_strategy,
+            'lang': self.context.lang,
+            'discussion_log': [log.to_dict() for log in self.context.discussion_log],
+            'chat_logs': [panelist.chat_log for panelist in self.context.panelists],
+        }
+
+    def load_state(self, state: dict):
+        """get_stateで取得した議論の途中経過を復元する。
+
+        同じ引数で生成したファシリテータに対して呼び出す。
 
         Args:
-            model_tag (str): モデルの種類を示すタグ。
-            model_dict (dict): モデルの情報が格納された辞書。
+            state (dict): 議論の途中経過。
+        """
+        self.context.agendas = state['agendas']
+        self.context.use_strategy = state['use_strategy']
+        self.context.lang = state['lang']
+        self.context.discussion_log = [DiscussionLog(**log) for log in state['discussion_log']]
+        for panelist, chat_log in zip(self.context.panelists, state['chat_logs']):
+            panelist.chat_log = chat_log
+
+    def estimate_size(self) -> int:
+        """議論の途中経過が保持している文字数を概算する。メモリ使用量の目安に用いる。
 
         Returns:
-            BaseLLMClient: LLMクライアントのインスタンス。
+            int: 各パネリストのメッセージログと議論ログの文字数の合計。
         """
-        _model_dict = {k: v for k, v in model_dict.items()}  # 副作用を避けて元の辞書からコピーした辞書を使う
-        model_version = _model_dict.pop("version")  # "version"だけ取り出す
-        return SimpleLLMClient(
-            model_tag=model_tag,
-            model_version=model_version,
-            **_model_dict
-        )
+        size = sum(len(str(log.comment)) for log in self.context.discussion_log)
+        for panelist in self.context.panelists:
+            size += sum(len(str(message.get('content', ''))) for message in panelist.chat_log)
+        return size
+
+    async def get_strategist(self) -> DiscussionStrategist:
+        """議論戦略構成器を取得する。
+
+        初回呼び出し時に議論戦略構成器を作成する。
+        議論戦略構成器を使用しない議論では呼び出されないため、埋め込みモデルの読み込みも発生しない。
+        埋め込みモデルの読み込みと状態名の埋め込みは重いため、イベントループをブロックしないよう別スレッドで作成する。
+
+        Returns:
+            DiscussionStrategist: 議論戦略構成器。
+        """
+        if self.strategist is None:
+            self.strategist = await asyncio.to_thread(
+                DiscussionStrategist.from_yaml,
+                path=STRATEGIST_CONFIG_PATH,
+                llm_client=self.clients['OpenAI'],
+            )
+        return self.strategist
 
     async def start_discussion(
         self,
         agenda: str,
         is_continue: bool,
         use_strategy: bool | None = None,
-        lang: str = None
+        lang: str = None,
+        stream: bool = False
     ):
         """議論を開始する。
 
         非同期ジェネレータとして、1ターンずつ議論ログを返却する。
         議論ログは、発言の種別、発言したパネリストのパネリスト名、発言の内容で構成されている。
+        ストリーミングを有効にした場合は、議論戦略構成器を使わないターンについて、
+        発言がすべて揃う前に発言の差分を種別`message_delta`として返却する。
+        発言がすべて揃った後は、ストリーミングしない場合と同様に種別`message`で発言全体を返却する。
+
+        各発言は、生成に必要な発言が揃った時点で（前の発言を返却する前に）生成を開始する。
+        前の発言に依存しない発言（is_independent_turnを参照）は、さらに先行して生成を開始する。
+        先行する発言数はDebateContext.lookaheadで制限する。返却する順番と内容は先行しない場合と変わらない。
 
         Args:
             agenda (str): 議題。
             is_continue (bool): 追加議論か否か。
             use_strategy (bool | None): 議論戦略構成器を使用するか否か。
             lang (str): 言語。日本語(ja)か英語(en)か。
+            stream (bool): 発言の差分をストリーミングで返却するか否か。
 
         Yields:
             tuple[str, str, str] : 発言の種別、発言したパネリストのパネリスト名、発言内容のタプル。
@@ -271,61 +341,230 @@ class Facilitator:
         if lang is not None:
             self.context.lang = lang
 
-        # ラウンドを実行
-        for turn in range(1, self.context.num_discussion_turn + 1):
-            # ラウンドのログを出力
-            yield 'system_info', 'system', f'======== ターン{turn} ========'
+        # 先行して生成を開始した発言（パネリストの順番をキーとする）
+        lookahead_turns: dict[int, TurnGeneration] = {}
+        try:
+            # ラウンドを実行
+            for turn in range(1, self.context.num_discussion_turn + 1):
+                async for log in self._run_turn(turn, agenda, is_continue, stream, lookahead_turns):
+                    yield log
+        finally:
+            # 議論が中断された場合は、先行して開始した生成をキャンセルし、終了を待つ（失敗していた場合の例外も回収する）
+            tasks = [turn_generation.task for turn_generation in lookahead_turns.values()]
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+        # ロギング
+        _LOGGER.debug(
+            'discussion_history_log:\n%s',
+            json.dumps([log.to_dict() for log in self.context.discussion_log], indent=4, ensure_ascii=False)
+        )
+
+        yield None, None, None  # AsyncGenratorでreturnを使用するとエラーになるのでyieldで返却する
+
+    async def _run_turn(
+        self,
+        turn: int,
+        agenda: str,
+        is_continue: bool,
+        stream: bool,
+        lookahead_turns: dict[int, TurnGeneration]
+    ):
+        """1ターン分の議論を実行する。
+
+        非同期ジェネレータとして、start_discussionと同じ形式で議論ログを返却する。
+        各パネリストの発言を議論ログに格納したら、返却する前に次のパネリストの発言の生成を開始する。
 
-            # 各パネリストに発言をさせる
-            for panelist_no, panelist in enumerate(self.context.panelists):
+        Args:
+            turn (int): ターン数。
+            agenda (str): 議題。
+            is_continue (bool): 追加議論か否か。
+            stream (bool): 発言の差分をストリーミングで返却するか否か。
+            lookahead_turns (dict[int, TurnGeneration]): 先行して生成を開始した発言。パネリストの順番をキーとする。
 
-                # テンプレートを選択、プレイスホルダ置換
-                prompt_template = self.get_prompt_template(is_continue, turn, panelist_no)
-                user_prompt = self.substitute_placeholder(prompt_template, panelist.id)
+        Yields:
+            tuple[str, str, str] : 発言の種別、発言したパネリストのパネリスト名、発言内容のタプル。
+        """
+        # ラウンドのログを出力
+        yield 'system_info', 'system', f'======== ターン{turn} ========'
 
-                # LLMの回答を取得
-                # NOTE: 各ラウンドで2ターン目の発言者から介入が入るように設計している
-                if self.context.use_strategy and panelist_no >= 1:
-                    _LOGGER.info("facilitator.start_discussion getting response by strategist: " +
-                                 f"use_strategy={ self.context.use_strategy}, panelist_no={panelist_no}")
+        # 各パネリストに発言をさせる
+        for panelist_no, panelist in enumerate(self.context.panelists):
+
+            # 後続のパネリストのうち、前の発言に依存しない発言の生成を先行して開始
+            self._start_lookahead(turn, is_continue, stream, panelist_no, lookahead_turns)
+
+            # LLMの回答を取得（先行して生成を開始していなければ、ここで開始する）
+            turn_generation = lookahead_turns.pop(panelist_no, None)
+            if turn_generation is None:
+                turn_generation = self._start_turn(turn, is_continue, stream, panelist_no)
+            else:
+                _LOGGER.info(f"facilitator.start_discussion getting response by lookahead: panelist_no={panelist_no}")
+            try:
+                if turn_generation.use_strategy:
                     # 「介入中」の議論ログを一時返却
                     intervening_text = 'ファシリテータAIの議論への介入中' \
                         if self.context.lang == "ja" else 'Intervening in the discussion by a facilitator AI'
                     yield 'opt_info', 'optimizer', intervening_text
-                    # 各介入を実施し、一番良い返答を取得
-                    response = await self.strategist.get_best_response(
-                        previous_comments=[log.comment for log in self.context.discussion_log],
-                        base_prompt=user_prompt,
-                        panelist=panelist,
-                    )
-                else:
-                    _LOGGER.info("facilitator.start_discussion getting response by panelist: " +
-                                 f"use_strategy={self.context.use_strategy}, panelist_no={panelist_no}")
-                    response = await panelist.generate(user_prompt)
-
-                # 議論ログに格納
-                response_log = DiscussionLog(
-                    agenda=agenda,
-                    panelist_id=panelist.id,
-                    panelist_name=panelist.name,
-                    panelist_persona=panelist.persona,
-                    comment=response
-                )
-                self.context.discussion_log.append(response_log)
-
-                # ロギング
-                _LOGGER.debug('discussion_response_log:\n%s', json.dumps(response_log.to_dict(), indent=4, ensure_ascii=False))
-
-                # 返却
-                yield 'message', panelist.name, response
+                if turn_generation.deltas is not None:
+                    # 発言の差分を届いた順に返却（先行して生成していた場合は、溜まっていた差分から返却）
+                    while (delta := await turn_generation.deltas.get()) is not None:
+                        yield 'message_delta', panelist.name, delta
+                response = await turn_generation.task
+            finally:
+                # 返却の途中で議論が中断された場合は、生成をキャンセルする
+                if not turn_generation.task.done():
+                    turn_generation.task.cancel()
+                    await asyncio.gather(turn_generation.task, return_exceptions=True)
+
+            # 議論ログに格納
+            response_log = DiscussionLog(
+                agenda=agenda,
+                panelist_id=panelist.id,
+                panelist_name=panelist.name,
+                panelist_persona=panelist.persona,
+                comment=response
+            )
+            self.context.discussion_log.append(response_log)
 
-        # ロギング
-        _LOGGER.debug(
-            'discussion_history_log:\n%s',
-            json.dumps([log.to_dict() for log in self.context.discussion_log], indent=4, ensure_ascii=False)
+            # ロギング
+            _LOGGER.debug('discussion_response_log:\n%s', json.dumps(response_log.to_dict(), indent=4, ensure_ascii=False))
+
+            # 次のパネリストの発言に必要な発言が揃ったので、返却を待たずに生成を開始
+            next_no = panelist_no + 1
+            if self.context.lookahead > 0 and next_no < len(self.context.panelists) and next_no not in lookahead_turns:
+                lookahead_turns[next_no] = self._start_turn(turn, is_continue, stream, next_no)
+
+            # 返却
+            yield 'message', panelist.name, response
+
+    def _start_turn(self, turn: int, is_continue: bool, stream: bool, panelist_no: int) -> TurnGeneration:
+        """パネリストの発言の生成を開始する。
+
+        プロンプトとこれまでの議論ログは開始時点の内容で確定する。
+        議論戦略構成器を使用する発言（各ターンの2人目以降）は、議論状態の判定と介入文ごとの応答の生成をまとめて開始する。
+        ストリーミングの場合は、差分をTurnGeneration.deltasに溜める。
+
+        Args:
+            turn (int): ターン数。
+            is_continue (bool): 追加議論か否か。
+            stream (bool): 発言の差分をストリーミングで返却するか否か。
+            panelist_no (int): パネリストの順番。
+
+        Returns:
+            TurnGeneration: 生成中の発言。
+        """
+        panelist = self.context.panelists[panelist_no]
+        prompt_template = self.get_prompt_template(is_continue, turn, panelist_no)
+        user_prompt = self.substitute_placeholder(prompt_template, panelist.id)
+        # NOTE: 各ラウンドで2ターン目の発言者から介入が入るように設計している
+        use_strategy = bool(self.context.use_strategy) and panelist_no >= 1
+        _LOGGER.info("facilitator.start_discussion start generating response: " +
+                     f"use_strategy={use_strategy}, stream={stream}, panelist_no={panelist_no}")
+        if use_strategy:
+            previous_comments = [log.comment for log in self.context.discussion_log]
+            return TurnGeneration(
+                task=asyncio.create_task(self._generate_by_strategist(previous_comments, user_prompt, panelist)),
+                use_strategy=True,
+            )
+        if stream:
+            deltas: asyncio.Queue[str | None] = asyncio.Queue()
+            return TurnGeneration(task=asyncio.create_task(self._generate_stream(user_prompt, panelist, deltas)),
+                                  deltas=deltas)
+        return TurnGeneration(task=asyncio.create_task(panelist.generate(user_prompt)))
+
+    async def _generate_by_strategist(
+        self,
+        previous_comments: list[str],
+        user_prompt: str,
+        panelist: Panelist
+    ) -> ChatCompletion | Any:
+        """議論戦略構成器で、最も良い展開になる応答を生成する。
+
+        Args:
+            previous_comments (list[str]): これまでの議論ログ。
+            user_prompt (str): 介入文を付け足すユーザプロンプト。
+            panelist (Panelist): パネリスト。
+
+        Returns:
+            ChatCompletion | Any: 最も良い展開になる応答。
+        """
+        strategist = await self.get_strategist()
+        return await strategist.get_best_response(
+            previous_comments=previous_comments,
+            base_prompt=user_prompt,
+            panelist=panelist,
         )
 
-        yield None, None, None  # AsyncGenratorでreturnを使用するとエラーになるのでyieldで返却する
+    @staticmethod
+    async def _generate_stream(user_prompt: str, panelist: Panelist, deltas: asyncio.Queue) -> str:
+        """ストリーミングで応答を生成し、差分をキューに溜める。
+
+        生成が終わった時点（失敗した場合を含む）で、終端としてNoneをキューに入れる。
+
+        Args:
+            user_prompt (str): ユーザプロンプト。
+            panelist (Panelist): パネリスト。
+            deltas (asyncio.Queue): 差分を溜めるキュー。
+
+        Returns:
+            str: 応答全体。
+        """
+        response = ''
+        try:
+            async for delta in panelist.generate_stream(user_prompt):
+                response += delta
+                deltas.put_nowait(delta)
+        finally:
+            deltas.put_nowait(None)
+        return response
+
+    def _start_lookahead(
+        self,
+        turn: int,
+        is_continue: bool,
+        stream: bool,
+        panelist_no: int,
+        lookahead_turns: dict[int, TurnGeneration]
+    ):
+        """現在のパネリストの後続のうち、前の発言に依存しない発言の生成を先行して開始する。
+
+        対象は同じターン内の後続lookahead人までとする。
+        ターンをまたぐと、同じパネリストの前の発言（メッセージログ）に依存するため先行しない。
+
+        Args:
+            turn (int): ターン数。
+            is_continue (bool): 追加議論か否か。
+            stream (bool): 発言の差分をストリーミングで返却するか否か。
+            panelist_no (int): 現在のパネリストの順番。
+            lookahead_turns (dict[int, TurnGeneration]): 先行して生成を開始した発言。パネリストの順番をキーとする。
+        """
+        last_no = min(panelist_no + self.context.lookahead, len(self.context.panelists) - 1)
+        for ahead_no in range(panelist_no + 1, last_no + 1):
+            if ahead_no in lookahead_turns or not self.is_independent_turn(is_continue, turn, ahead_no):
+                continue
+            lookahead_turns[ahead_no] = self._start_turn(turn, is_continue, stream, ahead_no)
+
+    def is_independent_turn(self, is_continue: bool, turn: int, panelist_no: int) -> bool:
+        """発言が前の発言に依存せず、前の発言が揃う前に生成できるかを判定する。
+
+        以下のいずれかに当たる発言は依存するものとする。
+        - プロンプトテンプレートに他のパネリストの発言履歴のプレイスホルダを含む
+        - 議論戦略構成器を使用する（これまでの議論ログから議論の状態を判定するため）
+
+        Args:
+            is_continue (bool): 追加議論か否か。
+            turn (int): ターン数。
+            panelist_no (int): パネリストの順番。
+
+        Returns:
+            bool: 依存しない場合はTrue。
+        """
+        if self.context.use_strategy and panelist_no >= 1:
+            return False
+        prompt_template = self.get_prompt_template(is_continue, turn, panelist_no)
+        return not any(placeholder in prompt_template.template for placeholder in OPPONENTS_COMMENTS_PLACEHOLDERS)
 
     ################ プロンプト作成のための関数 ################
 
@@ -2,10 +2,14 @@
 
 Panelistを定義する。
 """
+import asyncio
+import contextlib
 import json
 import logging
+from typing import Awaitable
 from openai.types.chat import ChatCompletion
 from ai_constellation.llm_clients.base_client import BaseLLMClient
+from ai_constellation.simulator.chat_context import ChatContextManager
 
 
 _LOGGER = logging.getLogger(__name__)
@@ -31,6 +35,7 @@ class Panelist:
 
         与えられたペルソナの情報やLLMクライアントを保持する。
         また、システムプロンプトは、メッセージログに追加する形でも保持する。
+        メッセージログは、LLMクライアントのコンテキスト長の上限に収まるように、リクエストの作成時に古いものから切り詰める。
 
         Args:
             id (str): パネリストID。
@@ -45,10 +50,27 @@ class Panelist:
         self.client: BaseLLMClient = client       # LLMクライアント
         self.system_prompt: str = system_prompt   # システムプロンプト
         self.chat_log: list[dict[str, str]] = []  # メッセージログ（パネリストの記憶）
+        self.context_manager = ChatContextManager(   # メッセージログの管理
+            client.get_max_context_tokens(), count_tokens=client.count_tokens)
 
         # メッセージログにシステムプロンプトを追加
         self.chat_log.append(self.client.format_system_message(system_prompt))
 
+    def build_requests(self, user_prompts: list[str]) -> list[list[dict[str, str]]]:
+        """メッセージログにユーザプロンプトを追加したリクエスト用のデータを作成する。
+
+        作成前に、最も大きいユーザプロンプトでもコンテキスト長の上限に収まるようにメッセージログを切り詰める。
+
+        Args:
+            user_prompts (list[str]): ユーザプロンプトのリスト。
+
+        Returns:
+            list[list[dict[str, str]]]: ユーザプロンプトと同じ順番のリクエスト用のデータ。
+        """
+        user_messages = [self.client.format_user_message(prompt) for prompt in user_prompts]
+        self.context_manager.compact(self.chat_log, user_messages)
+        return [self.chat_log + [user_message] for user_message in user_messages]
+
     async def generate(self, user_prompt: str) -> ChatCompletion:
         """ログを残しながら応答を生成する。
 
@@ -59,39 +81,138 @@ class Panelist:
             ChatCompletion: 応答結果。
         """
         # メッセージログにユーザプロンプト（リクエスト）を追加したリクエスト用のデータを作成
-        messege_log_tmp = self.chat_log + [self.client.format_user_message(user_prompt)]
+        messege_log_tmp, = self.build_requests([user_prompt])
         response = await self.client.generate(messege_log_tmp)  # LLMが回答を作成
         self.log(user_prompt, response)  # ログを残す
         return response
 
+    async def generate_stream(self, user_prompt: str):
+        """ログを残しながら応答をストリーミングで生成する。
+
+        非同期ジェネレータとして、応答の差分を届いた順に返却する。
+        応答がすべて揃った時点で、generateと同様にログを残す。
+
+        Args:
+            user_prompt: ユーザプロンプト。
+
+        Yields:
+            str: 応答の差分。
+        """
+        # メッセージログにユーザプロンプト（リクエスト）を追加したリクエスト用のデータを作成
+        messege_log_tmp, = self.build_requests([user_prompt])
+        response = ''
+        async for delta in self.client.generate_stream(messege_log_tmp):  # LLMが回答を作成
+            response += delta
+            yield delta
+        self.log(user_prompt, response)  # ログを残す
+
     # ログに残さずに応答生成
-    async def generate_wo_log(self, user_prompt: str | list[str]) -> ChatCompletion | list[ChatCompletion]:
+    async def generate_wo_log(
+        self,
+        user_prompt: str | list[str],
+        max_concurrency: int | None = None,
+        timeout: float | None = None,
+        min_responses: int | None = None,
+        selection: Awaitable[list[int]] | None = None
+    ) -> ChatCompletion | list[ChatCompletion | None]:
         """ログを残さずに応答を生成する。
 
         ユーザプロンプトを複数で渡された場合にも対応している。
-        複数で渡された場合は、すべてのユーザプロンプトに対して1回ずつ応答の生成を行い、複数の応答結果を返却する。
+        複数で渡された場合は、すべてのユーザプロンプトに対する応答の生成を並行して行い、複数の応答結果を返却する。
+        応答結果のリストはユーザプロンプトと同じ順番で並ぶ。
+        タイムアウトやエラーで応答が得られなかったもの、min_responsesに達した時点で打ち切ったものはNoneになる。
 
         Args:
             user_prompt (str | list[str]): ユーザプロンプト。
+            max_concurrency (int | None): 複数の場合の同時生成数の上限。Noneの場合は上限なし。
+            timeout (float | None): 複数の場合の1件あたりのタイムアウト秒数。Noneの場合はLLMクライアントの設定に従う。
+            min_responses (int | None): 複数の場合に、この件数の応答が得られた時点で残りの生成を打ち切る。Noneの場合はすべて待つ。
+            selection (Awaitable[list[int]] | None): 複数の場合に、必要なユーザプロンプトのインデックスを後から確定させる処理。
+                生成と並行して待ち、確定した時点で不要な生成を打ち切る。Noneの場合はすべて必要とする。
 
         Returns:
-            ChatCompletion | list[ChatCompletion]: 応答結果。
+            ChatCompletion | list[ChatCompletion | None]: 応答結果。
         """
         if type(user_prompt) is list:
-            response_list = []
-            for prompt in user_prompt:
-                # メッセージログにユーザプロンプト（リクエスト）を追加したリクエスト用のデータを作成
-                messege_log_tmp = self.chat_log + [self.client.format_user_message(prompt)]
-                response_list.append(await self.client.generate(messege_log_tmp))  # LLMが回答を作成
-            return response_list
+            return await self._generate_candidates(user_prompt, max_concurrency, timeout, min_responses, selection)
         elif type(user_prompt) is str:
             # メッセージログにユーザプロンプト（リクエスト）を追加したリクエスト用のデータを作成
-            messege_log_tmp = self.chat_log + [self.client.format_user_message(user_prompt)]
+            messege_log_tmp, = self.build_requests([user_prompt])
             response = await self.client.generate(messege_log_tmp)  # LLMが回答を作成
             return response
         else:
             raise Exception('user_prompt is not of type string or string list.')
 
+    async def _generate_candidates(
+        self,
+        user_prompts: list[str],
+        max_concurrency: int | None,
+        timeout: float | None,
+        min_responses: int | None,
+        selection: Awaitable[list[int]] | None = None
+    ) -> list[ChatCompletion | None]:
+        """複数のユーザプロンプトに対する応答を並行して生成する。
+
+        selectionが与えられた場合は、必要なユーザプロンプトが確定するのを待たずにすべての生成を開始する（投機的実行）。
+        確定した時点で不要な生成をキャンセルし、min_responsesも必要なものの中で数える。
+
+        Args:
+            user_prompts (list[str]): ユーザプロンプトのリスト。
+            max_concurrency (int | None): 同時生成数の上限。Noneの場合は上限なし。
+            timeout (float | None): 1件あたりのタイムアウト秒数。Noneの場合はLLMクライアントの設定に従う。
+            min_responses (int | None): この件数の応答が得られた時点で残りの生成を打ち切る。Noneの場合はすべて待つ。
+            selection (Awaitable[list[int]] | None): 必要なユーザプロンプトのインデックスを後から確定させる処理。
+
+        Returns:
+            list[ChatCompletion | None]: ユーザプロンプトと同じ順番の応答結果。応答が得られなかったもの、不要だったものはNone。
+        """
+        concurrency_limit = asyncio.Semaphore(max_concurrency) if max_concurrency else contextlib.nullcontext()
+
+        async def _generate(messege_log_tmp: list[dict[str, str]]) -> ChatCompletion:
+            async with concurrency_limit:
+                return await asyncio.wait_for(self.client.generate(messege_log_tmp, timeout=timeout), timeout)
+
+        # メッセージログにユーザプロンプト（リクエスト）を追加したリクエスト用のデータを作成し、すべての生成を一斉に開始
+        tasks = [asyncio.create_task(_generate(request)) for request in self.build_requests(user_prompts)]
+        task_indices = {task: i for i, task in enumerate(tasks)}
+        responses: list[ChatCompletion | None] = [None] * len(tasks)
+        selected = set(range(len(tasks)))  # 必要なユーザプロンプトのインデックス（確定するまではすべて）
+        selection_task = asyncio.ensure_future(selection) if selection is not None else None
+        try:
+            # 必要なものが確定し、その中で必要な件数の応答が揃うまで、終わったものから回収
+            pending = set(tasks)
+            while True:
+                num_required = len(selected) if min_responses is None else min(min_responses, len(selected))
+                num_succeeded = sum(responses[i] is not None for i in selected)
+                if selection_task is None and (not pending or num_succeeded >= num_required):
+                    break
+                waiting = (pending | {selection_task}) if selection_task is not None else pending
+                done, _ = await asyncio.wait(waiting, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task is selection_task:
+                        # 必要なものが確定したら、不要な生成は待たない
+                        selected = set(selection_task.result())
+                        selection_task = None
+                        pending = {task_i for task_i in pending if task_indices[task_i] in selected}
+                        continue
+                    pending.discard(task)
+                    if task.exception() is not None:
+                        _LOGGER.warning(f"candidate generation failed: {task.exception()!r}")
+                        continue
+                    responses[task_indices[task]] = task.result()
+        finally:
+            # 打ち切った生成や、呼び出し元がキャンセルされた場合の生成はキャンセルする
+            for task in tasks:
+                task.cancel()
+            if selection_task is not None:
+                selection_task.cancel()
+
+        # 不要だった応答は返却しない
+        responses = [response_i if i in selected else None for i, response_i in enumerate(responses)]
+        if all(response_i is None for response_i in responses):
+            raise Exception('all candidate generations failed.')
+        return responses
+
     # ログを残すための関数（主に外部からログを残すために使用）
     def log(self, user_prompt: str, response: ChatCompletion):
         """議論ログを追加する。
@@ -11,13 +11,15 @@ import json
 import logging
 import string
 import numpy as np
-import torch
 import yaml
-from transformers import pipeline, AutoTokenizer
 from typing import Any
 from openai.types.chat import ChatCompletion
 from ai_constellation.llm_clients.base_client import BaseLLMClient
 from ai_constellation.simulator.panelist import Panelist
+from ai_constellation.tech.embedding_service import (
+    DEFAULT_EMBEDDING_BACKEND, DEFAULT_EMBEDDING_BATCH_SIZE, DEFAULT_EMBEDDING_CACHE_SIZE, DEFAULT_POOLING,
+    EmbeddingBackend, EmbeddingService, Pooling, get_embedding_service
+)
 
 
 _LOGGER = logging.getLogger(__name__)
@@ -40,12 +42,23 @@ class DiscussionStrategist:
         llm_client: BaseLLMClient,
         embedding_model_name: str,
         torch_device: str,
+        candidate_fanout_limit: int | None = None,
+        candidate_timeout: float | None = None,
+        min_candidates: int | None = None,
+        speculative_fanout: bool = False,
+        embedding_batch_size: int = DEFAULT_EMBEDDING_BATCH_SIZE,
+        embedding_cache_size: int = DEFAULT_EMBEDDING_CACHE_SIZE,
+        embedding_num_threads: int | None = None,
+        embedding_backend: EmbeddingBackend = DEFAULT_EMBEDDING_BACKEND,
+        embedding_pooling: Pooling = DEFAULT_POOLING,
+        state_top_k: int = 1,
+        state_margin: float = 0.0,
     ):
         """コンストラクタ。
 
-        埋め込み用のパイプラインを生成する。
+        プロセス内で共有している埋め込みサービスを取得する（初回のみ埋め込みモデルを読み込む）。
         また、議論状態判断器と議論評価器を生成する。
-        その際、議論状態判断器と議論評価器には埋め込み用のパイプラインを渡す。
+        その際、議論状態判断器と議論評価器には埋め込みサービスを渡す。
         これらのモジュールは、インスタンス変数で保持し、get_best_responseで使用する。
 
         Args:
@@ -54,24 +67,46 @@ class DiscussionStrategist:
             state_judge_prompt (str): 議論の状態を取得するためのプロンプト。
             legal_prompts_dict (dict[str, list[int]]): 議論の状態と使用可能なプロンプトのインデックス番号を格納した辞書。
             llm_client (BaseLLMClient): 議論状態を取得するためのLLMクライアント。
-            embedding_model_name (str): 議論ログや議論の状態の埋め込み(Embedding)に使用するモデルの名前。パイプライン用。
+            embedding_model_name (str): 議論ログや議論の状態の埋め込み(Embedding)に使用するモデルの名前。
             torch_device (str): GPU/CPUの設定。
+            candidate_fanout_limit (int | None): 介入文ごとの応答を並行して生成する際の同時生成数の上限。Noneの場合は上限なし。
+            candidate_timeout (float | None): 介入文ごとの応答の生成1件あたりのタイムアウト秒数。
+            min_candidates (int | None): この件数の応答が得られた時点で残りの生成を打ち切る。Noneの場合はすべて待つ。
+            speculative_fanout (bool): 議論の状態の判定を待たずに、すべての介入文で応答の生成を開始するか。
+                状態が確定した時点で、使用できない介入文の生成は打ち切る。
+            embedding_batch_size (int): 埋め込みの1回の推論でまとめて処理するテキスト数の上限。
+            embedding_cache_size (int): 埋め込みのキャッシュのエントリ数の上限。
+            embedding_num_threads (int | None): 埋め込みの推論に使用するPyTorchのスレッド数。Noneの場合はPyTorchの既定値。
+            embedding_backend (EmbeddingBackend): 埋め込みの推論のバックエンド。torch_fp32、torch_int8、onnxのいずれか。
+                torch_fp32以外の場合は、読み込み時に議論状態名の埋め込みでtorch_fp32との精度の差を確認する。
+            embedding_pooling (Pooling): 文埋め込みのプーリング方法。cls、meanのいずれか。
+            state_top_k (int): 議論の状態の候補として扱う、類似度の高い状態の数の上限。
+            state_margin (float): 最も類似度の高い状態との類似度の差がこの値以下の状態を候補とする。
+                候補の状態それぞれで使用可能な介入文をすべて使用する。判定が曖昧な場合だけ介入文を増やすために用いる。
         """
         # 基本的な戦略情報を設定
         self.tail_prompts = tail_prompts              # 後ろに追加するプロンプトのリスト
         self.legal_prompts_dict = legal_prompts_dict  # 状態をkeyとして渡すと、使用可能なプロンプトのインデックス番号のリストを返す辞書
 
-        # 埋め込みモデルの設定（トークナイザ, 埋め込みモデル）
-        tokenizer = AutoTokenizer.from_pretrained(
-            embedding_model_name,                 # 埋め込みのモデル名を設定
-            truncation_side='left',               # 文章長が長い場合、先頭から削る（先頭は古い発言）
-        )
-        embedding_pipeline = pipeline(
-            model=embedding_model_name,            # 埋め込みのモデル名を設定
-            task='feature-extraction',             # タスクは特徴量抽出
-            tokenize_kwargs={'truncation': True},  # 文章長が長い場合、文字数カットを実行
-            tokenizer=tokenizer,                   # トークナイザ
-            device=torch.device(torch_device)      # GPU/CPUの設定
+        # 介入文ごとの応答を並行生成する際の設定
+        self.candidate_fanout_limit = candidate_fanout_limit
+        self.candidate_timeout = candidate_timeout
+        self.min_candidates = min_candidates
+        self.speculative_fanout = speculative_fanout
+
+        # 議論の状態の候補の絞り込みの設定
+        self.state_top_k = state_top_k
+        self.state_margin = state_margin
+
+        # 埋め込みサービスの取得（全ルームで共有。fp32以外のバックエンドは議論状態名で精度を確認する）
+        embedding_service = get_embedding_service(
+            embedding_model_name, torch_device,
+            batch_size=embedding_batch_size,
+            cache_size=embedding_cache_size,
+            num_threads=embedding_num_threads,
+            backend=embedding_backend,
+            pooling=embedding_pooling,
+            parity_texts=state_names,
         )
 
         if state_names == [] or state_names is None:
@@ -82,9 +117,9 @@ class DiscussionStrategist:
                 state_names=state_names,
                 state_judge_prompt=state_judge_prompt,
                 llm_client=llm_client,
-                embedding_pipeline=embedding_pipeline,
+                embedding_service=embedding_service,
             )  # 状態の判断器
-        self.evaluator = DiscussionEvaluator(embedding_pipeline)    # 議論の評価器
+        self.evaluator = DiscussionEvaluator(embedding_service)    # 議論の評価器
 
     @classmethod
     def from_yaml(cls, path: str, llm_client: BaseLLMClient) -> 'DiscussionStrategist':
@@ -107,6 +142,17 @@ class DiscussionStrategist:
             llm_client=llm_client,
             embedding_model_name=config['embedding_model_name'],
             torch_device=config['torch_device'],
+            candidate_fanout_limit=config.get('candidate_fanout_limit'),
+            candidate_timeout=config.get('candidate_timeout'),
+            min_candidates=config.get('min_candidates'),
+            speculative_fanout=config.get('speculative_fanout', False),
+            embedding_batch_size=config.get('embedding_batch_size', DEFAULT_EMBEDDING_BATCH_SIZE),
+            embedding_cache_size=config.get('embedding_cache_size', DEFAULT_EMBEDDING_CACHE_SIZE),
+            embedding_num_threads=config.get('embedding_num_threads'),
+            embedding_backend=config.get('embedding_backend', DEFAULT_EMBEDDING_BACKEND),
+            embedding_pooling=config.get('embedding_pooling', DEFAULT_POOLING),
+            state_top_k=config.get('state_top_k', 1),
+            state_margin=config.get('state_margin', 0.0),
         )
 
     async def get_best_response(
@@ -120,6 +166,7 @@ class DiscussionStrategist:
         議論状態判断器を使用して、これまでの議論の状態を判定する。
         その状態で使用可能な介入文のリスト取得し、それぞれベースプロンプトに結合する。
         それらの各プロンプトでLLMに応答を求める。
+        speculative_fanoutが有効な場合は、状態の判定と並行してすべての介入文で応答を求め、判定後に使用可能なものだけ残す。
         それらの応答を議論評価器で点数化し、最も点数の良い応答を取得する。
         応答をロギングしてから返却する。
 
@@ -132,25 +179,40 @@ class DiscussionStrategist:
             ChatCompletion | Any: 最も良い展開になる応答。
         """
         
+        selection = None
         if self.state_judge is None:
             # 状態に関係なく全行動集合を取得
             legal_actions = [base_prompt + tail_prompt_i
                             for i, tail_prompt_i in enumerate(self.tail_prompts)]           
+        elif self.speculative_fanout:
+            # 全行動集合で生成を開始し、状態の判定後に使用可能な行動だけに絞る
+            legal_actions = [base_prompt + tail_prompt_i
+                            for i, tail_prompt_i in enumerate(self.tail_prompts)]
+            selection = self.get_legal_indices(previous_comments)
         else:
-            # 状態を取得
-            state = await self.state_judge.eval(previous_comments)
+            # 状態から使用可能な行動のインデックスを取得
+            legal_indices = await self.get_legal_indices(previous_comments)
 
             # 使用可能な行動集合の取得
             legal_actions = [base_prompt + tail_prompt_i
                             for i, tail_prompt_i in enumerate(self.tail_prompts)
-                            if i in self.legal_prompts_dict[state]]
-
-        # すべての行動をそれぞれ実行
-        responses = await panelist.generate_wo_log(legal_actions)
+                            if i in legal_indices]
+
+        # すべての行動をそれぞれ並行して実行し、応答が得られた行動だけ残す
+        responses = await panelist.generate_wo_log(
+            legal_actions,
+            max_concurrency=self.candidate_fanout_limit,
+            timeout=self.candidate_timeout,
+            min_responses=self.min_candidates,
+            selection=selection,
+        )
+        legal_actions, responses = map(list, zip(*[(action_i, response_i)
+                                                    for action_i, response_i in zip(legal_actions, responses)
+                                                    if response_i is not None]))
 
         # 一番良い返答を見つける
         discussions = [previous_comments + [response_i] for response_i in responses]  # 複数の議論展開のリストを作成
-        rewards = self.evaluator.eval(discussions)  # それぞれの議論展開を評価
+        rewards = await self.evaluator.eval(discussions)  # それぞれの議論展開を評価
         best_index = np.argmax(rewards)             # 最も良い展開になる応答のindexを取得
         best_response = responses[best_index]       # 最も良い展開になる応答を取得
 
@@ -170,12 +232,31 @@ class DiscussionStrategist:
 
         return best_response
 
+    async def get_legal_indices(self, previous_comments: list[str]) -> list[int]:
+        """議論の状態を判定し、その状態で使用可能な介入文のインデックスを取得する。
+
+        類似度の高い順にstate_top_k件までの状態のうち、最も類似度の高い状態との差がstate_margin以下のものを候補とし、
+        候補の状態それぞれで使用可能な介入文のインデックスを合わせて返す。
+
+        Args:
+            previous_comments (list[str]): これまでの議論ログ。
+
+        Returns:
+            list[int]: 使用可能な介入文のインデックスのリスト。
+        """
+        ranked_states = await self.state_judge.eval_top_k(previous_comments, self.state_top_k)
+        best_similarity = ranked_states[0][1]
+        states = [state for state, similarity in ranked_states if best_similarity - similarity <= self.state_margin]
+        _LOGGER.debug(f"discussion state judged: states={states}, ranked_states={ranked_states}")
+        return sorted({index for state in states for index in self.legal_prompts_dict[state]})
+
 
 class DiscussionStateJudge:
     """議論状態判断器。
 
     現在の議論の状態を判定するためのクラス。
     LLMに現在の議論の状態を尋ね、その応答が状態リストのどれに当たるかを判断する。
+    応答と状態名は埋め込みベクトルのコサイン類似度で比較する。
     """
 
     def __init__(
@@ -183,42 +264,83 @@ class DiscussionStateJudge:
         state_names: list[str],
         state_judge_prompt: str,
         llm_client: BaseLLMClient,
-        embedding_pipeline: str
+        embedding_service: EmbeddingService
     ):
         """コンストラクタ。
 
         コンストラクタでは、議論の状態名を埋め込みベクトルに変換する。
-        変換した埋め込みベクトルは、インスタンス変数として保持し、evalに使用する。
+        変換した埋め込みベクトルは、長さを1に正規化したfloat32の行列としてインスタンス変数に保持し、evalに使用する。
+        状態名の埋め込みは埋め込みサービス側でキャッシュされるため、2回目以降の生成では再計算しない。
 
         Args:
             state_names (list[str]): 議論の状態名のリスト。
             state_judge_prompt (str): 議論の状態を取得するためのプロンプト。
             llm_client (BaseLLMClient): 議論の状態を取得するためのLLMクライアント。
-            embedding_pipeline (str): 議論の状態名やLLMの応答を埋め込みベクトルに変換するためのパイプライン。
+            embedding_service (EmbeddingService): 議論の状態名やLLMの応答を埋め込みベクトルに変換するためのサービス。
         """
         self.state_names = state_names                # 状態の名前のリスト
         self.state_judge_prompt = state_judge_prompt  # 状態を判断するために使用するプロンプト
         self.llm_client = llm_client                  # 状態を判断するために使用するLLMクライアント
-        self.embedding_pipeline = embedding_pipeline  # テキスト埋め込みのモデル
+        self.embedding_service = embedding_service    # テキスト埋め込みのサービス
+
+        # 状態の埋め込みを取得し、コサイン類似度を内積1回で計算できるよう正規化しておく（形状は(状態数, 次元数)）
+        self.state_embeds = self.normalize(self.embedding_service.embed_cached(self.state_names))
 
-        # 状態の埋め込みを取得
-        # NOTE: pipelineを使っているため、[テキスト番号][データ番号][トークン番号]を指定することで埋め込みが得られる形式で返される
-        self.state_embeds = self.embedding_pipeline(self.state_names, return_tensors=True)
-        self.state_embeds = [embeds[0][0].to('cpu').detach().numpy().copy() for embeds in self.state_embeds]
+    @staticmethod
+    def normalize(embeds: np.ndarray) -> np.ndarray:
+        """埋め込みベクトルを長さ1に正規化する。
+
+        Args:
+            embeds (np.ndarray): 埋め込みベクトルを行として並べた行列。
+
+        Returns:
+            np.ndarray: 各行を長さ1に正規化した、メモリ上で連続したfloat32の行列。
+        """
+        embeds = np.asarray(embeds, dtype=np.float32)
+        norms = np.linalg.norm(embeds, axis=-1, keepdims=True)
+        return np.ascontiguousarray(embeds / np.maximum(norms, np.finfo(np.float32).tiny))
+
+    def classify(self, embeds: np.ndarray, top_k: int = 1) -> list[list[tuple[str, float]]]:
+        """埋め込みベクトルに近い議論の状態を、コサイン類似度の高い順に取得する。
+
+        Args:
+            embeds (np.ndarray): 埋め込みベクトルを行として並べた行列。形状は(テキスト数, 次元数)。
+            top_k (int): 取得する状態の数。
+
+        Returns:
+            list[list[tuple[str, float]]]: テキストごとの、状態名とコサイン類似度の組のリスト（類似度の高い順）。
+        """
+        similarities = self.normalize(embeds) @ self.state_embeds.T  # 形状は(テキスト数, 状態数)
+        top_indices = np.argsort(-similarities, axis=-1, kind='stable')[:, :top_k]
+        top_similarities = np.take_along_axis(similarities, top_indices, axis=-1)
+        return [[(self.state_names[index], float(similarity)) for index, similarity in zip(indices_i, similarities_i)]
+                for indices_i, similarities_i in zip(top_indices, top_similarities)]
 
     async def eval(self, previous_comments: list[str]) -> str:
         """議論の状態を判定する。
 
+        Args:
+            previous_comments (list[str]): これまでの議論ログ。
+
+        Returns:
+            str: 議論の状態名。
+        """
+        ranked_states = await self.eval_top_k(previous_comments, top_k=1)
+        return ranked_states[0][0]
+
+    async def eval_top_k(self, previous_comments: list[str], top_k: int = 1) -> list[tuple[str, float]]:
+        """議論の状態を判定し、類似度の高い順に状態の候補を取得する。
+
         議論の状態は、LLMを使用して自然言語として回答させる。
-        その回答をパイプラインを使用して埋め込みベクトルに変換する。
-        その埋め込みベクトルと、議論の状態名の埋め込みベクトルとで、最も距離が近い状態名を取得する。
-        取得した状態名を返却する。
+        その回答を埋め込みサービスのワーカースレッドで埋め込みベクトルに変換する（イベントループはブロックしない）。
+        その埋め込みベクトルと、議論の状態名の埋め込みベクトルとのコサイン類似度が高い順に、状態名を取得する。
 
         Args:
             previous_comments (list[str]): これまでの議論ログ。
+            top_k (int): 取得する状態の数。
 
         Returns:
-            str: 議論の状態名。
+            list[tuple[str, float]]: 状態名とコサイン類似度の組のリスト（類似度の高い順）。
         """
         # LLMに状態を聞く
         placeholder_map = {
@@ -230,18 +352,14 @@ class DiscussionStateJudge:
             self.llm_client.format_system_message(''),    # システムプロンプトは何も設定しない
             self.llm_client.format_user_message(prompt),  # ユーザプロンプトで命令を設定
         ]
-        response = await self.llm_client.generate(request)  # 回答を作成
+        # 回答を作成（状態の分類なのでtemperatureを0にする。同じ議論ログの判定は生成結果のキャッシュから返却される）
+        response = await self.llm_client.generate(request, temperature=0)
 
         # LLMの回答の埋め込みを取得する
-        response_embed = self.embedding_pipeline([response], return_tensors=True)
-        response_embed = response_embed[0][0][0].to('cpu').detach().numpy().copy()
-
-        # LLMの回答が一番近い状態を取得する
-        distances = np.linalg.norm(self.state_embeds - response_embed)
-        state_name = self.state_names[np.argmin(distances)]
+        response_embeds = await self.embedding_service.aembed([response])
 
-        # 状態の名前を返す
-        return state_name
+        # LLMの回答に近い順に状態を取得する
+        return self.classify(response_embeds, top_k)[0]
 
 
 class DiscussionEvaluator:
@@ -251,21 +369,22 @@ class DiscussionEvaluator:
     議論ログからいくつかの埋め込みベクトルを生成し、それらを利用して議論の展開を点数化する。
     """
 
-    def __init__(self, embedding_pipeline):
+    def __init__(self, embedding_service: EmbeddingService):
         """コンストラクタ。
 
         Args:
-            embedding_pipeline (str): 議論ログを埋め込みべクトルに変換するためのパイプライン。
+            embedding_service (EmbeddingService): 議論ログを埋め込みべクトルに変換するためのサービス。
         """
-        self.embedding_pipeline = embedding_pipeline    # テキスト埋め込みのモデル
+        self.embedding_service = embedding_service    # テキスト埋め込みのサービス
 
-    def eval(self, discussions: list[list[tuple[str, Any] | ChatCompletion | str]]) -> float | list[float]:
+    async def eval(self, discussions: list[list[tuple[str, Any] | ChatCompletion | str]]) -> float | list[float]:
         """議論を評価する。
 
         複数の議論ログを受け取り、それぞれ独立した点数を算出する。
         点数は、基本スコアとペナルティの積として算出する。
         基本スコアは、「議論の一番最後の発言が議論に与えた影響」によって算出される。
         ペナルティは、「議論の一番最後のコメントとその直前のコメントとの遠さ」によって算出される。
+        埋め込みの計算は埋め込みサービスのワーカースレッドで行い、その間イベントループはブロックしない。
 
         - 基本スコアの「議論の一番最後の発言が議論に与えた影響」:
             「議論の一番最後の発言を抜いた議論ログ」と「議論の一番最後のコメントを抜かない議論ログ」の埋め込みベクトル間の距離によって算出される。
@@ -281,26 +400,13 @@ class DiscussionEvaluator:
             float | list[float]: 議論の評価スコア。
         """
         # NOTE: いくつかある議論ログを一気に評価計算できるように実装している
-
-        #### 基本スコアを計算 ####
+        #       最後のコメントを含まない議論ログや最後の一つ前の発言は候補間で共通で、
+        #       最後のコメントを含む議論ログは次のターンの「含まない議論ログ」になるため、埋め込みはキャッシュを使って1回の呼び出しで計算する
 
         # 埋め込み計算のための最後のコメントを含まない/含む議論ログの文字列を取得
         prev_comments_strs = [''.join(discussion_i[:-1]) for discussion_i in discussions]   # 最後のコメントを付け加えるまでの議論ログのリスト
         all_comments_strs = [''.join(discussion_i) for discussion_i in discussions]        # 最後のコメントまですべて含めた議論ログのリスト
 
-        # 埋め込み計算
-        embeds = self.embedding_pipeline([*prev_comments_strs, *all_comments_strs], return_tensors=True)
-        prev_embeds = np.vstack([embed_i[0][0].to('cpu').detach().numpy().copy()
-                                 for embed_i in embeds[:len(prev_comments_strs)]])
-        all_embeds = np.vstack([embed_i[0][0].to('cpu').detach().numpy().copy()
-                                for embed_i in embeds[-len(all_comments_strs):]])
-
-        # スコアを計算
-        n_dims = np.array([embed_i.shape[-1] for embed_i in all_embeds])
-        scores_origin = np.sqrt(np.sum((all_embeds - prev_embeds)**2, axis=-1) / n_dims)
-
-        #### ペナルティスコアを計算 ####
-
         # 埋め込み計算のための「最後の発言」と「最後の一つ前の発言」の文字列を取得
         # NOTE: 議論ログが1件しかない場合は「最後の一つ前の発言」が存在しない
         #       この場合はペナルティがつかないように「最後の発言」と「最後の一つ前の発言」をどちらも空文字で置き換えている
@@ -310,13 +416,19 @@ class DiscussionEvaluator:
                             for discussion_i in discussions]
 
         # 埋め込み計算
-        embeds = self.embedding_pipeline([*last_comment_strs, *new_comment_strs], return_tensors=True)
-        last_embeds = np.vstack([embed_i[0][0].to('cpu').detach().numpy().copy()
-                                 for embed_i in embeds[:len(prev_comments_strs)]])
-        new_embeds = np.vstack([embed_i[0][0].to('cpu').detach().numpy().copy()
-                                for embed_i in embeds[-len(all_comments_strs):]])
+        n_discussions = len(discussions)
+        embeds = await self.embedding_service.aembed_cached(
+            [*prev_comments_strs, *all_comments_strs, *last_comment_strs, *new_comment_strs])
+        prev_embeds, all_embeds, last_embeds, new_embeds = (
+            embeds[i * n_discussions:(i + 1) * n_discussions] for i in range(4))
+
+        #### 基本スコアを計算 ####
+
+        n_dims = np.array([embed_i.shape[-1] for embed_i in all_embeds])
+        scores_origin = np.sqrt(np.sum((all_embeds - prev_embeds)**2, axis=-1) / n_dims)
+
+        #### ペナルティスコアを計算 ####
 
-        # スコアを計算
         n_dims = np.array([embed_i.shape[-1] for embed_i in new_embeds])
         distance = np.sqrt(np.sum((new_embeds - last_embeds)**2, axis=-1) / n_dims)
         penalty = np.exp(-distance)
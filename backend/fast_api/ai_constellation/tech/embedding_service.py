@@ -0,0 +1,664 @@
+"""埋め込みサービスのモジュール。
+
+EmbeddingServiceと、プロセス内で共有するサービスを取得するget_embedding_serviceを定義する。
+get_embedding_serviceは、torch_fp32以外のバックエンドの精度をcheck_embedding_parityで確認する。
+EmbeddingServiceは、埋め込みモデルの推論にSentenceEncoderを使用する。
+また、埋め込みのバックエンドごとの精度と速度を比較するbenchmark_embedding_backendsを定義する。
+モジュールとして実行すると、議論戦略構成ファイルの設定でbenchmark_embedding_backendsを実行する。
+
+    python -m ai_constellation.tech.embedding_service
+"""
+import argparse
+import asyncio
+import collections
+import concurrent.futures
+import hashlib
+import json
+import logging
+import os
+import pathlib
+import shutil
+import tempfile
+import threading
+import time
+import typing
+import numpy as np
+import torch
+import yaml
+from transformers import AutoModel, AutoTokenizer
+
+
+_LOGGER = logging.getLogger(__name__)
+_LOGGER.addHandler(logging.NullHandler())
+
+
+# 1回の推論でまとめて埋め込むテキスト数と、埋め込みのキャッシュのエントリ数の既定値
+DEFAULT_EMBEDDING_BATCH_SIZE = 32
+DEFAULT_EMBEDDING_CACHE_SIZE = 4096
+
+# 埋め込みのバックエンド
+# - torch_fp32: PyTorchの単精度浮動小数点数のモデル（既定）
+# - torch_int8: 線形層の重みを動的に8bit整数へ量子化したPyTorchのモデル（CPUのみ）
+# - onnx: ONNXに変換したモデルをONNX Runtimeで実行する（optimum[onnxruntime]パッケージが必要）
+EmbeddingBackend = typing.Literal['torch_fp32', 'torch_int8', 'onnx']
+EMBEDDING_BACKENDS: tuple[EmbeddingBackend, ...] = typing.get_args(EmbeddingBackend)
+DEFAULT_EMBEDDING_BACKEND: EmbeddingBackend = 'torch_fp32'
+
+# 文埋め込みのプーリング方法
+# - cls: 先頭トークン([CLS])の出力を文の埋め込みとする（既定。SimCSEのモデルはこの方法で学習されている）
+# - mean: パディングを除いた全トークンの出力の平均を文の埋め込みとする
+Pooling = typing.Literal['cls', 'mean']
+POOLINGS: tuple[Pooling, ...] = typing.get_args(Pooling)
+DEFAULT_POOLING: Pooling = 'cls'
+
+# ONNXに変換したモデルを保存するディレクトリの既定値（環境変数EMBEDDING_ONNX_CACHE_DIRで変更可能）
+DEFAULT_EMBEDDING_ONNX_CACHE_DIR = './cache/onnx'
+
+# fp32以外のバックエンドで許容する、torch_fp32との精度の差
+# - コサイン類似度の最小値の下限
+# - テキスト間の類似度の差の最大値の上限（議論状態判断器の判定が入れ替わらない程度）
+EMBEDDING_PARITY_MIN_COSINE = 0.98
+EMBEDDING_PARITY_MAX_SIMILARITY_ERROR = 0.05
+
+
+class SentenceEncoder:
+    """文埋め込みのエンコーダ。
+
+    埋め込みモデルの出力から、文ごとにプーリングした埋め込みベクトルだけを取り出す。
+    推論は勾配を計算せずに行い、トークンごとの出力はデバイス上でプーリングして破棄する（CPUやnumpyには転送しない）。
+    結果は事前に確保したnumpyの配列に直接書き込む。
+
+    テキストは一度だけトークナイズし、トークン数の順に並べてバッチにまとめる。
+    バッチ内のパディングはそのバッチの最長のテキストに合わせるため、長さの異なるテキストが混ざっても無駄な計算が少ない。
+    最大トークン数を超えるテキストは先頭から削る（議論ログの先頭は古い発言のため）。
+    """
+
+    def __init__(self, model: typing.Any, tokenizer: typing.Any, torch_device: str, pooling: Pooling = DEFAULT_POOLING):
+        """コンストラクタ。
+
+        Args:
+            model (Any): 埋め込みモデル。last_hidden_stateを返すもの（PyTorchまたはONNX Runtimeのモデル）。
+            tokenizer (Any): 埋め込みモデルのトークナイザ。
+            torch_device (str): GPU/CPUの設定。
+            pooling (Pooling): プーリング方法。
+
+        Raises:
+            ValueError: プーリング方法が不明な場合。
+        """
+        if pooling not in POOLINGS:
+            raise ValueError(f'unknown pooling: {pooling}')
+        self.device = torch.device(torch_device)
+        self.model = model.to(self.device)
+        self.tokenizer = tokenizer
+        self.tokenizer.truncation_side = 'left'  # 文章長が長い場合、先頭から削る（先頭は古い発言）
+        self.pooling = pooling
+        self.hidden_size = model.config.hidden_size
+
+    def encode(self, texts: list[str], batch_size: int) -> np.ndarray:
+        """テキストを埋め込みベクトルに変換する。
+
+        Args:
+            texts (list[str]): テキストのリスト。
+            batch_size (int): 1回の推論でまとめて埋め込むテキスト数の上限。
+
+        Returns:
+            np.ndarray: 埋め込みベクトルを行として並べたfloat32の行列。形状は(テキスト数, 次元数)。
+        """
+        embeds = np.empty((len(texts), self.hidden_size), dtype=np.float32)
+        if not texts:
+            return embeds
+        encodings = self.tokenizer(texts, truncation=True)['input_ids']
+        order = sorted(range(len(texts)), key=lambda i: len(encodings[i]))
+        with torch.no_grad():
+            for start in range(0, len(order), batch_size):
+                batch = order[start:start + batch_size]
+                inputs = self.tokenizer.pad({'input_ids': [encodings[i] for i in batch]}, return_tensors='pt')
+                inputs = {name: tensor.to(self.device) for name, tensor in inputs.items()}
+                hidden_states = self.model(**inputs).last_hidden_state
+                embeds[batch] = self._pool(hidden_states, inputs['attention_mask']).float().cpu().numpy()
+        return embeds
+
+    def _pool(self, hidden_states: torch.Tensor, attention_mask: torch.Tensor) -> torch.Tensor:
+        """トークンごとの出力をプーリングして、文ごとの埋め込みベクトルにする。
+
+        Args:
+            hidden_states (torch.Tensor): トークンごとの出力。形状は(テキスト数, トークン数, 次元数)。
+            attention_mask (torch.Tensor): パディングでないトークンを1としたマスク。形状は(テキスト数, トークン数)。
+
+        Returns:
+            torch.Tensor: 文ごとの埋め込みベクトル。形状は(テキスト数, 次元数)。
+        """
+        if self.pooling == 'cls':
+            return hidden_states[:, 0]
+        mask = attention_mask.unsqueeze(-1).to(hidden_states.dtype)
+        return (hidden_states * mask).sum(dim=1) / mask.sum(dim=1).clamp(min=1)
+
+
+class EmbeddingService:
+    """埋め込みサービス。
+
+    テキストを埋め込みベクトルに変換する。
+    埋め込みモデルの読み込みは重いため、プロセス内で1度だけ読み込み、すべてのルームの議論戦略構成器で共有する。
+    状態名や、候補間・ターン間で共通する議論ログの接頭部分など、同じテキストの埋め込みはキャッシュして使い回す。
+    キャッシュはテキストのハッシュ値をキーとしたLRUキャッシュで、エントリ数に上限を設ける。
+    埋め込んでいないテキストはSentenceEncoderでトークン数の順に並べてバッチにまとめ、バッチ内のパディングを最小限にして推論する。
+
+    推論のバックエンドは、PyTorch(fp32)、動的量子化したPyTorch(int8)、ONNX Runtimeから選択する。
+    推論はサービス専用のワーカースレッドで1件ずつ実行する。
+    非同期処理からはaembed/aembed_cachedを使用し、推論中もイベントループ（他のルームのWebソケットやHTTPリクエスト）を止めない。
+
+    Attributes:
+        hits (int): キャッシュでヒットした回数。
+        misses (int): ヒットせずに埋め込みを計算した回数。
+    """
+
+    def __init__(
+        self,
+        model_name: str,
+        torch_device: str,
+        batch_size: int = DEFAULT_EMBEDDING_BATCH_SIZE,
+        cache_size: int = DEFAULT_EMBEDDING_CACHE_SIZE,
+        num_threads: int | None = None,
+        backend: EmbeddingBackend = DEFAULT_EMBEDDING_BACKEND,
+        pooling: Pooling = DEFAULT_POOLING
+    ):
+        """コンストラクタ。
+
+        埋め込み用のエンコーダと、推論を実行するワーカースレッドを生成する。
+
+        Args:
+            model_name (str): 埋め込み(Embedding)に使用するモデルの名前。
+            torch_device (str): GPU/CPUの設定。
+            batch_size (int): 1回の推論でまとめて埋め込むテキスト数の上限。
+            cache_size (int): 埋め込みのキャッシュのエントリ数の上限。
+            num_threads (int | None): 推論に使用するPyTorchのスレッド数。Noneの場合はPyTorchの既定値。
+                LLMの応答の受信などで使用するCPUを残すために、コア数より少なくする。
+            backend (EmbeddingBackend): 推論のバックエンド。
+            pooling (Pooling): 文埋め込みのプーリング方法。
+
+        Raises:
+            ValueError: バックエンドやプーリング方法が不明な場合や、バックエンドがデバイスで使用できない場合。
+            ImportError: onnxバックエンドでoptimum[onnxruntime]がインストールされていない場合。
+        """
+        if backend not in EMBEDDING_BACKENDS:
+            raise ValueError(f'unknown embedding backend: {backend}')
+        if backend == 'torch_int8' and torch.device(torch_device).type != 'cpu':
+            raise ValueError(f'torch_int8 embedding backend supports only cpu: torch_device={torch_device}')
+        self.model_name = model_name
+        self.torch_device = torch_device
+        self.backend = backend
+        self.pooling = pooling
+        self.batch_size = batch_size
+        self.cache_size = cache_size
+
+        # 埋め込みモデルの設定（バックエンドに合わせて読み込んだ埋め込みモデル, トークナイザ）
+        self.encoder = SentenceEncoder(
+            model=self._load_model(model_name, backend),
+            tokenizer=AutoTokenizer.from_pretrained(model_name),
+            torch_device=torch_device,
+            pooling=pooling,
+        )
+
+        # テキストのハッシュ値をキーとした埋め込みのLRUキャッシュ
+        self._cache: collections.OrderedDict[str, np.ndarray] = collections.OrderedDict()
+        self._cache_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        # 推論を実行するワーカースレッド（推論は同時に1件だけ実行する）
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1,
+            thread_name_prefix='embedding',
+            initializer=self._init_worker,
+            initargs=(num_threads,),
+        )
+
+    @staticmethod
+    def _load_model(model_name: str, backend: EmbeddingBackend) -> typing.Any:
+        """バックエンドに合わせて埋め込みモデルを読み込む。
+
+        Args:
+            model_name (str): 埋め込み(Embedding)に使用するモデルの名前。
+            backend (EmbeddingBackend): 推論のバックエンド。
+
+        Returns:
+            Any: 埋め込みモデル。
+        """
+        if backend == 'onnx':
+            return EmbeddingService._load_onnx_model(model_name)
+        model = AutoModel.from_pretrained(model_name)
+        model.eval()
+        if backend == 'torch_int8':
+            # 線形層の重みを8bit整数に量子化する（活性化は推論時に動的に量子化される）
+            model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+        return model
+
+    @staticmethod
+    def _load_onnx_model(model_name: str) -> typing.Any:
+        """ONNXに変換した埋め込みモデルを読み込む。
+
+        変換は時間がかかるため、初回のみ変換して環境変数EMBEDDING_ONNX_CACHE_DIRのディレクトリに保存し、
+        以降（他のプロセスを含む）は保存したモデルを読み込む。
+        複数のプロセスが同時に変換した場合に備え、一時ディレクトリに保存してから置き換える（先に置き換えたものを使用する）。
+
+        Args:
+            model_name (str): 埋め込み(Embedding)に使用するモデルの名前。
+
+        Returns:
+            Any: ONNX Runtimeで実行する埋め込みモデル。
+
+        Raises:
+            ImportError: optimum[onnxruntime]がインストールされていない場合。
+        """
+        try:
+            from optimum.onnxruntime import ORTModelForFeatureExtraction  # onnxバックエンドの場合のみ使用
+        except ImportError as e:
+            raise ImportError('onnxバックエンドを使用するにはoptimum[onnxruntime]パッケージをインストールしてください') from e
+
+        cache_dir = pathlib.Path(os.environ.get('EMBEDDING_ONNX_CACHE_DIR', DEFAULT_EMBEDDING_ONNX_CACHE_DIR))
+        export_dir = cache_dir / model_name.replace('/', '--')
+        if export_dir.is_dir():
+            _LOGGER.info(f"embedding onnx model loading from cache: export_dir={export_dir}")
+            return ORTModelForFeatureExtraction.from_pretrained(export_dir)
+
+        _LOGGER.info(f"embedding onnx model exporting: model_name={model_name}, export_dir={export_dir}")
+        model = ORTModelForFeatureExtraction.from_pretrained(model_name, export=True)
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        temp_dir = tempfile.mkdtemp(prefix=f'.{export_dir.name}.', dir=cache_dir)
+        try:
+            model.save_pretrained(temp_dir)
+            os.replace(temp_dir, export_dir)
+        except OSError:
+            # 他のプロセスが先に保存した場合など。変換したモデルはそのまま使用する
+            _LOGGER.warning(f"embedding onnx model not cached: export_dir={export_dir}", exc_info=True)
+            shutil.rmtree(temp_dir, ignore_errors=True)
+        return model
+
+    @staticmethod
+    def _init_worker(num_threads: int | None):
+        """ワーカースレッドの初期化。PyTorchのスレッド数を設定する。
+
+        Args:
+            num_threads (int | None): 推論に使用するPyTorchのスレッド数。Noneの場合は設定しない。
+        """
+        if num_threads is not None:
+            torch.set_num_threads(num_threads)
+
+    def embed(self, texts: list[str]) -> np.ndarray:
+        """テキストを埋め込みベクトルに変換する。推論が終わるまで呼び出し元をブロックする。
+
+        イベントループ上ではaembedを使用する。
+
+        Args:
+            texts (list[str]): テキストのリスト。
+
+        Returns:
+            np.ndarray: 埋め込みベクトルを行として並べた行列。形状は(テキスト数, 次元数)。
+        """
+        return self._executor.submit(self._embed, texts).result()
+
+    async def aembed(self, texts: list[str]) -> np.ndarray:
+        """テキストを埋め込みベクトルに変換する。推論はワーカースレッドで実行し、その間イベントループをブロックしない。
+
+        Args:
+            texts (list[str]): テキストのリスト。
+
+        Returns:
+            np.ndarray: 埋め込みベクトルを行として並べた行列。形状は(テキスト数, 次元数)。
+        """
+        return await asyncio.wrap_future(self._executor.submit(self._embed, texts))
+
+    def _embed(self, texts: list[str]) -> np.ndarray:
+        """ワーカースレッドでテキストを埋め込みベクトルに変換する。
+
+        Args:
+            texts (list[str]): テキストのリスト。
+
+        Returns:
+            np.ndarray: 埋め込みベクトルを行として並べた行列。形状は(テキスト数, 次元数)。
+        """
+        return self.encoder.encode(texts, self.batch_size)
+
+    def embed_cached(self, texts: list[str]) -> np.ndarray:
+        """テキストを埋め込みベクトルに変換する。変換結果はキャッシュする。推論が終わるまで呼び出し元をブロックする。
+
+        状態名や議論ログなど、何度も同じテキストを変換する場合に使用する。
+        キャッシュにないテキストだけを重複を除いてまとめて埋め込む。
+        イベントループ上ではaembed_cachedを使用する。
+
+        Args:
+            texts (list[str]): テキストのリスト。
+
+        Returns:
+            np.ndarray: 埋め込みベクトルを行として並べた行列。形状は(テキスト数, 次元数)。
+        """
+        keys, found, missing = self._lookup(texts)
+        if missing:
+            self._store(found, missing, self.embed(list(missing.values())))
+        return np.vstack([found[key] for key in keys])
+
+    async def aembed_cached(self, texts: list[str]) -> np.ndarray:
+        """テキストを埋め込みベクトルに変換する。変換結果はキャッシュする。推論中はイベントループをブロックしない。
+
+        Args:
+            texts (list[str]): テキストのリスト。
+
+        Returns:
+            np.ndarray: 埋め込みベクトルを行として並べた行列。形状は(テキスト数, 次元数)。
+        """
+        keys, found, missing = self._lookup(texts)
+        if missing:
+            self._store(found, missing, await self.aembed(list(missing.values())))
+        return np.vstack([found[key] for key in keys])
+
+    def _lookup(self, texts: list[str]) -> tuple[list[str], dict[str, np.ndarray], dict[str, str]]:
+        """テキストの埋め込みをキャッシュから探す。
+
+        Args:
+            texts (list[str]): テキストのリスト。
+
+        Returns:
+            tuple[list[str], dict[str, np.ndarray], dict[str, str]]:
+                テキストごとのキーのリスト、キャッシュで見つかった埋め込み、見つからなかったテキスト（重複なし）。
+        """
+        keys = [self.make_key(text) for text in texts]
+        found: dict[str, np.ndarray] = {}
+        missing: dict[str, str] = {}
+        with self._cache_lock:
+            for key, text in zip(keys, texts):
+                if key in found or key in missing:
+                    continue
+                embed = self._cache.get(key)
+                if embed is None:
+                    missing[key] = text
+                else:
+                    self._cache.move_to_end(key)
+                    found[key] = embed
+            self.hits += len(texts) - len(missing)
+            self.misses += len(missing)
+        return keys, found, missing
+
+    def _store(self, found: dict[str, np.ndarray], missing: dict[str, str], embeds: np.ndarray):
+        """計算した埋め込みをキャッシュに保存する。
+
+        Args:
+            found (dict[str, np.ndarray]): キャッシュのキーをキーとした埋め込み。計算した埋め込みを追加する。
+            missing (dict[str, str]): 埋め込みを計算したテキスト。
+            embeds (np.ndarray): missingの順に並んだ埋め込み。
+        """
+        found.update(zip(missing.keys(), embeds))
+        with self._cache_lock:
+            for key in missing:
+                self._cache[key] = found[key]
+                self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    @staticmethod
+    def make_key(text: str) -> str:
+        """テキストからキャッシュのキーを作成する。
+
+        議論ログのような長いテキストをそのまま保持しないよう、ハッシュ値をキーとする。
+
+        Args:
+            text (str): テキスト。
+
+        Returns:
+            str: キャッシュのキー(SHA-256の16進数文字列)。
+        """
+        return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+    def close(self):
+        """推論を実行するワーカースレッドを終了する。"""
+        self._executor.shutdown(wait=True)
+
+    def stats(self) -> dict[str, int | float]:
+        """キャッシュの利用状況を取得する。
+
+        Returns:
+            dict[str, int | float]: ヒット数、ミス数、ヒット率、キャッシュのエントリ数。
+        """
+        with self._cache_lock:
+            total = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / total if total > 0 else 0.0,
+                'entries': len(self._cache),
+            }
+
+
+# プロセス内で共有するサービス（キーはモデル名、デバイス、バックエンド、プーリング方法の組）
+_EMBEDDING_SERVICES: dict[tuple[str, str, EmbeddingBackend, Pooling], EmbeddingService] = {}
+_EMBEDDING_SERVICES_LOCK = threading.Lock()
+
+
+def get_embedding_service(
+    model_name: str,
+    torch_device: str,
+    batch_size: int = DEFAULT_EMBEDDING_BATCH_SIZE,
+    cache_size: int = DEFAULT_EMBEDDING_CACHE_SIZE,
+    num_threads: int | None = None,
+    backend: EmbeddingBackend = DEFAULT_EMBEDDING_BACKEND,
+    pooling: Pooling = DEFAULT_POOLING,
+    parity_texts: list[str] | None = None
+) -> EmbeddingService:
+    """プロセス内で共有する埋め込みサービスを取得する。
+
+    初回呼び出し時に埋め込みモデルを読み込む。
+    batch_size、cache_size、num_threadsは初回呼び出し時の値を使用する。
+    torch_fp32以外のバックエンドでは、初回呼び出し時にparity_textsでtorch_fp32との精度の差を確認する（check_embedding_parityを参照）。
+
+    Args:
+        model_name (str): 埋め込み(Embedding)に使用するモデルの名前。
+        torch_device (str): GPU/CPUの設定。
+        batch_size (int): 1回の推論でまとめて埋め込むテキスト数の上限。
+        cache_size (int): 埋め込みのキャッシュのエントリ数の上限。
+        num_threads (int | None): 推論に使用するPyTorchのスレッド数。Noneの場合はPyTorchの既定値。
+        backend (EmbeddingBackend): 推論のバックエンド。
+        pooling (Pooling): 文埋め込みのプーリング方法。
+        parity_texts (list[str] | None): 精度の差の確認に使用するテキストのリスト。Noneまたは空の場合は確認しない。
+
+    Returns:
+        EmbeddingService: 埋め込みサービス。
+
+    Raises:
+        ValueError: torch_fp32との精度の差が許容範囲を超える場合。
+    """
+    key = (model_name, torch_device, backend, pooling)
+    with _EMBEDDING_SERVICES_LOCK:
+        if key not in _EMBEDDING_SERVICES:
+            _LOGGER.info(f"embedding model loading: model_name={model_name}, torch_device={torch_device}, "
+                         f"backend={backend}, pooling={pooling}")
+            service = EmbeddingService(model_name, torch_device, batch_size, cache_size, num_threads, backend, pooling)
+            if backend != 'torch_fp32' and parity_texts:
+                # 共有しているtorch_fp32のサービスがあれば基準に使用し、なければ確認の間だけ読み込む
+                reference = _EMBEDDING_SERVICES.get((model_name, torch_device, 'torch_fp32', pooling))
+                try:
+                    check_embedding_parity(service, parity_texts, reference)
+                except ValueError:
+                    service.close()
+                    raise
+            _EMBEDDING_SERVICES[key] = service
+        return _EMBEDDING_SERVICES[key]
+
+
+def compare_embeddings(embeds: np.ndarray, reference: np.ndarray) -> dict[str, float]:
+    """同じテキストに対する埋め込みを、基準の埋め込みと比較する。
+
+    Args:
+        embeds (np.ndarray): 比較する埋め込み。
+        reference (np.ndarray): 基準の埋め込み。
+
+    Returns:
+        dict[str, float]: min_cosine(基準とのコサイン類似度の最小値)、mean_cosine(同平均値)、
+            max_similarity_error(テキスト間の類似度の基準との差の最大値)。
+    """
+    def similarities(embeds: np.ndarray) -> np.ndarray:
+        normalized = embeds / np.linalg.norm(embeds, axis=-1, keepdims=True)
+        return normalized @ normalized.T
+
+    cosines = np.sum(embeds * reference, axis=-1) / (
+        np.linalg.norm(embeds, axis=-1) * np.linalg.norm(reference, axis=-1))
+    return {
+        'min_cosine': float(np.min(cosines)),
+        'mean_cosine': float(np.mean(cosines)),
+        'max_similarity_error': float(np.max(np.abs(similarities(embeds) - similarities(reference)))),
+    }
+
+
+def check_embedding_parity(
+    service: EmbeddingService,
+    texts: list[str],
+    reference: EmbeddingService | None = None
+) -> dict[str, float]:
+    """埋め込みサービスの精度が、torch_fp32と比べて許容範囲内かを確認する。
+
+    同じテキストに対するtorch_fp32の埋め込みとのコサイン類似度と、テキスト間の類似度の差を比較する
+    （EMBEDDING_PARITY_MIN_COSINE、EMBEDDING_PARITY_MAX_SIMILARITY_ERRORを参照）。
+
+    Args:
+        service (EmbeddingService): 確認する埋め込みサービス。
+        texts (list[str]): 確認に使用するテキストのリスト。
+        reference (EmbeddingService | None): 基準とするtorch_fp32の埋め込みサービス。Noneの場合は確認の間だけ読み込む。
+
+    Returns:
+        dict[str, float]: 比較結果（compare_embeddingsを参照）。
+
+    Raises:
+        ValueError: 精度の差が許容範囲を超える場合。
+    """
+    if reference is None:
+        reference_service = EmbeddingService(service.model_name, service.torch_device,
+                                             backend='torch_fp32', pooling=service.pooling)
+        try:
+            reference_embeds = reference_service.embed(texts)
+        finally:
+            reference_service.close()
+    else:
+        reference_embeds = reference.embed_cached(texts)
+    result = compare_embeddings(service.embed(texts), reference_embeds)
+    _LOGGER.info(f"embedding parity: backend={service.backend}, {result}")
+    if result['min_cosine'] < EMBEDDING_PARITY_MIN_COSINE \
+            or result['max_similarity_error'] > EMBEDDING_PARITY_MAX_SIMILARITY_ERROR:
+        raise ValueError(f'embedding backend {service.backend} diverges from torch_fp32: {result}')
+    return result
+
+
+def get_embedding_stats() -> dict[str, dict[str, int | float]]:
+    """プロセス内で共有する埋め込みサービスごとのキャッシュの利用状況を取得する。
+
+    埋め込みサービスは議論戦略構成器を初めて使用した時に生成されるため、それまでは空の辞書を返す。
+
+    Returns:
+        dict[str, dict[str, int | float]]: `<モデル名>@<デバイス>/<バックエンド>/<プーリング方法>`をキーとした、キャッシュの利用状況。
+    """
+    with _EMBEDDING_SERVICES_LOCK:
+        services = dict(_EMBEDDING_SERVICES)
+    return {f'{model_name}@{torch_device}/{backend}/{pooling}': service.stats()
+            for (model_name, torch_device, backend, pooling), service in services.items()}
+
+
+def benchmark_embedding_backends(
+    model_name: str,
+    torch_device: str,
+    texts: list[str],
+    backends: typing.Iterable[EmbeddingBackend] = EMBEDDING_BACKENDS,
+    repeats: int = 5,
+    num_threads: int | None = None,
+    pooling: Pooling = DEFAULT_POOLING
+) -> dict[str, dict[str, float | str]]:
+    """埋め込みのバックエンドごとに、fp32との精度の差と推論速度を計測する。
+
+    精度は、同じテキストに対するtorch_fp32の埋め込みとのコサイン類似度で比較する。
+    また、議論状態判断器や議論評価器と同じくテキスト間の類似度を計算し、その値のtorch_fp32との差の最大値を求める。
+    推論速度は、キャッシュを使わずにtextsをrepeats回埋め込んだ時間の中央値で計測する（最初の1回は計測に含めない）。
+    使用できないバックエンド（パッケージがインストールされていないなど）は、エラー内容を記録して次に進む。
+
+    Args:
+        model_name (str): 埋め込み(Embedding)に使用するモデルの名前。
+        torch_device (str): GPU/CPUの設定。
+        texts (list[str]): 計測に使用するテキストのリスト。
+        backends (Iterable[EmbeddingBackend]): 計測するバックエンド。
+        repeats (int): 計測の繰り返し回数。
+        num_threads (int | None): 推論に使用するPyTorchのスレッド数。Noneの場合はPyTorchの既定値。
+        pooling (Pooling): 文埋め込みのプーリング方法。
+
+    Returns:
+        dict[str, dict[str, float | str]]: バックエンドをキーとした計測結果。
+            load_seconds(読み込み秒数)、median_seconds(推論秒数の中央値)、texts_per_second(1秒あたりのテキスト数)、
+            min_cosine(fp32とのコサイン類似度の最小値)、mean_cosine(同平均値)、max_similarity_error(テキスト間の類似度の差の最大値)。
+            使用できなかったバックエンドはerror(エラー内容)のみ。
+    """
+    results: dict[str, dict[str, float | str]] = {}
+    reference: np.ndarray | None = None
+    for backend in dict.fromkeys(['torch_fp32', *backends]):  # 比較の基準とするため、torch_fp32を最初に計測する
+        service = None
+        try:
+            started_at = time.perf_counter()
+            service = EmbeddingService(model_name, torch_device, num_threads=num_threads,
+                                       backend=backend, pooling=pooling)
+            load_seconds = time.perf_counter() - started_at
+            embeds = service.embed(texts)  # 初回は計測しない（ウォームアップ）
+            elapsed = []
+            for _ in range(repeats):
+                started_at = time.perf_counter()
+                service.embed(texts)
+                elapsed.append(time.perf_counter() - started_at)
+        except Exception as e:
+            _LOGGER.warning(f"embedding backend benchmark failed: backend={backend}", exc_info=True)
+            results[backend] = {'error': repr(e)}
+            continue
+        finally:
+            if service is not None:
+                service.close()
+        if reference is None:
+            reference = embeds
+        median_seconds = float(np.median(elapsed))
+        results[backend] = {
+            'load_seconds': load_seconds,
+            'median_seconds': median_seconds,
+            'texts_per_second': len(texts) / median_seconds if median_seconds > 0 else float('inf'),
+            **compare_embeddings(embeds, reference),
+        }
+    return results
+
+
+def main():
+    """議論戦略構成ファイルの設定で、埋め込みのバックエンドごとの精度と速度を計測し、結果をJSONで出力する。
+
+    計測に使用するテキストは、議論戦略構成ファイルの議論状態名と末尾プロンプト、およびそれらを連結した長いテキストとする。
+    --textsでテキストファイル（1行1テキスト）を指定した場合は、そのテキストを使用する。
+    """
+    parser = argparse.ArgumentParser(description='埋め込みのバックエンドごとの精度と速度を計測する。')
+    parser.add_argument('--config', default='./ai_constellation/tech/strategist_config.yml',
+                        help='議論戦略構成ファイルまでのパス。')
+    parser.add_argument('--texts', default=None, help='計測に使用するテキストファイル（1行1テキスト）までのパス。')
+    parser.add_argument('--backends', nargs='+', default=list(EMBEDDING_BACKENDS), choices=EMBEDDING_BACKENDS,
+                        help='計測するバックエンド。')
+    parser.add_argument('--repeats', type=int, default=5, help='計測の繰り返し回数。')
+    args = parser.parse_args()
+
+    with open(args.config, 'r', encoding='utf-8') as fp:
+        config = yaml.safe_load(fp)
+    if args.texts is not None:
+        with open(args.texts, 'r', encoding='utf-8') as fp:
+            texts = [line.rstrip('\n') for line in fp if line.strip()]
+    else:
+        texts = [*config.get('state_names', []), *config['tail_prompts']]
+        texts += [''.join(texts[:i + 1]) for i in range(len(texts))]  # 議論ログのように長くなるテキスト
+    results = benchmark_embedding_backends(
+        model_name=config['embedding_model_name'],
+        torch_device=config['torch_device'],
+        texts=texts,
+        backends=args.backends,
+        repeats=args.repeats,
+        num_threads=config.get('embedding_num_threads'),
+        pooling=config.get('embedding_pooling', DEFAULT_POOLING),
+    )
+    print(json.dumps(results, indent=4, ensure_ascii=False))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    main()
@@ -0,0 +1,125 @@
+import asyncio
+import logging
+from typing import Callable
+from fastapi import WebSocket
+
+
+# ロガー
+_LOGGER = logging.getLogger(__name__)
+_LOGGER.addHandler(logging.NullHandler())
+
+
+# 送信キューに溜められるフレーム数の上限
+DEFAULT_MAX_QUEUE_SIZE = 64
+# 1フレームの送信にかけられる秒数の上限（超えた場合は切断）
+DEFAULT_SEND_TIMEOUT = 10.0
+# 送信キューが溢れた時にスナップショットで再同期する回数の上限（超えた場合は切断）
+DEFAULT_MAX_RESYNCS = 3
+
+
+class ClientChannel:
+    """Webソケット1接続分の送信チャネル。
+
+    接続ごとに上限付きの送信キューと送信専用タスクを持ち、ブロードキャストはキューに積むだけで待たない。
+    そのため、送信の遅いクライアントがいても、他のクライアントへの送信は遅れない。
+
+    送信の遅いクライアントは以下のように扱う。
+      - 送信キューが溢れた場合: キューを破棄し、スナップショットを積み直して再同期する。
+      - 再同期の回数が上限を超えた場合、または1フレームの送信が時間内に終わらない場合: 切断する。
+    """
+
+    def __init__(
+        self,
+        websocket: WebSocket,
+        get_snapshot_text: Callable[[], str],
+        on_closed: Callable[[WebSocket], None],
+        max_queue_size: int = DEFAULT_MAX_QUEUE_SIZE,
+        send_timeout: float = DEFAULT_SEND_TIMEOUT,
+        max_resyncs: int = DEFAULT_MAX_RESYNCS,
+    ):
+        """コンストラクタ。
+
+        Args:
+            websocket (WebSocket): Webソケットのインスタンス。
+            get_snapshot_text (Callable[[], str]): 再同期に使うスナップショットのJSON文字列を作成する関数。
+            on_closed (Callable[[WebSocket], None]): チャネルが閉じた時に呼ばれる関数。
+            max_queue_size (int): 送信キューに溜められるフレーム数の上限。
+            send_timeout (float): 1フレームの送信にかけられる秒数の上限。
+            max_resyncs (int): 送信キューが溢れた時にスナップショットで再同期する回数の上限。
+        """
+        self.websocket = websocket
+        self.get_snapshot_text = get_snapshot_text
+        self.on_closed = on_closed
+        self.send_timeout = send_timeout
+        self.max_resyncs = max_resyncs
+        self.num_resyncs = 0
+        self.queue: asyncio.Queue[str] = asyncio.Queue(maxsize=max_queue_size)
+        self.sender_task: asyncio.Task | None = None
+        self.close_task: asyncio.Task | None = None  # 送信キューが溢れて切断する時のタスク（実行前に破棄されないよう保持する）
+        self.is_closed = False
+
+    def start(self):
+        """送信専用タスクを開始する。"""
+        self.sender_task = asyncio.create_task(self._send_loop())
+
+    def send(self, text: str):
+        """フレームを送信キューに積む。
+
+        送信キューが溢れた場合は、キューを破棄してスナップショットを積み直す。
+        再同期の回数が上限を超えた場合は切断する。
+
+        Args:
+            text (str): 送信するフレームのJSON文字列。
+        """
+        if self.is_closed:
+            return
+        try:
+            self.queue.put_nowait(text)
+        except asyncio.QueueFull:
+            self.num_resyncs += 1
+            if self.num_resyncs > self.max_resyncs:
+                _LOGGER.warning(f"client dropped: too many resyncs. client={self.websocket.client}")
+                # 以降のフレームを積まないよう先に閉じた状態にし、Webソケットの切断はタスクで行う
+                self.stop()
+                self.close_task = asyncio.create_task(self._close_websocket())
+                return
+            _LOGGER.warning(f"client resynced by snapshot: send queue overflowed. client={self.websocket.client}")
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait(self.get_snapshot_text())
+
+    async def _send_loop(self):
+        """送信キューのフレームを順に送信する。送信に失敗したら切断する。"""
+        try:
+            while True:
+                text = await self.queue.get()
+                await asyncio.wait_for(self.websocket.send_text(text), self.send_timeout)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            _LOGGER.warning(f"client dropped: send failed. client={self.websocket.client}", exc_info=True)
+            await self.close()
+
+    def stop(self):
+        """送信専用タスクを止める。Webソケットはすでに切断されている前提で閉じない。"""
+        self.is_closed = True
+        if self.sender_task is not None and self.sender_task is not asyncio.current_task():
+            self.sender_task.cancel()
+
+    async def close(self):
+        """チャネルを閉じる。
+
+        送信専用タスクを止め、Webソケットを閉じ、on_closedを呼び出す。
+        """
+        if self.is_closed:
+            return
+        self.stop()
+        await self._close_websocket()
+
+    async def _close_websocket(self):
+        """Webソケットを閉じ、on_closedを呼び出す。送信専用タスクは止めてある前提。"""
+        try:
+            await self.websocket.close()
+        except Exception:
+            pass  # すでに切断されている場合は何もしない
+        self.on_closed(self.websocket)
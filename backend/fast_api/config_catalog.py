@@ -0,0 +1,182 @@
+import copy
+import hashlib
+import logging
+import os
+import pathlib
+import threading
+import typing
+import yaml
+from ai_constellation.common.utils import json_dumps
+
+
+# ロガー
+_LOGGER = logging.getLogger(__name__)
+_LOGGER.addHandler(logging.NullHandler())
+
+
+class CatalogResponse(typing.NamedTuple):
+    """設定ファイルカタログが返却するレスポンス。
+
+    Attributes:
+        body (bytes): レスポンスボディ(JSON)。
+        etag (str): レスポンスボディのETag。
+    """
+    body: bytes
+    etag: str
+
+
+class ConfigCatalog:
+    """設定ファイルカタログ。
+
+    設定ディレクトリ内の議論設定ファイルと議題一覧ファイルを、ファイルごとに1度だけ解析して保持する。
+    ファイルの更新日時が変わった場合は、次回の参照時に解析し直す。
+    設定ファイル一覧や議題一覧のレスポンスは、元になったファイルの更新日時が変わらない限り、作成済みのJSONとETagを使い回す。
+    """
+
+    def __init__(self, config_dir: str):
+        """コンストラクタ。
+
+        Args:
+            config_dir (str): 設定ファイルのディレクトリ。
+        """
+        self.config_dir = pathlib.Path(config_dir)
+        self._lock = threading.Lock()
+        self._files: dict[pathlib.Path, tuple[float, typing.Any]] = {}  # ファイルパスをキーとした、更新日時と解析結果
+        self._responses: dict[str, tuple[tuple, CatalogResponse]] = {}  # レスポンス名をキーとした、元ファイルの状態とレスポンス
+
+    def load(self, path: pathlib.Path) -> typing.Any:
+        """YAMLファイルの解析結果を取得する。
+
+        解析結果は共有しているため、呼び出し元で変更してはならない。変更する場合はload_configを使用する。
+
+        Args:
+            path (pathlib.Path): YAMLファイルまでのパス。
+
+        Returns:
+            Any: 解析結果。
+        """
+        mtime = os.path.getmtime(path)
+        with self._lock:
+            cached = self._files.get(path)
+            if cached is not None and cached[0] == mtime:
+                return cached[1]
+        with path.open('r', encoding='utf-8') as f:
+            content = yaml.load(f, Loader=yaml.SafeLoader)
+        with self._lock:
+            self._files[path] = (mtime, content)
+        _LOGGER.info(f"config file loaded: {path}")
+        return content
+
+    def load_config(self, config_file: str) -> dict:
+        """議論設定ファイルの内容を、呼び出し元で変更できるように複製して取得する。
+
+        Args:
+            config_file (str): 議論設定ファイル名。
+
+        Returns:
+            dict: 議論設定ファイルの内容。
+        """
+        return copy.deepcopy(self.load(self.config_dir / config_file))
+
+    def get_config_list(self) -> CatalogResponse:
+        """設定ファイルとそのパネリストの一覧のレスポンスを取得する。
+
+        Returns:
+            CatalogResponse: 設定ファイルとパネリストの一覧のレスポンス。
+        """
+        config_ja_paths = sorted(self.config_dir.glob('*_ja.yml'))
+        source_paths = []
+        for path in config_ja_paths:
+            prefix = path.stem[:-3]  # "_ja"を取り除く
+            source_paths.extend([path, self.config_dir / f'{prefix}_en.yml'])
+        return self._get_response('config_list', source_paths, lambda: self._build_config_list(config_ja_paths))
+
+    def get_agenda(self, agenda_file: str) -> CatalogResponse | None:
+        """議題一覧ファイルの内容のレスポンスを取得する。
+
+        Args:
+            agenda_file (str): 議題一覧ファイル名。
+
+        Returns:
+            CatalogResponse | None: 議題一覧のレスポンス。ファイルが存在しない場合はNone。
+        """
+        path = self.config_dir / agenda_file
+        if not path.exists():
+            return None
+        return self._get_response(f'agenda/{agenda_file}', [path], lambda: self.load(path))
+
+    def _get_response(
+        self,
+        name: str,
+        source_paths: list[pathlib.Path],
+        build: typing.Callable[[], typing.Any]
+    ) -> CatalogResponse:
+        """元ファイルが変わっていなければ作成済みのレスポンスを、変わっていれば作り直したレスポンスを取得する。
+
+        Args:
+            name (str): レスポンス名。
+            source_paths (list[pathlib.Path]): レスポンスの元になるファイルのパスのリスト。
+            build (Callable[[], Any]): レスポンスの内容を作成する関数。
+
+        Returns:
+            CatalogResponse: レスポンス。
+        """
+        state = tuple((str(path), os.path.getmtime(path)) for path in source_paths)
+        with self._lock:
+            cached = self._responses.get(name)
+            if cached is not None and cached[0] == state:
+                return cached[1]
+        body = json_dumps(build()).encode('utf-8')
+        response = CatalogResponse(body=body, etag=f'"{hashlib.sha256(body).hexdigest()[:32]}"')
+        with self._lock:
+            self._responses[name] = (state, response)
+        return response
+
+    def _build_config_list(self, config_ja_paths: list[pathlib.Path]) -> list:
+        """設定ファイルとそのパネリストの一覧を作成する。
+
+        フロントエンドで設定ファイルを確認するために用いる。
+        パネリストのみ表示するため、それ以外の設定値は含めない。
+
+        Args:
+            config_ja_paths (list[pathlib.Path]): 日本語の議論設定ファイルのパスのリスト。
+
+        Returns:
+            list: 設定ファイルとパネリストの一覧。
+        """
+        # 設定ファイルの形式に沿ったオブジェクトを作成
+        config_list = []
+        for idx, path in enumerate(config_ja_paths):
+            prefix = path.stem[:-3]  # "_ja"を取り除く
+
+            # pathの設定値をまとめたconfigを構成するために初期化
+            config = {}
+            config['id'] = idx + 1
+            config['file'] = {
+                'ja': f'{prefix}_ja.yml',
+                'en': f'{prefix}_en.yml',
+            }
+            config['label'] = {'ja': '', 'en': ''}
+            config['panelist_names'] = {'ja': list(), 'en': list()}
+            config['panelist_images'] = {'ja': dict(), 'en': dict()}
+
+            # 議論設定ファイルを読み込み、パネリスト情報を取得
+            for lang in ['ja', 'en']:
+                # 元データ読み込み
+                config_origin = self.load(self.config_dir / f'{prefix}_{lang}.yml')
+
+                # 'label'の読み込み
+                config['label'][lang] = config_origin['label']
+
+                # 'user'の読み込み
+                user = config_origin['user']
+                config['panelist_names'][lang].append(user['name'])
+                config['panelist_images'][lang].update({user['name']: user['image']})
+
+                # 'panelists'の読み込み
+                panelists = config_origin['panelists']
+                config['panelist_names'][lang].extend([e['name'] for e in panelists])
+                config['panelist_images'][lang].update({e['name']: e['image'] for e in panelists})
+
+            config_list.append(config)
+        return config_list
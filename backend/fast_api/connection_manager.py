@@ -4,11 +4,17 @@ import pathlib
 import dataclasses
 import logging
 import os
+import time
 from datetime import datetime, timedelta
-from typing import Literal, Tuple
+from typing import Callable, Coroutine, Literal, Tuple, TypeVar
 from fastapi import WebSocket
-from ai_constellation.simulator.facilitator import Facilitator
-from ai_constellation.common.utils import Mappable
+from client_channel import ClientChannel
+from room_store import BaseRoomStore
+from pubsub import BasePubSub, room_channel, encode_event
+from discussion_cache import CachedComment, get_discussion_cache, make_cache_key
+from ai_constellation.simulator.facilitator import Facilitator, DEFAULT_LOOKAHEAD, STRATEGIST_CONFIG_PATH
+from ai_constellation.llm_clients.client_registry import get_client_registry
+from ai_constellation.common.utils import Mappable, transient_field, json_dumps
 
 
 # ロガー
@@ -16,6 +22,13 @@ _LOGGER = logging.getLogger(__name__)
 _LOGGER.addHandler(logging.NullHandler())
 
 
+# ルームストアの読み書きの戻り値の型
+T = TypeVar('T')
+
+# 再接続時に差分だけを送信する、取りこぼしたメッセージ数の上限（これより多い場合はスナップショットを送信）
+MAX_RESYNC_GAP = 100
+
+
 # メッセージ種別
 MessageType = Literal[
     "message",
@@ -38,6 +51,7 @@ class Message(Mappable):
         time (str | None): 作成時間。タイムスタンプと同じ日時で時間を`%H:%M`形式で格納する。
         user_img (str | None): メッセージ作成者の画像。画像までのパスが格納されている。
         handover_datum (dict | None): 引継ぎデータ。クライアント間で受け渡される任意のデータ。
+        seq (int | None): シーケンス番号。メッセージDB内の順番(0始まり)。
     """
     type: MessageType | None = None
     user_name: str | None = None
@@ -46,6 +60,27 @@ class Message(Mappable):
     time: str | None = None
     user_img: str | None = None
     handover_datum: dict | None = None
+    seq: int | None = None
+    _json: str | None = transient_field(default=None)
+
+    def freeze(self):
+        """メッセージを確定し、JSON文字列をキャッシュする。
+
+        メッセージDBに追加されたメッセージは以降変更されないため、JSON文字列は1度だけ作成すれば良い。
+        """
+        self._json = json_dumps(self.to_dict())
+
+    def to_json(self) -> str:
+        """メッセージをJSON文字列にダンプする。
+
+        確定済みのメッセージであれば、キャッシュしたJSON文字列を返却する。
+
+        Returns:
+            str: JSON文字列。
+        """
+        if self._json is not None:
+            return self._json
+        return json_dumps(self.to_dict())
 
 
 class ConnectionManager:
@@ -63,21 +98,156 @@ class ConnectionManager:
     実装内容
       実装要件(1): 議論開始と議論継続はHTTPリクエストで受け取る。
       実装要件(2): 閲覧者はwebsocketで接続する。
-      実装要件(3): wsで新規接続したり、閲覧可能なメッセージ一覧が更新されるたびに、閲覧可能なメッセージの全データをブロードキャスト。
+      実装要件(3): wsで新規接続した時は、閲覧可能なメッセージの全データ（スナップショット）を送信。
+        閲覧可能なメッセージ一覧が更新されるたびに、新しく閲覧可能になったメッセージ（差分）だけをブロードキャスト。
+        メッセージにはシーケンス番号を振り、メッセージDBをリセットするたびに世代番号(epoch)を変える。
+        再接続時にクライアントが世代番号と最後に受け取ったシーケンス番号を送ってきた場合は、取りこぼした差分だけを送信する。
       実装要件(4): 閲覧できないデータのDB（self.messages）と閲覧できるデータのDB（self.accessible_messages）に分けてDBを作る。
         add_accessible_message関数を「次へ（Next）」に紐づける。
+
+    議論はルームごとに1つのタスク（self.discussion_task）として実行する。
+    停止やルームの削除ではこのタスクをキャンセルし、実行中のLLMへのリクエストや応答候補の並行生成も合わせてキャンセルする。
+
+    ストリーミングを有効にした議論では、生成中の発言（self.streaming_message）の差分をストリームフレームとしてブロードキャストする。
+    ただし、閲覧者がすべてのメッセージを閲覧済みで、生成中の発言が次に閲覧可能になる発言である場合に限る。
+    生成が終わった発言は通常通りメッセージDBに追加され、「次へ（Next）」で閲覧可能になる。
+
+    ルームストアが与えられた場合、メッセージDBをルームストアに永続化する。
+    メッセージの追加は追記、閲覧可能なメッセージの追加はインデックスの更新として書き込む。
+    生成時にはルームストアからメッセージDBを復元する。
+    生成後のルームストアの読み書きは、イベントループを止めないようにasyncio.to_threadで別スレッドで行う。
+    読み書きの間に他のコルーチンがメッセージDBを変更しないよう、メッセージDBの変更とルームストアの読み書きはself._store_lockで直列化する。
+
+    Pub/Subが与えられた場合、ブロードキャストはPub/Subにイベントとして発行し、購読側（RoomManager）からdeliver_frameで各接続に送信する。
+    複数ワーカー構成（共有のPub/Sub）では、議論を実行するワーカーと「次へ（Next）」や接続を受け付けるワーカーが異なりうるため、
+    ルームストアを正として、メッセージDBを参照する前にsync_message_dbで他のワーカーの更新を取り込む。
     """
 
     ######## 初期化 ###############################################################
 
-    def __init__(self):
+    def __init__(
+        self,
+        room_id: int | None = None,
+        room_store: BaseRoomStore | None = None,
+        pubsub: BasePubSub | None = None
+    ):
         """コンストラクタ。
 
         接続相手やDBを初期化する。
+        ルームストアにメッセージDBが保存されている場合は、それを復元する。
+
+        Args:
+            room_id (int | None): ルームID。ルームストアの読み書きやPub/Subのチャネルに使用する。
+            room_store (BaseRoomStore | None): ルームストア。Noneの場合は永続化しない。
+            pubsub (BasePubSub | None): Pub/Sub。Noneの場合は自身の接続に直接ブロードキャストする。
         """
+        self.room_id = room_id
+        self.room_store = room_store
+        self.pubsub = pubsub
+        self.is_shared = pubsub is not None and pubsub.is_shared and room_store is not None  # 他のワーカーと状態を共有するか
         self.active_connections: dict[WebSocket, dict] = {}  # ws接続中のユーザのリスト
-        self.reset_message_db()                              # メッセージのDBをリセット
+        self.channels: dict[WebSocket, ClientChannel] = {}   # ws接続ごとの送信チャネル
+        self.discussion_module: Facilitator | None = None    # 議論用のモジュール
+        self.facilitator_config: dict | None = None          # 議論用のモジュールの生成時の引数（ルームの解放後に作り直すため）
+        self.user_name: str | None = None                    # 議題を指示するユーザの名前
+        self.image_dict: dict[str, str] = {}                 # ユーザ名から画像URLをひくための辞書
         self.is_running_discussion = False
+        self.should_stop = False
+        self.discussion_task: asyncio.Task | None = None     # 実行中の議論のタスク
+        self.last_active_at = time.monotonic()               # 最後のアクティビティの日時（アイドルなルームの解放に使用）
+        self._store_lock = asyncio.Lock()                    # メッセージDBの変更とルームストアの読み書きを直列化するロック
+        self._event_task: asyncio.Task | None = None         # 最後に受け取ったPub/Subのイベントを処理するタスク
+        # メッセージDBを復元（生成時の1度だけなので、ルームストアを直接読み書きする）
+        if not self.restore_message_db():
+            self.clear_message_db()                          # メッセージのDBをリセット
+            if self.room_store is not None:
+                self.room_store.reset_messages(self.room_id, self.epoch)
+
+    ######## ライフサイクル関係 ###################################################
+
+    def touch(self):
+        """最後のアクティビティの日時を更新する。"""
+        self.last_active_at = time.monotonic()
+
+    def get_idle_seconds(self) -> float:
+        """最後のアクティビティからの経過秒数を取得する。
+
+        Returns:
+            float: 経過秒数。
+        """
+        return time.monotonic() - self.last_active_at
+
+    def is_idle(self) -> bool:
+        """Webソケットの接続がなく、議論を実行していないかを判定する。
+
+        Returns:
+            bool: アイドルであればTrue。
+        """
+        return (
+            not self.active_connections
+            and not self.is_running_discussion
+            and (self.discussion_task is None or self.discussion_task.done())
+        )
+
+    def estimate_memory(self) -> int:
+        """ルームが保持しているメッセージDBと議論の途中経過の文字数を概算する。メモリ使用量の目安に用いる。
+
+        Returns:
+            int: 文字数の合計。
+        """
+        size = sum(len(message.to_json()) for message in self.messages)
+        if self.discussion_module is not None:
+            size += self.discussion_module.estimate_size()
+        return size
+
+    def get_stats(self) -> dict:
+        """ルームの利用状況を取得する。
+
+        Returns:
+            dict: 接続数、メッセージ数、議論の実行状況、アイドル秒数、メモリ使用量の概算など。
+        """
+        return {
+            'room_id': self.room_id,
+            'loaded': True,
+            'num_connections': len(self.active_connections),
+            'num_messages': len(self.messages),
+            'accessible_index': self.accessible_index,
+            'is_running_discussion': self.discussion_task is not None and not self.discussion_task.done(),
+            'has_facilitator': self.discussion_module is not None,
+            'idle_seconds': self.get_idle_seconds(),
+            'memory_chars': self.estimate_memory(),
+        }
+
+    def get_evictable_state(self) -> dict | None:
+        """ルームの解放時にディスクへ退避する状態を取得する。
+
+        メッセージDBはルームストアに永続化済みのため含めず、議論用のモジュールを作り直すための値だけを含める。
+
+        Returns:
+            dict | None: 退避する状態。議論用のモジュールがない場合はNone。
+        """
+        if self.discussion_module is None or self.facilitator_config is None:
+            return None
+        return {
+            'facilitator_config': self.facilitator_config,
+            'facilitator_state': self.discussion_module.get_state(),
+            'user_name': self.user_name,
+            'image_dict': self.image_dict,
+        }
+
+    def restore_evicted_state(self, state: dict):
+        """get_evictable_stateで退避した状態から、議論用のモジュールを作り直す。
+
+        Args:
+            state (dict): 退避した状態。
+        """
+        if self.discussion_module is not None:
+            return
+        self.facilitator_config = state['facilitator_config']
+        self.discussion_module = Facilitator(**self.facilitator_config)
+        self.discussion_module.load_state(state['facilitator_state'])
+        self.user_name = state['user_name']
+        self.image_dict = state['image_dict']
 
     ######## ws接続関係 ###########################################################
 
@@ -88,6 +258,7 @@ class ConnectionManager:
             websocket (WebSocket): Webソケットのインスタンス。
             query_params: クエリパラメータ。可変長名前付き引数。
         """
+        self.touch()
         # 接続
         await websocket.accept()
         # 接続可否判定
@@ -103,8 +274,21 @@ class ConnectionManager:
             "accecpt_datetime": datetime.now() + timedelta(hours=9)  # 記録用に接続日時も加えておく
         }
         self._log_active_connections()  # ロギング
-        # 接続してきた相手に，現在のDBの全メッセージを送信（ブラウザリロード対策）
-        await websocket.send_text(self.get_accessible_message_db_text())
+        # 他のワーカーが更新したメッセージDBを取り込む
+        await self.sync_message_db()
+        # 送信チャネルを作成して送信開始
+        channel = ClientChannel(
+            websocket,
+            get_snapshot_text=self.get_snapshot_frame_text,
+            on_closed=self.disconnect,
+        )
+        self.channels[websocket] = channel
+        channel.start()
+        # 接続してきた相手に，取りこぼした差分、または現在のDBの全メッセージを送信（ブラウザリロード・再接続対策）
+        channel.send(self.get_resync_frame_text(query_params.get("epoch"), query_params.get("last_seq")))
+        # 生成中の発言があれば、その時点までの発言を送信
+        if self.streaming_message is not None and self.is_caught_up():
+            channel.send(self.get_stream_frame_text(0, self.streaming_message.msg_text))
 
     def validate_connection(self, websocket: WebSocket, **query_params: dict) -> Tuple[bool, int, str]:
         """Webソケットの接続検証。
@@ -126,10 +310,18 @@ class ConnectionManager:
     def disconnect(self, websocket: WebSocket):
         """Webソケット接続解除。
 
+        クライアントからの切断と、送信チャネルによる切断の両方から呼ばれるため、2回呼ばれても問題ないようにしている。
+
         Args:
             websocket (WebSocket): Webソケットのインスタンス。
         """
+        if websocket not in self.active_connections:
+            return
+        self.touch()
         self.active_connections.pop(websocket)  # 接続中のユーザのリストから接続を削除
+        channel = self.channels.pop(websocket, None)
+        if channel is not None:
+            channel.stop()  # 送信チャネルを停止
         self._log_active_connections()  # ロギング
 
     def _log_active_connections(self):
@@ -144,33 +336,274 @@ class ConnectionManager:
                     log += f"\n - {k}: {v}"
             _LOGGER.info(f"Active connections: {log}")
 
-    async def broadcast(self, message: str):
+    async def broadcast(self, message: str, kind: Literal['frame', 'stream'] = 'frame'):
         """Webソケット接続しているすべてのクライアントにメッセージを一斉送信(ブロードキャスト)する。
 
+        Pub/Subがある場合はイベントとして発行し、すべてのワーカーがそれぞれの接続に送信する。
+
         Args:
             message (str): メッセージ。
+            kind (Literal['frame', 'stream']): イベント種別。メッセージフレームかストリームフレームか。
         """
-        for connection in self.active_connections.keys():
-            try:
-                await connection.send_text(message)  # メッセージを送信
-            except Exception:
-                self.active_connections.pop(connection)  # もし接続がクローズされていたら、その接続をリストから除外
+        if self.pubsub is None:
+            self.deliver_frame(message)
+        else:
+            await self.pubsub.publish(room_channel(self.room_id), encode_event(kind, message))
+
+    def deliver_frame(self, message: str):
+        """このワーカーでWebソケット接続しているすべてのクライアントにメッセージを送信する。
+
+        各接続の送信チャネルのキューに積むだけで、実際の送信は接続ごとの送信専用タスクが並行して行う。
+        送信に失敗した接続や送信の遅い接続は、送信チャネルが切断し、接続リストから除外する。
+
+        Args:
+            message (str): メッセージ。
+        """
+        for channel in list(self.channels.values()):
+            channel.send(message)
+
+    def handle_event(self, kind: str, payload: str):
+        """Pub/Subから受け取ったルームのイベントを処理する。
+
+        他のワーカーと状態を共有する場合は、ルームストアから更新を取り込む必要があるため、タスクとして処理する。
+        ルームストアの読み込みを待つ間も、イベントは受け取った順に処理する。
+
+        Args:
+            kind (str): イベント種別。
+            payload (str): イベントの本体。
+        """
+        if not self.is_shared:
+            # 単一ワーカー構成ではメモリ上のメッセージDBが常に最新のため、その場で処理する
+            if kind == 'frame' or kind == 'stream':
+                self.deliver_frame(payload)
+            elif kind == 'stop':
+                self.should_stop = True
+                self.cancel_discussion()
+            else:
+                _LOGGER.warning(f"unknown event ignored: room_id={self.room_id}, kind={kind}")
+            return
+        self._event_task = asyncio.create_task(self._handle_shared_event(kind, payload, self._event_task))
+
+    async def _handle_shared_event(self, kind: str, payload: str, previous_task: asyncio.Task | None):
+        """他のワーカーと状態を共有する場合に、Pub/Subから受け取ったルームのイベントを処理する。
+
+        Args:
+            kind (str): イベント種別。
+            payload (str): イベントの本体。
+            previous_task (asyncio.Task | None): 1つ前のイベントを処理するタスク。その完了を待ってから処理する。
+        """
+        if previous_task is not None:
+            await asyncio.wait([previous_task])
+        try:
+            if kind == 'frame':
+                # 閲覧可能なメッセージが増えているので、スナップショットでの再同期に備えて取り込んでから送信
+                await self.sync_message_db()
+                self.deliver_frame(payload)
+            elif kind == 'stream':
+                self.deliver_frame(payload)
+            elif kind == 'stop':
+                # 他のワーカーで停止された議論を、このワーカーで実行している場合に止める
+                self.should_stop = True
+                self.cancel_discussion()
+                await self.sync_message_db()
+            else:
+                _LOGGER.warning(f"unknown event ignored: room_id={self.room_id}, kind={kind}")
+        except Exception:
+            _LOGGER.exception(f"room event handling error happened: room_id={self.room_id}, kind={kind}")
 
     ######## メッセージDB管理の汎用関数 ###################################################
 
-    def reset_message_db(self):
-        """メッセージDBをリセットする。"""
+    async def run_store(self, func: Callable[..., T], *args) -> T:
+        """ルームストアの読み書きを別スレッドで実行する。
+
+        呼び出し元がキャンセルされても、読み書きが終わるまで待つ（終わる前に次の読み書きが始まり、順番が入れ替わらないようにする）。
+
+        Args:
+            func (Callable[..., T]): ルームストアのメソッド。
+            args: funcの引数。可変長引数。
+
+        Returns:
+            T: funcの戻り値。
+        """
+        future = asyncio.ensure_future(asyncio.to_thread(func, *args))
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            await asyncio.wait([future])
+            raise
+
+    async def reset_message_db(self):
+        """メッセージDBをリセットし、ルームストアに書き込む。"""
+        async with self._store_lock:
+            self.clear_message_db()
+            if self.room_store is not None:
+                await self.run_store(self.room_store.reset_messages, self.room_id, self.epoch)
+
+    def clear_message_db(self):
+        """メモリ上のメッセージDBをリセットする。ルームストアには書き込まない。"""
         self.messages: list[Message] = []              # DBに保持されているデータ
         self.accessible_messages: list[Message] = []   # DBの中でユーザに表示するデータ
         self.accessible_index = -1                     # DBの中でユーザに表示するデータの終端のインデックス、表示可能なデータが0個なら-1
+        self.epoch = str(time.time_ns())               # DBの世代番号。リセットのたびに変わる
+        self.streaming_message: Message | None = None  # ストリーミングで生成中の発言
+        self.streaming_length = 0  # 生成中の発言の本文の長さ（フロントエンドの文字列に合わせてUTF-16のコード単位で数える）
+
+    def restore_message_db(self) -> bool:
+        """ルームストアからメッセージDBを復元する。
 
-    def get_accessible_message_db_text(self) -> str:
-        """閲覧可能メッセージDBをJSON文字列にダンプする。
+        議論の途中でプロセスが停止していた場合、議論を再開することはできないため、議論終了シグナルを追加して議論を閉じる。
+        生成時に1度だけ呼び出すため、ルームストアを直接読み書きする。
+
+        Returns:
+            bool: 復元できた場合はTrue。ルームストアがない、または保存されていない場合はFalse。
+        """
+        if self.room_store is None:
+            return False
+        stored = self.room_store.load_messages(self.room_id)
+        if stored is None:
+            return False
+        self.messages = []
+        for message_json in stored.messages:
+            message = Message(**json.loads(message_json))
+            message.freeze()
+            self.messages.append(message)
+        self.accessible_index = min(stored.accessible_index, len(self.messages) - 1)
+        self.accessible_messages = self.messages[:self.accessible_index + 1]
+        self.epoch = stored.epoch
+        self.streaming_message = None
+        _LOGGER.info(f"message db restored: room_id={self.room_id}, num_messages={len(self.messages)}")
+        # 中断された議論を閉じる
+        # ただし複数ワーカー構成では、他のワーカーで実行中の議論と区別できないため閉じない
+        if not self.is_shared and self.messages and self.messages[-1].msg_text != '議論終了':
+            message = self.add_message(Message(
+                type='system_info',
+                user_name='system',
+                msg_text='議論終了'
+            ))
+            self.room_store.append_message(self.room_id, message.seq, message.to_json())
+        return True
+
+    async def sync_message_db(self):
+        """他のワーカーが更新したメッセージDBを、ルームストアから取り込む。
+
+        追記されたメッセージと閲覧可能なメッセージのインデックスを取り込む。
+        世代番号が変わっていた場合（他のワーカーで議論の開始や停止があった場合）は、すべて読み込み直す。
+        単一ワーカー構成ではメモリ上のメッセージDBが常に最新のため、何もしない。
+        """
+        if not self.is_shared:
+            return
+        async with self._store_lock:
+            await self._sync_message_db()
+
+    async def _sync_message_db(self):
+        """sync_message_dbの本体。self._store_lockを取得した状態で呼び出す。"""
+        if not self.is_shared:
+            return
+        stored = await self.run_store(self.room_store.load_messages, self.room_id, len(self.messages))
+        if stored is None:
+            return
+        if stored.epoch != self.epoch:
+            stored = await self.run_store(self.room_store.load_messages, self.room_id)
+            if stored is None:
+                return
+            self.messages = []
+            self.accessible_messages = []
+            self.epoch = stored.epoch
+            self.streaming_message = None
+        for message_json in stored.messages:
+            message = Message(**json.loads(message_json))
+            message.freeze()
+            self.messages.append(message)
+        self.accessible_index = min(stored.accessible_index, len(self.messages) - 1)
+        self.accessible_messages.extend(self.messages[len(self.accessible_messages):self.accessible_index + 1])
+
+    @staticmethod
+    def get_messages_text(messages: list[Message]) -> str:
+        """メッセージのリストを、JSON配列の文字列にダンプする。
+
+        各メッセージのJSON文字列はメッセージ側でキャッシュしているので、それらを連結するだけで作成する。
+
+        Args:
+            messages (list[Message]): メッセージのリスト。
 
         Returns:
             str: JSON文字列。
         """
-        return json.dumps([message.to_dict() for message in self.accessible_messages], ensure_ascii=False)
+        return f'[{",".join(message.to_json() for message in messages)}]'
+
+    def get_message_frame_text(self, frame: Literal['snapshot', 'delta'], messages: list[Message]) -> str:
+        """メッセージのリストを、スナップショットまたは差分フレームのJSON文字列にダンプする。
+
+        Args:
+            frame (Literal['snapshot', 'delta']): フレームの種類。
+            messages (list[Message]): メッセージのリスト。
+
+        Returns:
+            str: JSON文字列。
+        """
+        return f'{{"frame":"{frame}","epoch":{json_dumps(self.epoch)},"messages":{self.get_messages_text(messages)}}}'
+
+    def get_snapshot_frame_text(self) -> str:
+        """閲覧可能メッセージDBの全メッセージを、スナップショットフレームのJSON文字列にダンプする。
+
+        Returns:
+            str: JSON文字列。
+        """
+        return self.get_message_frame_text('snapshot', self.accessible_messages)
+
+    def get_delta_frame_text(self, messages: list[Message]) -> str:
+        """新しく閲覧可能になったメッセージを、差分フレームのJSON文字列にダンプする。
+
+        Args:
+            messages (list[Message]): 新しく閲覧可能になったメッセージ。
+
+        Returns:
+            str: JSON文字列。
+        """
+        return self.get_message_frame_text('delta', messages)
+
+    def get_resync_frame_text(self, epoch: str | None, last_seq: int | None) -> str:
+        """クライアントの受信状況に応じて、取りこぼした差分、またはスナップショットのJSON文字列を作成する。
+
+        世代番号が一致し、取りこぼしたメッセージ数がMAX_RESYNC_GAP以下の場合は差分フレーム、それ以外はスナップショットフレームとする。
+
+        Args:
+            epoch (str | None): クライアントが保持しているDBの世代番号。
+            last_seq (int | None): クライアントが最後に受け取ったメッセージのシーケンス番号。
+
+        Returns:
+            str: JSON文字列。
+        """
+        if epoch == self.epoch and last_seq is not None and 0 <= self.accessible_index - last_seq <= MAX_RESYNC_GAP:
+            return self.get_delta_frame_text(self.accessible_messages[last_seq + 1:])
+        return self.get_snapshot_frame_text()
+
+    def get_stream_frame_text(self, offset: int, delta: str) -> str:
+        """生成中の発言の差分を、ストリームフレームのJSON文字列にダンプする。
+
+        Args:
+            offset (int): 生成中の発言の本文のうち、差分が始まる位置（UTF-16のコード単位）。
+            delta (str): 差分。
+
+        Returns:
+            str: JSON文字列。
+        """
+        return json_dumps({
+            'frame': 'stream',
+            'type': self.streaming_message.type,
+            'user_name': self.streaming_message.user_name,
+            'user_img': self.streaming_message.user_img,
+            'offset': offset,
+            'delta': delta,
+        })
+
+    def is_caught_up(self) -> bool:
+        """メッセージDBのメッセージがすべて閲覧可能になっているかを判定する。
+
+        Returns:
+            bool: すべて閲覧可能であればTrue。
+        """
+        return self.accessible_index + 1 >= len(self.messages)
 
     def get_user_img(self, name: str) -> str:
         """ユーザ名から画像を取得する。
@@ -188,11 +621,25 @@ class ConnectionManager:
         else:
             return ''                       # それ以外は空白で返す（画像なしで表示される）
 
-    def push_message(self, new_message: Message):
-        """メッセージをメッセージDBに追加する。
+    async def push_message(self, new_message: Message):
+        """メッセージをメッセージDBに追加し、ルームストアに追記する。
+
+        Args:
+            new_message (Message): メッセージ。
+        """
+        async with self._store_lock:
+            self.add_message(new_message)
+            if self.room_store is not None:
+                await self.run_store(self.room_store.append_message, self.room_id, new_message.seq, new_message.to_json())
+
+    def add_message(self, new_message: Message) -> Message:
+        """メッセージを確定し、メモリ上のメッセージDBに追加する。ルームストアには書き込まない。
 
         Args:
             new_message (Message): メッセージ。
+
+        Returns:
+            Message: 確定したメッセージ。
         """
         # 不要な「」を削除
         if new_message.msg_text[0] == '「' and new_message.msg_text[-1] == '」':
@@ -201,21 +648,61 @@ class ConnectionManager:
         new_message.timestamp = str(now.timestamp())                         # メッセージ本体にタイムスタンプ情報を取得
         new_message.time = now.strftime('%H:%M')                             # メッセージ本体に時刻情報を追加
         new_message.user_img = self.get_user_img(new_message.user_name)   # メッセージ本体にユーザの画像の情報を追加
+        new_message.seq = len(self.messages)                                    # メッセージ本体にシーケンス番号を追加
+        new_message.freeze()                                                    # メッセージを確定し、JSON文字列をキャッシュ
         self.messages.append(new_message)                                       # DBにメッセージを追加
-        print(new_message)
+        self.streaming_message = None                                           # 生成中の発言は確定したので破棄
+        return new_message
+
+    async def push_message_delta(self, user_name: str, delta: str):
+        """生成中の発言に差分を追加し、閲覧者がすべて閲覧済みであればブロードキャストする。
+
+        Args:
+            user_name (str): 発言者。
+            delta (str): 発言の差分。
+        """
+        # 発言者が変わった場合は、新しい発言として生成中の発言を作り直す
+        if self.streaming_message is None or self.streaming_message.user_name != user_name:
+            self.streaming_message = Message(
+                type='message',
+                user_name=user_name,
+                msg_text='',
+                user_img=self.get_user_img(user_name),
+            )
+            self.streaming_length = 0
+        # NOTE: フロントエンド(JavaScript)の文字列の長さはUTF-16のコード単位のため、絵文字などはPythonの文字数と一致しない
+        offset = self.streaming_length
+        self.streaming_message.msg_text += delta
+        self.streaming_length += len(delta.encode('utf-16-le')) // 2
+        # 閲覧者にとって次の発言である場合のみ送信（未閲覧のメッセージがある場合は、発言順が崩れるため送信しない）
+        if self.is_caught_up():
+            await self.broadcast(self.get_stream_frame_text(offset, delta), kind='stream')
 
     async def add_accessible_message(self) -> list:
         """閲覧可能メッセージDBにメッセージDBのメッセージを1つ追加し、ブロードキャストする。
 
+        メッセージの生成と表示のペースは独立しており、議論はメッセージDBに追加するだけで表示を待たない。
+        表示のペースは、この関数を呼び出す間隔（「次へ（Next）」の操作やクライアントの自動要求の間隔）で決まる。
+        追加によってすべて閲覧済みになり、生成中の発言がある場合は、その時点までの発言をストリームフレームで送信する
+        （閲覧済みになるまでに届いた差分は送信していないため。以降の差分はこの続きとして送信される）。
+
         Returns:
             list: メッセージ追加後の閲覧可能メッセージDB。
         """
-        if len(self.messages) <= self.accessible_index + 1:
-            pass
-        else:
+        self.touch()
+        async with self._store_lock:
+            await self._sync_message_db()  # 他のワーカーが更新したメッセージDBを取り込む
+            if len(self.messages) <= self.accessible_index + 1:
+                return self.accessible_messages
             self.accessible_messages.append(self.messages[self.accessible_index+1])  # 閲覧可能なメッセージを1つ増やす
             self.accessible_index += 1
-            await self.broadcast(self.get_accessible_message_db_text())  # DB更新のため，全体へDBの全メッセージを送信
+            if self.room_store is not None:
+                # ルームストアのカーソルを更新
+                await self.run_store(self.room_store.set_accessible_index, self.room_id, self.accessible_index)
+        await self.broadcast(self.get_delta_frame_text([self.accessible_messages[-1]]))  # DB更新のため，全体へ追加したメッセージを送信
+        # すべて閲覧済みになった時点で生成中の発言があれば、それまでの差分は送信していないので、その時点までの発言を送信
+        if self.streaming_message is not None and self.is_caught_up():
+            await self.broadcast(self.get_stream_frame_text(0, self.streaming_message.msg_text), kind='stream')
         return self.accessible_messages
 
     ######## メッセージ処理関連 ###################################################
@@ -240,10 +727,14 @@ class ConnectionManager:
             return {"status": "failed"}
         # 実行中フラグを立てる
         self.is_running_discussion = True
+        self.touch()
+        # 停止後にキャンセルが完了していない議論があれば、新しい議論と並行して動かないようにキャンセル
+        self.cancel_discussion()
         # 強制停止フラグを下ろす
         self.should_stop = False
-        # キャッシュ
+        # キャッシュ（再生する議論の発言）と、議論の結果を保存するキャッシュのキー
         cache = None
+        cache_key = None
         try:
             # フロントエンドで画像表示・音声合成用の参加者（ユーザ, パネリスト）のコンフィグを作成
             # userだけ別のデータとして格納されているので、panelistsのリストの先頭に追加
@@ -260,32 +751,27 @@ class ConnectionManager:
             self.image_dict = {datum_i['name']: datum_i['image'] for datum_i in participants_config}
 
             # DBをリセット、フロントエンドで使用するデータをDBにpush
-            self.reset_message_db()
+            await self.reset_message_db()
 
             # 議論開始メッセージ
             # 議論を実行したユーザから他のユーザへの引継ぎデータを含む
             # さらにパネリスト構成の情報を含む
             handover_datum['participants_config'] = participants_config
-            self.push_message(Message(
+            await self.push_message(Message(
                 type='system_info',
                 user_name='system',
                 msg_text='議論開始',
                 handover_datum=handover_datum
             ))
 
-            # キャッシュの指定がある場合、キャッシュを読み込む
-            if 'cache' in config_message:
-                cache_dir = pathlib.Path('./cache/')
-                cache_file = cache_dir / config_message['cache']
-                if os.path.isfile(cache_file):
-                    with cache_file.open('r', encoding='utf-8') as f:
-                        cache = json.load(f)
-                    _LOGGER.info(f"cache file found: {cache_file}")
-                else:
-                    _LOGGER.warning(f"cache file not found: {cache_file}")
+            # 議論キャッシュを読み込む（なければ、キャッシュファイルの指定がある場合にキャッシュファイルを読み込む）
+            cache_key = self.get_discussion_cache_key(config_message)
+            cache = get_discussion_cache().get(cache_key)
+            if cache is None and 'cache' in config_message:
+                cache = self.load_legacy_cache(config_message['cache'], config_message['agenda'])
 
             # 議論用のモジュールを用意
-            self.discussion_module = Facilitator(
+            self.facilitator_config = dict(
                 panelist_names=[e['name'] for e in config_message['panelists']],
                 panelist_personas=[e['persona'] for e in config_message['panelists']],
                 panelist_characteristics=[e['characteristics'] for e in config_message['panelists']],
@@ -297,15 +783,19 @@ class ConnectionManager:
                 additional_subsequent_user_prompt=config_message['additional_subsequent_user_prompt'],
                 additional_last_user_prompt=config_message['additional_last_user_prompt'],
                 num_discussion_turn=1,
+                lookahead=config_message.get('lookahead', DEFAULT_LOOKAHEAD),
             )
+            self.discussion_module = Facilitator(**self.facilitator_config)
 
-            # 議論実行
-            asyncio.create_task(self.do_discussion(
+            # 議論実行（完了を待たずに返却）
+            self.run_discussion(self.do_discussion(
                 agenda=config_message['agenda'],
                 is_continue=False,
                 use_strategy=config_message['tech_enable'],
                 lang=config_message['lang'],
-                cache=cache)
+                cache=cache,
+                cache_key=cache_key if cache is None else None,
+                stream=config_message.get('stream', False))
             )
             return {
                 "status": "succeeded",
@@ -318,6 +808,47 @@ class ConnectionManager:
             # 実行中フラグを下ろす
             self.is_running_discussion = False
 
+    def get_discussion_cache_key(self, config_message: dict) -> str:
+        """議論の初期設定メッセージから議論キャッシュのキーを作成する。
+
+        パネリストが使用するモデルのバージョンと、革アG技術を使う場合は議論戦略構成器の設定とそのモデルのバージョンもキーに含める。
+
+        Args:
+            config_message (dict): 議論の初期設定メッセージ。
+
+        Returns:
+            str: 議論キャッシュのキー。
+        """
+        model_tags = [e['model'] for e in config_message['panelists']]
+        strategist_config = None
+        if config_message['tech_enable']:
+            model_tags.append('OpenAI')  # 議論戦略構成器が使用するモデル
+            strategist_config = pathlib.Path(STRATEGIST_CONFIG_PATH).read_text(encoding='utf-8')
+        registry = get_client_registry()
+        model_versions = {model_tag: registry.get_model_version(model_tag) for model_tag in sorted(set(model_tags))}
+        return make_cache_key(config_message, model_versions, strategist_config)
+
+    def load_legacy_cache(self, cache_file_name: str, agenda: str) -> list[CachedComment] | None:
+        """キャッシュファイル（`./cache/{議題ID}_{設定ファイル名}.json`）から議題の議論の発言を読み込む。
+
+        Args:
+            cache_file_name (str): キャッシュファイル名。
+            agenda (str): 議題。
+
+        Returns:
+            list[CachedComment] | None: 議論の発言のリスト。キャッシュファイルがない、または議題が含まれない場合はNone。
+        """
+        cache_file = pathlib.Path('./cache/') / cache_file_name
+        if not os.path.isfile(cache_file):
+            return None
+        with cache_file.open('r', encoding='utf-8') as f:
+            cache = json.load(f)
+        if agenda not in cache:
+            _LOGGER.warning(f"agenda not found in cache file: {cache_file}")
+            return None
+        _LOGGER.info(f"cache file found: {cache_file}")
+        return [tuple(comment) for comment in cache[agenda]]
+
     async def start_additional_discussion(self, query_message):
         """追加議論を開始する。
 
@@ -329,24 +860,37 @@ class ConnectionManager:
         if self.is_running_discussion:
             _LOGGER.warning("discussion is already running, start_additional_discussion canceled.")
             return
+        # 議論用のモジュールがない（ルームストアから復元したルームなど）場合は議論を継続できない
+        if self.discussion_module is None:
+            _LOGGER.warning("discussion module not found, start_additional_discussion canceled.")
+            return
         # 実行中フラグを立てる
         self.is_running_discussion = True
+        self.touch()
         try:
             # 各種設定値の取り出し
             agenda = query_message['msg_text']           # 議題情報
             use_strategy = query_message["tech_enable"]  # 革アG技術を使うかどうか
+            stream = query_message.get("stream", False)  # 発言をストリーミングで送信するかどうか
 
             # 追加議論開始メッセージ
             # 追加議論時も議論を実行したユーザから他のユーザに引き継ぎデータを送らないと、初回議論の設定値で画面が更新されてしまう
-            self.push_message(Message(
+            await self.push_message(Message(
                 type='system_info',
                 user_name='system',
                 msg_text='議論開始',
                 handover_datum=query_message
             ))
 
-            # 議論実行
-            await self.do_discussion(agenda=agenda, is_continue=True, use_strategy=use_strategy)
+            # 議論実行（完了を待つ）
+            task = self.run_discussion(
+                self.do_discussion(agenda=agenda, is_continue=True, use_strategy=use_strategy, stream=stream))
+            try:
+                await task
+            except asyncio.CancelledError:
+                if not task.cancelled():
+                    raise  # 呼び出し元がキャンセルされた場合
+                _LOGGER.info(f"additional discussion canceled: room_id={self.room_id}")
         except Exception as ex:
             _LOGGER.exception("start_additional_discussion error happened.")
             raise ex
@@ -360,48 +904,67 @@ class ConnectionManager:
         is_continue: bool,
         use_strategy: bool,
         lang: str = None,
-        cache: dict = None
+        cache: list[CachedComment] | None = None,
+        cache_key: str | None = None,
+        stream: bool = False
     ):
         """議論を実行する。
 
+        キャッシュが与えられた場合は、LLMを呼び出さずにキャッシュの発言を再生する。
+        キャッシュのキーが与えられた場合は、最後まで完了した議論の発言を議論キャッシュに保存する。
+
         Args:
             agenda (str): 議題。
             is_continue (bool): 追加議論か否か。
             use_strategy (bool): 議論戦略器を使うかどうか。
             lang (str): 言語。日本語(ja)か英語(en)か。
-            cache (dict): 議論のキャッシュ。
+            cache (list[CachedComment] | None): 再生する議論の発言。
+            cache_key (str | None): 議論の結果を保存する議論キャッシュのキー。
+            stream (bool): 発言をストリーミングで送信するかどうか。
         """
-        if not cache:
+        if cache is None:
             # 議題指示をDBに追加
             new_message = Message(
                 type='message',
                 user_name=self.user_name,
                 msg_text=agenda,
             )
-            self.push_message(new_message)
-            await asyncio.sleep(1)
+            await self.push_message(new_message)
+            comments: list[CachedComment] = [('message', self.user_name, agenda)]  # 議論キャッシュに保存する発言
 
             # 議論開始：LLMの出力をDBに追加
-            gen_start_discussion = self.discussion_module.start_discussion(agenda, is_continue, use_strategy, lang)
-            while True:
-                try:
-                    comment_type, panelist_name, comment = await gen_start_discussion.__anext__()
-                    # 強制停止フラグが立っていた場合は終了
-                    if self.should_stop:
-                        break
-                    # Noneが返却されたらcontinue
-                    if comment_type is None or panelist_name is None or comment is None:
-                        continue
-                    # コメントをDBに追加
-                    new_message = Message(
-                        type=comment_type,
-                        user_name=panelist_name,
-                        msg_text=comment
-                    )
-                    self.push_message(new_message)
-                    await asyncio.sleep(1)
-                except StopAsyncIteration:
-                    break  # __anext__の終了検知、議論終了
+            gen_start_discussion = self.discussion_module.start_discussion(agenda, is_continue, use_strategy, lang, stream)
+            try:
+                while True:
+                    try:
+                        comment_type, panelist_name, comment = await gen_start_discussion.__anext__()
+                        # 強制停止フラグが立っていた場合は終了
+                        if self.should_stop:
+                            break
+                        # Noneが返却されたらcontinue
+                        if comment_type is None or panelist_name is None or comment is None:
+                            continue
+                        # 発言の差分は生成中の発言に追加してcontinue
+                        if comment_type == 'message_delta':
+                            await self.push_message_delta(panelist_name, comment)
+                            continue
+                        # コメントをDBに追加
+                        new_message = Message(
+                            type=comment_type,
+                            user_name=panelist_name,
+                            msg_text=comment
+                        )
+                        await self.push_message(new_message)
+                        comments.append((comment_type, panelist_name, comment))
+                    except StopAsyncIteration:
+                        break  # __anext__の終了検知、議論終了
+            finally:
+                # 停止やキャンセルで中断した場合も、生成中のリクエストや先行生成を後始末する
+                await gen_start_discussion.aclose()
+
+            # 最後まで完了した議論は議論キャッシュに保存
+            if cache_key is not None and not self.should_stop:
+                get_discussion_cache().put(cache_key, agenda, comments)
 
             # 議論終了シグナルをDBに追加
             new_message = Message(
@@ -409,21 +972,11 @@ class ConnectionManager:
                 user_name='system',
                 msg_text='議論終了'
             )
-            self.push_message(new_message)
+            await self.push_message(new_message)
 
         else:
-            # キャッシュの確認
-            if agenda not in cache:
-                new_message = Message(
-                    type='system_info',
-                    user_name='Error',
-                    msg_text='Cache Error',
-                )
-                self.push_message(new_message)
-                return
-
             # 議論開始：キャッシュの内容をDBに追加
-            for message_type, panelist_name, comment in cache[agenda]:
+            for message_type, panelist_name, comment in cache:
                 # 強制停止フラグが立っていた場合は終了
                 if self.should_stop:
                     break
@@ -434,8 +987,7 @@ class ConnectionManager:
                     user_name=panelist_name,
                     msg_text=comment
                 )
-                self.push_message(new_message)
-                await asyncio.sleep(1)
+                await self.push_message(new_message)
 
             # 議論終了シグナルをDBに追加
             new_message = Message(
@@ -443,9 +995,63 @@ class ConnectionManager:
                 user_name='system',
                 msg_text='議論終了'
             )
-            self.push_message(new_message)
+            await self.push_message(new_message)
+
+    def run_discussion(self, discussion: Coroutine) -> asyncio.Task:
+        """議論をこのルームの議論のタスクとして実行する。
+
+        Args:
+            discussion (Coroutine): 議論を実行するコルーチン。
+
+        Returns:
+            asyncio.Task: 議論のタスク。
+        """
+        task = asyncio.create_task(discussion)
+        task.add_done_callback(self._on_discussion_done)
+        self.discussion_task = task
+        return task
+
+    def _on_discussion_done(self, task: asyncio.Task):
+        """議論のタスクが終了した時に、タスクを破棄し、例外があればロギングする。
+
+        Args:
+            task (asyncio.Task): 終了した議論のタスク。
+        """
+        if self.discussion_task is task:
+            self.discussion_task = None
+        if task.cancelled():
+            _LOGGER.info(f"discussion task canceled: room_id={self.room_id}")
+        elif task.exception() is not None:
+            _LOGGER.error(f"discussion task error happened: room_id={self.room_id}", exc_info=task.exception())
+
+    def cancel_discussion(self) -> asyncio.Task | None:
+        """実行中の議論のタスクをキャンセルする。
+
+        タスクのキャンセルは、実行中のLLMへのリクエストや応答候補の並行生成、先行生成にも伝わる。
+
+        Returns:
+            asyncio.Task | None: キャンセルしたタスク。実行中の議論がない場合はNone。
+        """
+        task = self.discussion_task
+        if task is None or task.done():
+            return None
+        task.cancel()
+        return task
 
     async def stop_discussion(self):
         """議論を停止する。"""
         self.should_stop = True     # 強制停止フラグを立てる
-        self.reset_message_db()     # DBをリセット
+        self.cancel_discussion()    # 実行中の議論をキャンセル
+        await self.reset_message_db()  # DBをリセット
+        # 他のワーカーで議論を実行している場合に備えて、停止を通知
+        if self.pubsub is not None:
+            await self.pubsub.publish(room_channel(self.room_id), encode_event('stop', self.epoch))
+
+    async def close(self):
+        """ルームの削除時に、実行中の議論をキャンセルし、すべてのWebソケット接続を閉じる。"""
+        self.should_stop = True
+        task = self.cancel_discussion()
+        if task is not None:
+            await asyncio.wait([task])  # キャンセルが完了し、LLMへのリクエストが閉じられるまで待つ
+        for channel in list(self.channels.values()):
+            await channel.close()
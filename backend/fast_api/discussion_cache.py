@@ -0,0 +1,166 @@
+import hashlib
+import json
+import logging
+import os
+import pathlib
+import tempfile
+import threading
+import time
+from ai_constellation.common.utils import json_dumps
+
+
+# ロガー
+_LOGGER = logging.getLogger(__name__)
+_LOGGER.addHandler(logging.NullHandler())
+
+
+# 議論キャッシュの保存先と、エントリ数・有効期間の既定値（環境変数で変更可能）
+DEFAULT_DISCUSSION_CACHE_DIR = './cache/discussions/'
+DEFAULT_DISCUSSION_CACHE_MAX_ENTRIES = 256
+DEFAULT_DISCUSSION_CACHE_TTL = 60 * 60 * 24 * 30  # 30日
+
+# 議論キャッシュの1発言。メッセージ種別、発言者、発言の組
+CachedComment = tuple[str, str, str]
+
+
+def make_cache_key(config_message: dict, model_versions: dict[str, str | None], strategist_config: str | None) -> str:
+    """議論キャッシュのキーを作成する。
+
+    議論の結果に影響する値（議題、設定ファイルの内容（プロンプトやパネリスト構成を含む）、言語、革アG技術の有無、
+    使用するモデルのバージョン、議論戦略構成器の設定）を正規化したJSONにし、そのハッシュ値をキーとする。
+    ストリーミングの有無など、議論の結果に影響しない値は含めない。
+
+    Args:
+        config_message (dict): 議論の初期設定メッセージ。
+        model_versions (dict[str, str | None]): モデルタグをキーとした、使用するモデルのバージョン。
+        strategist_config (str | None): 議論戦略構成器の設定ファイルの内容。革アG技術を使わない場合はNone。
+
+    Returns:
+        str: キャッシュのキー(SHA-256の16進数文字列)。
+    """
+    content = {
+        'config': {k: v for k, v in config_message.items() if k not in ('stream', 'cache')},
+        'model_versions': model_versions,
+        'strategist_config': strategist_config,
+    }
+    canonical = json.dumps(content, ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+class DiscussionCache:
+    """議論キャッシュ。
+
+    完了した議論の発言をキーごとに1ファイルのJSONとして保存し、同じ条件の議論をLLMを呼び出さずに再生できるようにする。
+    エントリ数の上限を超えた場合は最後に使われたのが古いものから、有効期間を過ぎたものは読み込み時と保存時に削除する。
+    ファイルは一時ファイルに書いてから置き換えるため、複数ワーカーから同時に読み書きしても壊れない。
+    """
+
+    def __init__(
+        self,
+        cache_dir: str = DEFAULT_DISCUSSION_CACHE_DIR,
+        max_entries: int = DEFAULT_DISCUSSION_CACHE_MAX_ENTRIES,
+        ttl: float | None = DEFAULT_DISCUSSION_CACHE_TTL
+    ):
+        """コンストラクタ。
+
+        Args:
+            cache_dir (str): キャッシュファイルを保存するディレクトリ。
+            max_entries (int): 保持するエントリ数の上限。
+            ttl (float | None): エントリの有効期間(秒)。Noneの場合は期限なし。
+        """
+        self.cache_dir = pathlib.Path(cache_dir)
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> list[CachedComment] | None:
+        """キャッシュから議論の発言を取得する。
+
+        Args:
+            key (str): キャッシュのキー。
+
+        Returns:
+            list[CachedComment] | None: 議論の発言のリスト。キャッシュがない、または有効期間を過ぎている場合はNone。
+        """
+        path = self.cache_dir / f'{key}.json'
+        try:
+            if self._is_expired(os.path.getmtime(path)):
+                path.unlink(missing_ok=True)
+                return None
+            with path.open('r', encoding='utf-8') as f:
+                entry = json.load(f)
+            os.utime(path)  # 最後に使われた日時として更新日時を更新
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+        _LOGGER.info(f"discussion cache hit: key={key}")
+        return [tuple(comment) for comment in entry['comments']]
+
+    def put(self, key: str, agenda: str, comments: list[CachedComment]):
+        """議論の発言をキャッシュに保存し、古いエントリを削除する。
+
+        Args:
+            key (str): キャッシュのキー。
+            agenda (str): 議題。確認用に保存する。
+            comments (list[CachedComment]): 議論の発言のリスト。
+        """
+        entry = {
+            'agenda': agenda,
+            'created_at': time.time(),
+            'comments': [list(comment) for comment in comments],
+        }
+        with self._lock:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                f.write(json_dumps(entry))
+            os.replace(tmp_path, self.cache_dir / f'{key}.json')
+            self._evict()
+        _LOGGER.info(f"discussion cache stored: key={key}, num_comments={len(comments)}")
+
+    def _is_expired(self, mtime: float) -> bool:
+        """有効期間を過ぎているかを判定する。
+
+        Args:
+            mtime (float): キャッシュファイルの更新日時。
+
+        Returns:
+            bool: 有効期間を過ぎていればTrue。
+        """
+        return self.ttl is not None and time.time() - mtime > self.ttl
+
+    def _evict(self):
+        """有効期間を過ぎたエントリと、上限を超えた分の最後に使われたのが古いエントリを削除する。"""
+        entries = []
+        for path in self.cache_dir.glob('*.json'):
+            try:
+                entries.append((os.path.getmtime(path), path))
+            except FileNotFoundError:
+                continue  # 他のワーカーが削除済み
+        entries.sort(reverse=True)
+        for i, (mtime, path) in enumerate(entries):
+            if i >= self.max_entries or self._is_expired(mtime):
+                path.unlink(missing_ok=True)
+                _LOGGER.info(f"discussion cache evicted: {path.name}")
+
+
+# プロセス内で共有する議論キャッシュ
+_DISCUSSION_CACHE: DiscussionCache | None = None
+
+
+def get_discussion_cache() -> DiscussionCache:
+    """プロセス内で共有する議論キャッシュを取得する。
+
+    初回呼び出し時に、環境変数DISCUSSION_CACHE_DIR、DISCUSSION_CACHE_MAX_ENTRIES、DISCUSSION_CACHE_TTLの設定に従って生成する。
+
+    Returns:
+        DiscussionCache: 議論キャッシュ。
+    """
+    global _DISCUSSION_CACHE
+    if _DISCUSSION_CACHE is None:
+        ttl = os.getenv('DISCUSSION_CACHE_TTL')
+        _DISCUSSION_CACHE = DiscussionCache(
+            cache_dir=os.getenv('DISCUSSION_CACHE_DIR', DEFAULT_DISCUSSION_CACHE_DIR),
+            max_entries=int(os.getenv('DISCUSSION_CACHE_MAX_ENTRIES', DEFAULT_DISCUSSION_CACHE_MAX_ENTRIES)),
+            ttl=float(ttl) if ttl else DEFAULT_DISCUSSION_CACHE_TTL,
+        )
+    return _DISCUSSION_CACHE
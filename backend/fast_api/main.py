@@ -4,17 +4,21 @@ FastAPIのエンドポイントを定義する。
 ConnectionManagerで接続状態を管理する。
 """
 import yaml
-import pathlib
 import os
+from contextlib import asynccontextmanager
 from datetime import datetime, timedelta
 from typing import Any, Literal
 from ai_constellation.common.async_logger import AsyncLogger
-from fastapi import FastAPI, HTTPException, WebSocket, WebSocketDisconnect, Query
+from fastapi import FastAPI, HTTPException, Request, Response, WebSocket, WebSocketDisconnect, Query
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.websockets import WebSocketState
 from collections import OrderedDict
 from ai_constellation.common.utils import yaml_ordered_dict_representer, yaml_multiline_string_representer
+from ai_constellation.llm_clients.client_registry import get_client_registry
+from ai_constellation.llm_clients.completion_cache import get_completion_cache
+from ai_constellation.tech.embedding_service import get_embedding_stats
 from room_manager import RoomManager
+from config_catalog import CatalogResponse, ConfigCatalog
 
 ################################# ロギング関係 #################################
 
@@ -26,7 +30,25 @@ logger.start(logfile_path=f'./logs/log_{start_datetime.strftime("%Y%m%d%H%M%S")}
 
 ################################# FastAPI設定関係 #################################
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """アプリケーションの起動・終了時の処理。
+
+    起動時にLLMクライアントのレジストリを読み込み、全ルーム・全議論で共有するクライアントを生成しておく。
+    また、ルームのイベントを受け取るためにPub/Subの購読を開始する。
+    終了時にはPub/Subの購読を終了し、クライアントのコネクションプールと生成結果のキャッシュを閉じる。
+
+    Args:
+        app (FastAPI): FastAPIのインスタンス。
+    """
+    get_client_registry().load()
+    await _ROOM_MANAGER.start()
+    yield
+    await _ROOM_MANAGER.aclose()
+    await get_client_registry().aclose()
+
+
+app = FastAPI(lifespan=lifespan)
 
 # CORS設定
 app.add_middleware(
@@ -49,18 +71,34 @@ _ROOM_MANAGER = RoomManager()
 
 
 @app.get('/rooms')
-def get_rooms() -> dict[int, dict[str, Any]]:
+async def get_rooms(
+    response: Response,
+    offset: int = Query(0, ge=0),
+    limit: int | None = Query(None, ge=1),
+    room_name: str | None = Query(None)
+) -> dict[int, dict[str, Any]]:
     """ルーム一覧を取得する。
 
+    作成日時順に並べたルームのうち、offset件目からlimit件を返却する。指定しない場合はすべて返却する。
+    条件に合うルームの総数はX-Total-Countヘッダで返却する。
+
+    Args:
+        response (Response): レスポンス。ヘッダの設定に使用する。
+        offset (int): 返却する先頭のルームの位置。
+        limit (int | None): 返却するルーム数の上限。
+        room_name (str | None): 指定した場合は、このルーム名のルームだけを返却する。
+
     Returns:
         dict[int, dict[str, Any]]: ルーム一覧。
     """
     global _ROOM_MANAGER
-    return _ROOM_MANAGER.get_rooms()
+    rooms = await _ROOM_MANAGER.get_rooms(offset, limit, room_name)
+    response.headers['X-Total-Count'] = str(_ROOM_MANAGER.count_rooms(room_name))
+    return rooms
 
 
 @app.post('/rooms')
-def create_room(data: dict[str, Any]) -> dict:
+async def create_room(data: dict[str, Any]) -> dict:
     """ルームを新規作成する。
 
     Args:
@@ -70,12 +108,12 @@ def create_room(data: dict[str, Any]) -> dict:
         dict: 処理結果。
     """
     global _ROOM_MANAGER
-    _ = _ROOM_MANAGER.create_room(data['room_name'])
+    _ = await _ROOM_MANAGER.create_room(data['room_name'])
     return {'status': 'success'}
 
 
 @app.delete('/rooms/{room_id}')
-def delete_room(room_id: int) -> dict:
+async def delete_room(room_id: int) -> dict:
     """ルームを削除する。
 
     Args:
@@ -85,7 +123,7 @@ def delete_room(room_id: int) -> dict:
         dict: 処理結果。
     """
     global _ROOM_MANAGER
-    deleted_room = _ROOM_MANAGER.delete_room(room_id)
+    deleted_room = await _ROOM_MANAGER.delete_room(room_id)
     # 対象ルームが存在しない場合は404エラー
     if deleted_room is None:
         raise HTTPException(
@@ -107,23 +145,23 @@ async def start_discussion(data: dict) -> dict:
         dict: 処理結果。
     """
     # ConnectionManagerを取得
-    (connection_manager, room_id, exist) = _ROOM_MANAGER.try_get_connection_manager_by_post_data(data)
+    (connection_manager, room_id, exist) = await _ROOM_MANAGER.try_get_connection_manager_by_post_data(data)
     if not exist:
         logger.logger.error(f"start_discussion error happend. ConnectionManager not found. room_id={room_id}")
         raise HTTPException(
             status_code=404,
             detail=f'ConnectionManager not found. room_id={room_id}')
     # start_discussionに渡すmessageを作成
-    config_dir = pathlib.Path(RoomManager.config_dir)
-    config_file = config_dir / data['config_file']
-    with config_file.open('r', encoding='utf-8') as f:
-        message = yaml.load(f, Loader=yaml.SafeLoader)
+    config_file = data['config_file']
+    message = _CONFIG_CATALOG.load_config(config_file)
     # messageに言語を設定
     message['lang'] = data['lang']
     # messageに革アG技術フラグを設定
     message['tech_enable'] = data['tech_enable']
     # messageに議題を設定
     message['agenda'] = data['agenda_text']
+    # messageにストリーミング有無を設定
+    message['stream'] = data.get('stream', False)
     # messageにキャッシュファイルを設定
     if data['is_select_agenda']:
         agenda_id = data['agenda_id']  # 議題ID
@@ -138,27 +176,28 @@ async def start_discussion(data: dict) -> dict:
 
 
 @app.post("/next_accessible_message")
-async def add_accessible_message(data: dict) -> list:
+async def add_accessible_message(data: dict) -> Response:
     """閲覧可能メッセージを追加する。
 
     ConnectionManagerが保持するメッセージDBからメッセージを1つ、閲覧可能メッセージDBに移す。
     その後、閲覧可能メッセージを各クライアントにブロードキャストする。
     閲覧可能メッセージは、HTTPリクエストに対するレスポンスとしても返却する。
+    レスポンスは、各メッセージがキャッシュしているJSON文字列を連結して作成する（メッセージごとに辞書化し直さない）。
 
     Args:
         data (dict): POSTのHTTPリクエストのボディ。ルームIDを含む。
 
     Returns:
-        list: 閲覧可能メッセージ。
+        Response: 閲覧可能メッセージのJSON配列。
     """
-    (connection_manager, room_id, exist) = _ROOM_MANAGER.try_get_connection_manager_by_post_data(data)
+    (connection_manager, room_id, exist) = await _ROOM_MANAGER.try_get_connection_manager_by_post_data(data)
     if not exist:
         logger.logger.error(f"add_accessible_message error happend. ConnectionManager not found. room_id={room_id}")
         raise HTTPException(
             status_code=404,
             detail=f'ConnectionManager not found. room_id={room_id}')
     messages = await connection_manager.add_accessible_message()  # 次のデータを送信するよう要求
-    return messages
+    return Response(content=connection_manager.get_messages_text(messages), media_type='application/json')
 
 
 @app.post("/additional_discussion")
@@ -171,7 +210,7 @@ async def start_additional_discussion(data: dict) -> dict:
     Returns:
         dict: 処理結果。
     """
-    (connection_manager, room_id, exist) = _ROOM_MANAGER.try_get_connection_manager_by_post_data(data)
+    (connection_manager, room_id, exist) = await _ROOM_MANAGER.try_get_connection_manager_by_post_data(data)
     if not exist:
         logger.logger.error("start_additional_discussion error happend. "
                             + f"ConnectionManager not found. room_id={room_id}")
@@ -192,7 +231,9 @@ async def websocket_endpoint_chat(
     websocket: WebSocket,
     room_id: int = Query(...),
     chat_room_mode: ChatRoomMode = Query(...),
-    screen_name: ScreenName = Query(...)
+    screen_name: ScreenName = Query(...),
+    epoch: str | None = Query(None),
+    last_seq: int | None = Query(None)
 ):
     """Webソケット接続を受け入れる。
 
@@ -201,20 +242,26 @@ async def websocket_endpoint_chat(
         room_id (int): ルームID。
         chat_room_mode (ChatRoomMode): クライアントのチャットルームモード。
         screen_name (ScreenName): クライアントで表示している画面名。ログ用。
+        epoch (str | None): 再接続時に、クライアントが保持しているメッセージDBの世代番号。
+        last_seq (int | None): 再接続時に、クライアントが最後に受け取ったメッセージのシーケンス番号。
     """
     # ConnectionManager取得
-    (connection_manager, exist) = _ROOM_MANAGER.try_get_connection_manager_by_room_id(room_id)
+    (connection_manager, exist) = await _ROOM_MANAGER.try_get_connection_manager_by_room_id(room_id)
     if not exist:
         logger.logger.error(f"websocket_endpoint_chat error happend. ConnectionManager not found. room_id={room_id}")
-        raise HTTPException(
-            status_code=404,
-            detail=f'ConnectionManager not found. room_id={room_id}')
+        # NOTE: 受け入れ前に拒否するとクライアントには異常切断(1006)として見え、再接続が繰り返されるため、
+        #       受け入れてから再接続しない終了コード(1008)で切断する
+        await websocket.accept()
+        await websocket.close(1008, 'ルームなし')
+        return
     # サーバからクライアントへの送信専用で接続
     await connection_manager.connect(
         websocket,
         room_id=room_id,
         chat_room_mode=chat_room_mode,
-        screen_name=screen_name
+        screen_name=screen_name,
+        epoch=epoch,
+        last_seq=last_seq
     )
     # 接続失敗したら終了(websokcetがclosedな状態でreceive_textを呼び出すと例外になる)
     if websocket.application_state == WebSocketState.DISCONNECTED:
@@ -239,7 +286,7 @@ async def stop_discussion(data: dict) -> dict:
     Returns:
         dict: 処理結果。
     """
-    (connection_manager, room_id, exist) = _ROOM_MANAGER.try_get_connection_manager_by_post_data(data)
+    (connection_manager, room_id, exist) = await _ROOM_MANAGER.try_get_connection_manager_by_post_data(data)
     if not exist:
         logger.logger.error(f"stop_discussion error happend. ConnectionManager not found. room_id={room_id}")
         raise HTTPException(
@@ -251,77 +298,91 @@ async def stop_discussion(data: dict) -> dict:
 
 ############################### API：設定ファイル関係 ###############################
 
+# 設定ファイルカタログ
+_CONFIG_CATALOG = ConfigCatalog(RoomManager.config_dir)
+
+
+def make_catalog_response(request: Request, catalog_response: CatalogResponse) -> Response:
+    """設定ファイルカタログのレスポンスから、HTTPレスポンスを作成する。
+
+    リクエストのIf-None-MatchがETagと一致する場合は、ボディなしで304を返却する。
+
+    Args:
+        request (Request): HTTPリクエスト。
+        catalog_response (CatalogResponse): 設定ファイルカタログのレスポンス。
+
+    Returns:
+        Response: HTTPレスポンス。
+    """
+    headers = {'ETag': catalog_response.etag, 'Cache-Control': 'no-cache'}
+    if request.headers.get('if-none-match') == catalog_response.etag:
+        return Response(status_code=304, headers=headers)
+    return Response(content=catalog_response.body, media_type='application/json', headers=headers)
+
+
 @app.get('/system/config_list')
-async def list_config() -> list:
+async def list_config(request: Request) -> Response:
     """設定ファイルとそのパネリストの一覧を取得する。
 
     フロントエンドで設定ファイルを確認するために用いる。
     パネリストのみ表示するため、それ以外の設定値は返さない。
 
+    Args:
+        request (Request): HTTPリクエスト。
+
     Returns:
-        list: 設定ファイルとパネリストの一覧。
+        Response: 設定ファイルとパネリストの一覧。
     """
-    # 議論設定ファイルの一覧を取得
-    config_dir = pathlib.Path(RoomManager.config_dir)
-    config_ja_paths = list(config_dir.glob('*_ja.yml'))
-    config_ja_paths.sort()
-
-    # 設定ファイルの形式に沿ったオブジェクトを作成
-    config_list = []
-    for idx, path in enumerate(config_ja_paths):
-        prefix = path.stem[:-3]  # "_ja"を取り除く
-
-        # pathの設定値をまとめたconfigを構成するために初期化
-        config = {}
-        config['id'] = idx + 1
-        config['file'] = {
-            'ja': f'{prefix}_ja.yml',
-            'en': f'{prefix}_en.yml',
-        }
-        config['label'] = {'ja': '', 'en': ''}
-        config['panelist_names'] = {'ja': list(), 'en': list()}
-        config['panelist_images'] = {'ja': dict(), 'en': dict()}
-
-        # 議論設定ファイルを読み込み、パネリスト情報を取得
-        for lang in ['ja', 'en']:
-            # 元データ読み込み
-            config_path = config_dir / f'{prefix}_{lang}.yml'
-            with config_path.open('r', encoding='utf-8') as f:
-                config_origin = yaml.load(f, Loader=yaml.SafeLoader)
-
-            # 'label'の読み込み
-            config['label'][lang] = config_origin['label']
-
-            # 'user'の読み込み
-            user = config_origin['user']
-            config['panelist_names'][lang].append(user['name'])
-            config['panelist_images'][lang].update({user['name']: user['image']})
-
-            # 'panelists'の読み込み
-            panelists = config_origin['panelists']
-            config['panelist_names'][lang].extend([e['name'] for e in panelists])
-            config['panelist_images'][lang].update({e['name']: e['image'] for e in panelists})
-
-        config_list.append(config)
-    return config_list
+    return make_catalog_response(request, _CONFIG_CATALOG.get_config_list())
 
 
 @app.get('/system/agenda/{agenda_file}')
-async def load_agenda(agenda_file: str) -> list:
+async def load_agenda(agenda_file: str, request: Request) -> Response:
     """議題一覧ファイルの内容を取得する。
 
     Args:
         agenda_file (str): 議題一覧ファイルまでのパス。
+        request (Request): HTTPリクエスト。
 
     Return:
-        list: 議題一覧。
+        Response: 議題一覧。
     """
-    config_dir = pathlib.Path(RoomManager.config_dir)
-    path = config_dir / agenda_file
-    if not path.exists():
+    catalog_response = _CONFIG_CATALOG.get_agenda(agenda_file)
+    if catalog_response is None:
         raise HTTPException(
             status_code=404,
             detail=f'agenda file not found. path={agenda_file}')
-    with path.open('r', encoding='utf-8') as f:
-        agenda_list = yaml.load(f, Loader=yaml.SafeLoader)
-    return agenda_list
+    return make_catalog_response(request, catalog_response)
+
+
+############################### API：システム状態関係 ###############################
+
+@app.get('/system/completion_cache/stats')
+async def get_completion_cache_stats() -> dict:
+    """LLMの生成結果のキャッシュの利用状況を取得する。
+
+    Returns:
+        dict: ヒット数、ミス数、ヒット率など。
+    """
+    return get_completion_cache().stats()
+
+
+@app.get('/system/embedding/stats')
+async def get_embedding_cache_stats() -> dict:
+    """議論戦略構成器の埋め込みのキャッシュの利用状況を取得する。
+
+    Returns:
+        dict: 埋め込みモデルごとのヒット数、ミス数、ヒット率など。
+    """
+    return get_embedding_stats()
+
+
+@app.get('/system/rooms/stats')
+async def get_room_stats() -> dict:
+    """ルームごとの利用状況を取得する。
+
+    Returns:
+        dict: ルームごとの接続数、メッセージ数、アイドル秒数、メモリ使用量の概算と、それらの合計など。
+    """
+    global _ROOM_MANAGER
+    return _ROOM_MANAGER.get_room_stats()
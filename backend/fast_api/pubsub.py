@@ -0,0 +1,217 @@
+import asyncio
+import logging
+import os
+import typing
+from typing import Callable
+try:
+    import redis.asyncio as aioredis   # 複数ワーカー構成でのみ使用（インストールされていない場合はLocalPubSubのみ使用可能）
+except ImportError:
+    aioredis = None
+
+
+# ロガー
+_LOGGER = logging.getLogger(__name__)
+_LOGGER.addHandler(logging.NullHandler())
+
+
+# チャネル名の接頭辞（Redisを他の用途と共用しても衝突しないようにする）
+CHANNEL_PREFIX = 'aic:'
+# ルーム一覧の変更を通知するチャネル
+ROOMS_CHANNEL = f'{CHANNEL_PREFIX}rooms'
+
+# イベント種別
+EventKind = typing.Literal[
+    'frame',         # メッセージフレーム（スナップショット・差分）。受信側はルームストアからメッセージDBを取り込んでから送信する
+    'stream',        # ストリームフレーム。受信側はそのまま送信する
+    'stop',          # 議論の強制停止
+    'room_deleted',  # ルームの削除
+]
+
+# イベントを受け取る関数の型（引数はチャネル名とイベントの文字列）
+EventHandler = Callable[[str, str], None]
+
+
+def room_channel(room_id: int) -> str:
+    """ルームのイベントを通知するチャネル名を取得する。
+
+    Args:
+        room_id (int): ルームID。
+
+    Returns:
+        str: チャネル名。
+    """
+    return f'{CHANNEL_PREFIX}room:{room_id}'
+
+
+def parse_room_channel(channel: str) -> int | None:
+    """チャネル名からルームIDを取り出す。
+
+    Args:
+        channel (str): チャネル名。
+
+    Returns:
+        int | None: ルームID。ルームのチャネルでない場合はNone。
+    """
+    prefix = f'{CHANNEL_PREFIX}room:'
+    if not channel.startswith(prefix):
+        return None
+    return int(channel[len(prefix):])
+
+
+def encode_event(kind: EventKind, payload: str) -> str:
+    """イベントを文字列にする。
+
+    フレームのJSON文字列をそのまま運べるよう、JSONで包み直さずに種別と本体を改行で連結する。
+
+    Args:
+        kind (EventKind): イベント種別。
+        payload (str): イベントの本体。
+
+    Returns:
+        str: イベントの文字列。
+    """
+    return f'{kind}\n{payload}'
+
+
+def decode_event(data: str) -> tuple[str, str]:
+    """イベントの文字列を種別と本体に分ける。
+
+    Args:
+        data (str): イベントの文字列。
+
+    Returns:
+        tuple[str, str]: イベント種別とイベントの本体。
+    """
+    kind, _, payload = data.partition('\n')
+    return kind, payload
+
+
+@typing.runtime_checkable
+class BasePubSub(typing.Protocol):
+    """ルームのイベントを配信するPub/Subの抽象クラス。
+
+    ブロードキャストするフレームや議論の停止などのイベントをチャネルに発行し、購読しているすべてのワーカーに配信する。
+    各ワーカーは受け取ったイベントを、自身が保持しているWebソケット接続に送信する。
+
+    Attributes:
+        is_shared (bool): 複数プロセスで共有するPub/Subかどうか。
+            Trueの場合、ルームの状態は他のワーカーからも更新されるため、ルームストアから取り込み直す必要がある。
+    """
+    is_shared: bool
+
+    async def start(self, handler: EventHandler):
+        """イベントの購読を開始する。
+
+        Args:
+            handler (EventHandler): イベントを受け取る関数。
+        """
+        ...
+
+    async def publish(self, channel: str, data: str):
+        """イベントを発行する。
+
+        Args:
+            channel (str): チャネル名。
+            data (str): イベントの文字列。
+        """
+        ...
+
+    async def aclose(self):
+        """購読を終了し、接続を閉じる。"""
+        ...
+
+
+class LocalPubSub(BasePubSub):
+    """プロセス内で完結するPub/Sub。
+
+    発行したイベントをその場で購読側の関数に渡す。単一ワーカー構成で使用する。
+    """
+    is_shared = False
+
+    def __init__(self):
+        """コンストラクタ。"""
+        self.handler: EventHandler | None = None
+
+    async def start(self, handler: EventHandler):
+        """BasePubSub.startを参照。"""
+        self.handler = handler
+
+    async def publish(self, channel: str, data: str):
+        """BasePubSub.publishを参照。"""
+        if self.handler is not None:
+            self.handler(channel, data)
+
+    async def aclose(self):
+        """BasePubSub.acloseを参照。"""
+        self.handler = None
+
+
+class RedisPubSub(BasePubSub):
+    """Redis互換サーバを介したPub/Sub。
+
+    複数ワーカー構成で使用する。Redisのほか、ValkeyやKeyDBなどRedis互換のサーバであれば動作する。
+    接続先は`redis://host:port`のほか、`unix:///path/to/redis.sock`形式でUnixソケットも指定できる。
+    """
+    is_shared = True
+
+    def __init__(self, url: str):
+        """コンストラクタ。
+
+        Args:
+            url (str): Redis互換サーバの接続先URL。
+        """
+        if aioredis is None:
+            raise ImportError('RedisPubSubを使用するにはredisパッケージをインストールしてください')
+        self.url = url
+        self._redis = aioredis.from_url(url, decode_responses=True)
+        self._pubsub = None
+        self._listener_task: asyncio.Task | None = None
+
+    async def start(self, handler: EventHandler):
+        """BasePubSub.startを参照。"""
+        self._pubsub = self._redis.pubsub()
+        await self._pubsub.psubscribe(f'{CHANNEL_PREFIX}*')
+        self._listener_task = asyncio.create_task(self._listen(handler))
+        _LOGGER.info(f"pubsub subscribed: {self.url}")
+
+    async def _listen(self, handler: EventHandler):
+        """購読しているチャネルのイベントを受け取り、handlerに渡し続ける。
+
+        Args:
+            handler (EventHandler): イベントを受け取る関数。
+        """
+        async for message in self._pubsub.listen():
+            if message['type'] != 'pmessage':
+                continue
+            try:
+                handler(message['channel'], message['data'])
+            except Exception:
+                _LOGGER.exception(f"pubsub handler error happened. channel={message['channel']}")
+
+    async def publish(self, channel: str, data: str):
+        """BasePubSub.publishを参照。"""
+        await self._redis.publish(channel, data)
+
+    async def aclose(self):
+        """BasePubSub.acloseを参照。"""
+        if self._listener_task is not None:
+            self._listener_task.cancel()
+            self._listener_task = None
+        if self._pubsub is not None:
+            await self._pubsub.aclose()
+            self._pubsub = None
+        await self._redis.aclose()
+
+
+def create_pubsub() -> BasePubSub:
+    """環境変数の設定に従ってPub/Subを生成する。
+
+    環境変数PUBSUB_URLが設定されている場合はRedisPubSubを、設定されていない場合はLocalPubSubを生成する。
+
+    Returns:
+        BasePubSub: Pub/Sub。
+    """
+    url = os.getenv('PUBSUB_URL')
+    if url:
+        return RedisPubSub(url)
+    return LocalPubSub()
@@ -0,0 +1,180 @@
+import asyncio
+import json
+import logging
+import os
+import pathlib
+import tempfile
+import typing
+from ai_constellation.common.utils import json_dumps
+if typing.TYPE_CHECKING:
+    from connection_manager import ConnectionManager
+
+
+# ロガー
+_LOGGER = logging.getLogger(__name__)
+_LOGGER.addHandler(logging.NullHandler())
+
+
+# 退避先のディレクトリ、アイドル判定までの秒数、アイドル判定の間隔の既定値（環境変数で変更可能）
+DEFAULT_ROOM_SPILL_DIR = './data/rooms/'
+DEFAULT_ROOM_IDLE_TIMEOUT = 60 * 30  # 30分
+DEFAULT_ROOM_SWEEP_INTERVAL = 60
+
+
+class RoomLifecycleManager:
+    """ルームのライフサイクル管理用モジュール。
+
+    ルームごとの最終アクティビティ日時とメモリ使用量を集計し、一定時間アイドルだったルームの重い状態を解放する。
+    アイドルなルームとは、Webソケットの接続がなく、議論を実行していないルームを指す。
+
+    解放するのはConnectionManagerごとで、メッセージDBはルームストアに永続化済みのため、次にアクセスされた時に復元される。
+    ファシリテータ（パネリストのメッセージログや議論ログ）はルームストアに保存されないため、ディスクに退避して復元時に読み込み直す。
+    これにより、解放したルームでも追加議論を続けられる。
+    """
+
+    def __init__(
+        self,
+        spill_dir: str = DEFAULT_ROOM_SPILL_DIR,
+        idle_timeout: float | None = DEFAULT_ROOM_IDLE_TIMEOUT,
+        sweep_interval: float = DEFAULT_ROOM_SWEEP_INTERVAL
+    ):
+        """コンストラクタ。
+
+        Args:
+            spill_dir (str): ファシリテータの状態を退避するディレクトリ。
+            idle_timeout (float | None): 最後のアクティビティからこの秒数が経過したアイドルなルームを解放する。Noneの場合は解放しない。
+            sweep_interval (float): アイドルなルームを確認する間隔(秒)。
+        """
+        self.spill_dir = pathlib.Path(spill_dir)
+        self.idle_timeout = idle_timeout
+        self.sweep_interval = sweep_interval
+        self.num_evictions = 0
+        self._sweep_task: asyncio.Task | None = None
+
+    def start(self, sweep: typing.Callable[[], None]):
+        """アイドルなルームの定期的な確認を開始する。
+
+        Args:
+            sweep (Callable[[], None]): アイドルなルームを確認して解放する関数。
+        """
+        if self.idle_timeout is None:
+            return
+        self._sweep_task = asyncio.create_task(self._sweep_loop(sweep))
+
+    async def _sweep_loop(self, sweep: typing.Callable[[], None]):
+        """sweep_intervalごとにsweepを呼び出し続ける。
+
+        Args:
+            sweep (Callable[[], None]): アイドルなルームを確認して解放する関数。
+        """
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            try:
+                sweep()
+            except Exception:
+                _LOGGER.exception("room sweep error happened.")
+
+    def stop(self):
+        """アイドルなルームの定期的な確認を終了する。"""
+        if self._sweep_task is not None:
+            self._sweep_task.cancel()
+            self._sweep_task = None
+
+    def should_evict(self, connection_manager: 'ConnectionManager') -> bool:
+        """ルームを解放するかを判定する。
+
+        Args:
+            connection_manager (ConnectionManager): ルームのConnectionManager。
+
+        Returns:
+            bool: アイドルなまま最後のアクティビティからidle_timeout秒が経過していればTrue。
+        """
+        return (
+            self.idle_timeout is not None
+            and connection_manager.is_idle()
+            and connection_manager.get_idle_seconds() >= self.idle_timeout
+        )
+
+    def evict(self, room_id: int, connection_manager: 'ConnectionManager'):
+        """ルームのファシリテータの状態をディスクに退避する。
+
+        呼び出し元は、退避後にConnectionManagerへの参照を破棄する。
+        ファシリテータがない（議論をしていない）ルームは退避するものがないため、何も書き込まない。
+
+        Args:
+            room_id (int): ルームID。
+            connection_manager (ConnectionManager): ルームのConnectionManager。
+        """
+        state = connection_manager.get_evictable_state()
+        if state is not None:
+            self.spill_dir.mkdir(parents=True, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=self.spill_dir, suffix='.tmp')
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                f.write(json_dumps(state))
+            os.replace(tmp_path, self._get_spill_path(room_id))
+        self.num_evictions += 1
+        _LOGGER.info(f"room evicted: room_id={room_id}, spilled={state is not None}")
+
+    def restore(self, room_id: int, connection_manager: 'ConnectionManager'):
+        """ディスクに退避したファシリテータの状態を、生成し直したConnectionManagerに復元する。
+
+        Args:
+            room_id (int): ルームID。
+            connection_manager (ConnectionManager): 生成し直したルームのConnectionManager。
+        """
+        path = self._get_spill_path(room_id)
+        try:
+            with path.open('r', encoding='utf-8') as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return
+        connection_manager.restore_evicted_state(state)
+        path.unlink(missing_ok=True)
+        _LOGGER.info(f"room restored from spill: room_id={room_id}")
+
+    def discard(self, room_id: int):
+        """削除したルームの退避ファイルを削除する。
+
+        Args:
+            room_id (int): ルームID。
+        """
+        self._get_spill_path(room_id).unlink(missing_ok=True)
+
+    def is_spilled(self, room_id: int) -> bool:
+        """ルームのファシリテータの状態がディスクに退避されているかを判定する。
+
+        Args:
+            room_id (int): ルームID。
+
+        Returns:
+            bool: 退避されていればTrue。
+        """
+        return self._get_spill_path(room_id).exists()
+
+    def _get_spill_path(self, room_id: int) -> pathlib.Path:
+        """退避ファイルのパスを取得する。
+
+        Args:
+            room_id (int): ルームID。
+
+        Returns:
+            pathlib.Path: 退避ファイルのパス。
+        """
+        return self.spill_dir / f'{room_id}.json'
+
+
+def create_room_lifecycle_manager() -> RoomLifecycleManager:
+    """環境変数の設定に従ってルームのライフサイクル管理用モジュールを生成する。
+
+    環境変数ROOM_SPILL_DIR、ROOM_IDLE_TIMEOUT、ROOM_SWEEP_INTERVALの設定に従う。
+    ROOM_IDLE_TIMEOUTが0の場合は、ルームを解放しない。
+
+    Returns:
+        RoomLifecycleManager: ルームのライフサイクル管理用モジュール。
+    """
+    idle_timeout = float(os.getenv('ROOM_IDLE_TIMEOUT', DEFAULT_ROOM_IDLE_TIMEOUT))
+    return RoomLifecycleManager(
+        spill_dir=os.getenv('ROOM_SPILL_DIR', DEFAULT_ROOM_SPILL_DIR),
+        idle_timeout=idle_timeout if idle_timeout > 0 else None,
+        sweep_interval=float(os.getenv('ROOM_SWEEP_INTERVAL', DEFAULT_ROOM_SWEEP_INTERVAL)),
+    )
@@ -1,9 +1,14 @@
+import asyncio
+import bisect
 import dataclasses
 import logging
 from typing import Tuple
 from datetime import datetime, timedelta
 from ai_constellation.common.utils import Mappable
 from connection_manager import ConnectionManager
+from room_store import BaseRoomStore, MemoryRoomStore, create_room_store
+from room_lifecycle import RoomLifecycleManager, create_room_lifecycle_manager
+from pubsub import BasePubSub, ROOMS_CHANNEL, create_pubsub, decode_event, encode_event, parse_room_channel
 
 
 # ロガー
@@ -16,6 +21,8 @@ class Room(Mappable):
     """ルーム。
 
     ルームIDやルーム名など、ルームの情報を保持する。
+    ConnectionManagerは最初にアクセスされた時に生成する（ルームストアから復元したルームの場合はメッセージDBもその時に復元する）。
+    アイドルなルームのConnectionManagerは解放し、次にアクセスされた時に生成し直す。
     """
     room_id: int = -1
     room_name: str = ''
@@ -23,47 +30,258 @@ class Room(Mappable):
     connection_manager: ConnectionManager = None
 
 
-# ルームID初期値
-DEFAULT_ROOM_ID = 1
-
-
 class RoomManager:
     """ルーム管理用モジュール。
 
     ルームDBを保持し、その中にConnectionManagerを含む情報を格納する。
     ルームDBを操作する機能を外部に提供する。
+    ルームDBはルームIDをキーとした辞書で、ルーム名と作成日時の索引も合わせて保持する。
+    ルームIDはルームストアが単調増加で払い出し、削除されたルームのIDは再利用しない。
+    ルームDBはルームストアに永続化し、起動時にはルームストアからルームの一覧を復元する。
+
+    Pub/Subを購読し、受け取ったルームのイベントをこのワーカーのConnectionManagerに振り分ける。
+    複数ワーカー構成（共有のPub/Sub）では、他のワーカーで作成・削除されたルームをルームストアから取り込む。
+
+    一定時間アイドルなルームは、ライフサイクル管理用モジュールでConnectionManagerごと解放し、メモリ使用量を抑える。
+
+    ルームDBと索引はロックで保護していないため、すべてのメソッドはイベントループのスレッドから呼び出す（同期のエンドポイントから呼び出さない）。
+    ルームストアの読み書きと、ルームストアから復元するConnectionManagerの生成は、イベントループを止めないようにasyncio.to_threadで行う。
+    ただし、生成時（アプリケーションの起動前）のルームの復元と初期状態のルームの作成は直接行う。
 
     Attributes:
         config_dir (str): 設定ファイルのディレクトリ。
     """
     config_dir = "./configs/"
 
-    def __init__(self):
+    def __init__(
+        self,
+        room_store: BaseRoomStore | None = None,
+        pubsub: BasePubSub | None = None,
+        lifecycle: RoomLifecycleManager | None = None
+    ):
         """コンストラクタ
 
         ルームDBを初期化する。
         ルームDBは辞書型であり、keyとしてルームID、valueとしてRoomインスタンスを格納する。
+        ルームストアにルームが保存されている場合は、それらをルームDBに復元する。
+
+        Args:
+            room_store (BaseRoomStore | None): ルームストア。Noneの場合は環境変数の設定に従って生成する。
+            pubsub (BasePubSub | None): Pub/Sub。Noneの場合は環境変数の設定に従って生成する。
+            lifecycle (RoomLifecycleManager | None): ライフサイクル管理用モジュール。Noneの場合は環境変数の設定に従って生成する。
         """
-        # ルームDB
+        # ルームストア
+        self.room_store = room_store if room_store is not None else create_room_store()
+        # Pub/Sub
+        self.pubsub = pubsub if pubsub is not None else create_pubsub()
+        if self.pubsub.is_shared and isinstance(self.room_store, MemoryRoomStore):
+            raise ValueError('複数ワーカー構成では、ワーカー間で共有できるルームストアを使用してください')
+        # ライフサイクル管理用モジュール
+        self.lifecycle = lifecycle if lifecycle is not None else create_room_lifecycle_manager()
+        # ルームDBと索引
         self.room_db: dict[int, Room] = {}
-        # 初期状態でルームを1件加えておく
-        self.create_room("Room 1")
+        self.room_ids_by_name: dict[str, set[int]] = {}    # ルーム名からルームIDをひくための索引
+        self.room_order: list[tuple[datetime, int]] = []   # 作成日時順に並べたルーム（ページングに使用）
+        for room_id, room_name, created_at in self.room_store.load_rooms():
+            self._add_room(Room(room_id=room_id, room_name=room_name, created_at=created_at))
+        _LOGGER.info(f"rooms restored: {len(self.room_db)} rooms")
+        # ルームが1件もない場合は、初期状態でルームを1件加えておく
+        if len(self.room_db) == 0:
+            self._create_first_room("Room 1")
+
+    def _create_first_room(self, room_name: str):
+        """初期状態のルームを作成する。
+
+        複数ワーカーが同時に起動した場合に各ワーカーがルームを作成しないよう、ルームストアでルームがない場合に限って保存する。
+        他のワーカーが先に作成していた場合は、そのルームをルームストアから取り込む。
+
+        Args:
+            room_name (str): ルーム名。
+        """
+        created_at = datetime.now() + timedelta(hours=9)
+        room_id = self.room_store.save_first_room(room_name, created_at)
+        if room_id is None:
+            for stored_room_id, stored_room_name, stored_created_at in self.room_store.load_rooms():
+                self._add_room(Room(room_id=stored_room_id, room_name=stored_room_name, created_at=stored_created_at))
+            return
+        # 永続化しないルームストアでは再起動後に同じルームIDを払い出すため、以前のプロセスで退避した状態が残っていれば削除
+        self.lifecycle.discard(room_id)
+        created_room = Room(room_id=room_id, room_name=room_name, created_at=created_at)
+        self._add_room(created_room)
+        _LOGGER.info(f"room created: {created_room}")
+
+    async def start(self):
+        """Pub/Subの購読と、アイドルなルームの定期的な解放を開始する。アプリケーションの起動時に呼び出す。"""
+        await self.pubsub.start(self.handle_event)
+        self.lifecycle.start(self.evict_idle_rooms)
+
+    async def aclose(self):
+        """Pub/Subの購読と、アイドルなルームの定期的な解放を終了する。アプリケーションの終了時に呼び出す。"""
+        self.lifecycle.stop()
+        await self.pubsub.aclose()
+
+    def evict_idle_rooms(self):
+        """一定時間アイドルなルームのConnectionManagerを解放する。
+
+        議論用のモジュールの状態はディスクに退避し、次にアクセスされた時に復元する。
+        """
+        for room in list(self.room_db.values()):
+            if room.connection_manager is not None and self.lifecycle.should_evict(room.connection_manager):
+                self.lifecycle.evict(room.room_id, room.connection_manager)
+                room.connection_manager = None
+
+    def get_room_stats(self) -> dict:
+        """ルームごとの利用状況と、その合計を取得する。
+
+        Returns:
+            dict: ルームごとの利用状況のリストと、ConnectionManagerを生成済みのルーム数、メモリ使用量の概算の合計など。
+        """
+        rooms = []
+        for room_id, room in list(self.room_db.items()):
+            if room.connection_manager is not None:
+                stats = room.connection_manager.get_stats()
+            else:
+                stats = {'room_id': room_id, 'loaded': False}
+            stats['spilled'] = self.lifecycle.is_spilled(room_id)
+            rooms.append(stats)
+        return {
+            'num_rooms': len(rooms),
+            'num_loaded_rooms': sum(stats['loaded'] for stats in rooms),
+            'num_evictions': self.lifecycle.num_evictions,
+            'idle_timeout': self.lifecycle.idle_timeout,
+            'total_memory_chars': sum(stats.get('memory_chars', 0) for stats in rooms),
+            'rooms': rooms,
+        }
+
+    def handle_event(self, channel: str, data: str):
+        """Pub/Subから受け取ったイベントを処理する。
+
+        ルームのイベントは、このワーカーで生成済みのConnectionManagerに渡す。
+        未生成の場合は、このワーカーに接続しているクライアントがいないため何もしない。
+
+        Args:
+            channel (str): チャネル名。
+            data (str): イベントの文字列。
+        """
+        kind, payload = decode_event(data)
+        if channel == ROOMS_CHANNEL:
+            if kind == 'room_deleted':
+                deleted_room = self._remove_room(int(payload))
+                # 削除されたルームの議論をこのワーカーで実行している場合は止める
+                if deleted_room is not None and deleted_room.connection_manager is not None:
+                    deleted_room.connection_manager.cancel_discussion()
+            return
+        room_id = parse_room_channel(channel)
+        room = self.room_db.get(room_id)
+        if room is None or room.connection_manager is None:
+            return
+        room.connection_manager.handle_event(kind, payload)
+
+    async def sync_rooms(self):
+        """他のワーカーで作成・削除されたルームを、ルームストアから取り込む。
+
+        単一ワーカー構成ではメモリ上のルームDBが常に最新のため、何もしない。
+        """
+        if not self.pubsub.is_shared:
+            return
+        known_room_ids = set(self.room_db.keys())  # 読み込みを待つ間にこのワーカーで作成されたルームは削除しない
+        stored_rooms = await asyncio.to_thread(self.room_store.load_rooms)
+        stored_room_ids = {room_id for room_id, _, _ in stored_rooms}
+        for room_id in known_room_ids:
+            if room_id not in stored_room_ids:
+                self._remove_room(room_id)
+        for room_id, room_name, created_at in stored_rooms:
+            if room_id not in self.room_db:
+                self._add_room(Room(room_id=room_id, room_name=room_name, created_at=created_at))
+
+    def _add_room(self, room: Room):
+        """ルームDBと索引にルームを追加する。
+
+        Args:
+            room (Room): ルーム。
+        """
+        self.room_db[room.room_id] = room
+        self.room_ids_by_name.setdefault(room.room_name, set()).add(room.room_id)
+        bisect.insort(self.room_order, (room.created_at, room.room_id))
+
+    def _remove_room(self, room_id: int) -> Room | None:
+        """ルームDBと索引からルームを削除する。
+
+        Args:
+            room_id (int): ルームID。
+
+        Returns:
+            Room | None: 削除したルーム。ルームが存在しない場合はNone。
+        """
+        room = self.room_db.pop(room_id, None)
+        if room is None:
+            return None
+        room_ids = self.room_ids_by_name.get(room.room_name)
+        if room_ids is not None:
+            room_ids.discard(room_id)
+            if not room_ids:
+                del self.room_ids_by_name[room.room_name]
+        i = bisect.bisect_left(self.room_order, (room.created_at, room_id))
+        if i < len(self.room_order) and self.room_order[i] == (room.created_at, room_id):
+            del self.room_order[i]
+        return room
 
-    def get_rooms(self) -> dict[int, Room]:
+    async def get_rooms(
+        self,
+        offset: int = 0,
+        limit: int | None = None,
+        room_name: str | None = None
+    ) -> dict[int, Room]:
         """ルーム一覧を取得。
 
         ルームは呼び出し元での変更を考慮してディープコピーとして返却する。
+        作成日時順に並べ、offset件目からlimit件を返却する。
+
+        Args:
+            offset (int): 返却する先頭のルームの位置。
+            limit (int | None): 返却するルーム数の上限。Noneの場合は末尾まで返却する。
+            room_name (str | None): 指定した場合は、このルーム名のルームだけを返却する。
 
         Returns:
             dict[int, Room]: ルーム一覧。
         """
+        await self.sync_rooms()
+        stop = None if limit is None else offset + limit
+        room_ids = self._get_ordered_room_ids(room_name)[offset:stop]
         return {room_id: {
-            "room_id": room.room_id,
-            "room_name": room.room_name,
-            "created_at": room.created_at
-        } for room_id, room in self.room_db.items()}
+            "room_id": self.room_db[room_id].room_id,
+            "room_name": self.room_db[room_id].room_name,
+            "created_at": self.room_db[room_id].created_at
+        } for room_id in room_ids}
+
+    def count_rooms(self, room_name: str | None = None) -> int:
+        """ルームDBのルーム数を取得する。他のワーカーの更新は取り込まないため、get_roomsの後に呼び出す。
+
+        Args:
+            room_name (str | None): 指定した場合は、このルーム名のルームだけを数える。
+
+        Returns:
+            int: ルーム数。
+        """
+        if room_name is None:
+            return len(self.room_db)
+        return len(self.room_ids_by_name.get(room_name, ()))
+
+    def _get_ordered_room_ids(self, room_name: str | None) -> list[int]:
+        """作成日時順に並べたルームIDのリストを取得する。
 
-    def create_room(self, room_name: str) -> Room:
+        Args:
+            room_name (str | None): 指定した場合は、このルーム名のルームだけを対象とする。
+
+        Returns:
+            list[int]: ルームIDのリスト。
+        """
+        if room_name is None:
+            return [room_id for _, room_id in self.room_order]
+        room_ids = self.room_ids_by_name.get(room_name, ())
+        return sorted(room_ids, key=lambda room_id: (self.room_db[room_id].created_at, room_id))
+
+    async def create_room(self, room_name: str) -> Room:
         """ルーム作成。
 
         与えられたルーム名でルームを新規作成する。
@@ -75,8 +293,8 @@ class RoomManager:
         Returns:
             Room: 新規作成したルーム。
         """
-        # ルームID
-        room_id = DEFAULT_ROOM_ID if len(self.room_db) == 0 else max(self.room_db.keys()) + 1
+        # ルームID（ルームストアで払い出し、他のワーカーで作成したルームとも重複しない）
+        room_id = await asyncio.to_thread(self.room_store.allocate_room_id)
         # 作成日時
         created_at = datetime.now() + timedelta(hours=9)
         # 新規ルーム作成
@@ -84,30 +302,43 @@ class RoomManager:
             room_id=room_id,
             room_name=room_name,
             created_at=created_at,
-            connection_manager=ConnectionManager()
+            connection_manager=await asyncio.to_thread(ConnectionManager, room_id, self.room_store, self.pubsub)
         )
-        # ルームDBに新規ルーム追加
-        self.room_db[room_id] = created_room
+        # 永続化しないルームストアでは再起動後に同じルームIDを払い出すため、以前のプロセスで退避した状態が残っていれば削除
+        self.lifecycle.discard(room_id)
+        # ルームストアに保存してから、ルームDBに新規ルーム追加
+        await asyncio.to_thread(self.room_store.save_room, room_id, room_name, created_at)
+        self._add_room(created_room)
         _LOGGER.info(f"room created: {created_room}")
         return created_room
 
-    def delete_room(self, room_id: int) -> Room | None:
+    async def delete_room(self, room_id: int) -> Room | None:
         """ルーム削除。
 
         与えられたルームIDでルームDBからルームを削除する。
+        実行中の議論はキャンセルし、Webソケット接続は閉じる。
+        他のワーカーにもルームの削除を通知する。
 
         Returns:
             Room | None: 削除したルーム。ルームが存在しない場合はNone。
         """
+        # ルームIDがルームDB内に存在するかチェック（存在しない場合は、他のワーカーで作成されていないか確認）
+        if room_id not in self.room_db:
+            await self.sync_rooms()
         if room_id not in self.room_db:
             _LOGGER.error(f"room not deleted: room id `{room_id}` not found.")
             return None
         # 対象ルームを削除してDBを更新
-        deleted_room = self.room_db.pop(room_id)
+        deleted_room = self._remove_room(room_id)
+        if deleted_room.connection_manager is not None:
+            await deleted_room.connection_manager.close()
+        self.lifecycle.discard(room_id)
+        await asyncio.to_thread(self.room_store.delete_room, room_id)
+        await self.pubsub.publish(ROOMS_CHANNEL, encode_event('room_deleted', str(room_id)))
         _LOGGER.info(f"room deleted: {deleted_room}")
         return deleted_room
 
-    def try_get_connection_manager_by_room_id(self, room_id: int) -> Tuple[ConnectionManager | None, bool]:
+    async def try_get_connection_manager_by_room_id(self, room_id: int) -> Tuple[ConnectionManager | None, bool]:
         """ConnectionManagerを取得する。
 
         Args:
@@ -116,14 +347,24 @@ class RoomManager:
         Returns:
             Tuple[ConnectionManager | None, bool]: ConnectionManagerと取得成否。
         """
-        # ルームIDがルームDB内に存在するかチェック
+        # ルームIDがルームDB内に存在するかチェック（存在しない場合は、他のワーカーで作成されていないか確認）
+        if room_id not in self.room_db:
+            await self.sync_rooms()
         if room_id not in self.room_db:
             return (None, False)
-        # ConnectionManagerを取得して返却
-        connection_manager = self.room_db[room_id].connection_manager
-        return (connection_manager, True)
+        # ConnectionManagerを取得して返却（未生成・解放済みの場合はルームストアと退避した状態から復元して生成）
+        room = self.room_db[room_id]
+        if room.connection_manager is None:
+            connection_manager = await asyncio.to_thread(ConnectionManager, room_id, self.room_store, self.pubsub)
+            # 生成を待つ間にルームが削除された場合や、他のリクエストが先に生成した場合はそちらに従う
+            if self.room_db.get(room_id) is not room:
+                return (None, False)
+            if room.connection_manager is None:
+                room.connection_manager = connection_manager
+                self.lifecycle.restore(room_id, room.connection_manager)
+        return (room.connection_manager, True)
 
-    def try_get_connection_manager_by_post_data(
+    async def try_get_connection_manager_by_post_data(
         self,
         post_body: dict
     ) -> Tuple[ConnectionManager | None, int | None, bool]:
@@ -140,5 +381,5 @@ class RoomManager:
             return (None, None, False)
         # ConnectionManagerを取得して返却
         room_id = int(post_body['room_id'])
-        (connection_manager, exist) = self.try_get_connection_manager_by_room_id(room_id)
+        (connection_manager, exist) = await self.try_get_connection_manager_by_room_id(room_id)
         return (connection_manager, room_id, exist)
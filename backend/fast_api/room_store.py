@@ -0,0 +1,374 @@
+import contextlib
+import logging
+import os
+import pathlib
+import sqlite3
+import threading
+import typing
+from datetime import datetime
+
+
+# ロガー
+_LOGGER = logging.getLogger(__name__)
+_LOGGER.addHandler(logging.NullHandler())
+
+
+# ルームストアの種類とSQLiteのファイルパスの既定値（環境変数で変更可能）
+DEFAULT_ROOM_STORE = 'sqlite'
+DEFAULT_ROOM_STORE_PATH = './data/rooms.sqlite3'
+
+
+class StoredMessages(typing.NamedTuple):
+    """ルームストアから読み込んだメッセージDB。
+
+    Attributes:
+        epoch (str): メッセージDBの世代番号。
+        messages (list[str]): メッセージのJSON文字列のリスト。シーケンス番号順。
+        accessible_index (int): 閲覧可能なメッセージの終端のインデックス。
+    """
+    epoch: str
+    messages: list[str]
+    accessible_index: int
+
+
+@typing.runtime_checkable
+class BaseRoomStore(typing.Protocol):
+    """ルームストアの抽象クラス。
+
+    ルームの一覧と、ルームごとのメッセージDBを永続化する。
+    メッセージは追記のみで書き込み、閲覧可能なメッセージはインデックス（カーソル）の更新だけで表す。
+    """
+
+    def load_rooms(self) -> list[tuple[int, str, datetime]]:
+        """ルームの一覧を読み込む。
+
+        Returns:
+            list[tuple[int, str, datetime]]: ルームID、ルーム名、作成日時の組のリスト。ルームID順。
+        """
+        ...
+
+    def allocate_room_id(self) -> int:
+        """新しいルームIDを払い出す。
+
+        ルームIDは単調増加で、削除されたルームのIDも再利用しない（古い接続が別のルームにつながらないようにする）。
+        払い出し済みの最大値はルームと一緒に永続化する。
+
+        Returns:
+            int: ルームID。
+        """
+        ...
+
+    def save_first_room(self, room_name: str, created_at: datetime) -> int | None:
+        """ルームが1件もない場合に限り、ルームIDを払い出してルームを保存する。
+
+        初期状態のルームの作成に使用する。
+        複数ワーカーが同時に起動しても、作成されるルームは1件だけになるよう、確認と保存を不可分に行う。
+
+        Args:
+            room_name (str): ルーム名。
+            created_at (datetime): 作成日時。
+
+        Returns:
+            int | None: 保存したルームのルームID。すでにルームがあり保存しなかった場合はNone。
+        """
+        ...
+
+    def save_room(self, room_id: int, room_name: str, created_at: datetime):
+        """ルームを保存する。
+
+        Args:
+            room_id (int): ルームID。
+            room_name (str): ルーム名。
+            created_at (datetime): 作成日時。
+        """
+        ...
+
+    def delete_room(self, room_id: int):
+        """ルームとそのメッセージDBを削除する。
+
+        Args:
+            room_id (int): ルームID。
+        """
+        ...
+
+    def reset_messages(self, room_id: int, epoch: str):
+        """ルームのメッセージDBを空にし、世代番号を更新する。
+
+        Args:
+            room_id (int): ルームID。
+            epoch (str): 新しい世代番号。
+        """
+        ...
+
+    def append_message(self, room_id: int, seq: int, message_json: str):
+        """ルームのメッセージDBにメッセージを追記する。
+
+        Args:
+            room_id (int): ルームID。
+            seq (int): メッセージのシーケンス番号。
+            message_json (str): メッセージのJSON文字列。
+        """
+        ...
+
+    def set_accessible_index(self, room_id: int, accessible_index: int):
+        """ルームの閲覧可能なメッセージの終端のインデックスを更新する。
+
+        Args:
+            room_id (int): ルームID。
+            accessible_index (int): 閲覧可能なメッセージの終端のインデックス。
+        """
+        ...
+
+    def load_messages(self, room_id: int, start_seq: int = 0) -> StoredMessages | None:
+        """ルームのメッセージDBを読み込む。
+
+        start_seqを指定すると、それ以降のメッセージだけを読み込む（他のワーカーが追記した分の取り込み用）。
+
+        Args:
+            room_id (int): ルームID。
+            start_seq (int): 読み込むメッセージの先頭のシーケンス番号。
+
+        Returns:
+            StoredMessages | None: メッセージDB。保存されていない場合はNone。
+        """
+        ...
+
+
+class MemoryRoomStore(BaseRoomStore):
+    """永続化しないルームストア。
+
+    プロセスのメモリ上にのみ保持する。再起動するとすべて消える。
+    """
+
+    def __init__(self):
+        """コンストラクタ。"""
+        self.rooms: dict[int, tuple[int, str, datetime]] = {}
+        self.states: dict[int, StoredMessages] = {}
+        self.next_room_id = 1
+
+    def load_rooms(self) -> list[tuple[int, str, datetime]]:
+        """BaseRoomStore.load_roomsを参照。"""
+        return [self.rooms[room_id] for room_id in sorted(self.rooms)]
+
+    def allocate_room_id(self) -> int:
+        """BaseRoomStore.allocate_room_idを参照。"""
+        room_id = self.next_room_id
+        self.next_room_id += 1
+        return room_id
+
+    def save_first_room(self, room_name: str, created_at: datetime) -> int | None:
+        """BaseRoomStore.save_first_roomを参照。"""
+        if self.rooms:
+            return None
+        room_id = self.allocate_room_id()
+        self.save_room(room_id, room_name, created_at)
+        return room_id
+
+    def save_room(self, room_id: int, room_name: str, created_at: datetime):
+        """BaseRoomStore.save_roomを参照。"""
+        self.rooms[room_id] = (room_id, room_name, created_at)
+        self.next_room_id = max(self.next_room_id, room_id + 1)
+
+    def delete_room(self, room_id: int):
+        """BaseRoomStore.delete_roomを参照。"""
+        self.rooms.pop(room_id, None)
+        self.states.pop(room_id, None)
+
+    def reset_messages(self, room_id: int, epoch: str):
+        """BaseRoomStore.reset_messagesを参照。"""
+        self.states[room_id] = StoredMessages(epoch=epoch, messages=[], accessible_index=-1)
+
+    def append_message(self, room_id: int, seq: int, message_json: str):
+        """BaseRoomStore.append_messageを参照。"""
+        self.states[room_id].messages.append(message_json)
+
+    def set_accessible_index(self, room_id: int, accessible_index: int):
+        """BaseRoomStore.set_accessible_indexを参照。"""
+        self.states[room_id] = self.states[room_id]._replace(accessible_index=accessible_index)
+
+    def load_messages(self, room_id: int, start_seq: int = 0) -> StoredMessages | None:
+        """BaseRoomStore.load_messagesを参照。"""
+        state = self.states.get(room_id)
+        if state is None or start_seq == 0:
+            return state
+        return state._replace(messages=state.messages[start_seq:])
+
+
+class SQLiteRoomStore(BaseRoomStore):
+    """SQLiteで永続化するルームストア。
+
+    WALモードで動作させ、メッセージの追記やカーソルの更新を軽量に行う。
+    他のワーカーの書き込みを待つ間にイベントループを止めないよう、ConnectionManagerやRoomManagerは
+    asyncio.to_threadで別スレッドから呼び出すため、コネクションの利用はロックで直列化する。
+    複数ワーカー構成では、同じファイルを各ワーカーのプロセスから開いて共有する。
+    コネクションは自動コミットモードで開き、複数の文を実行するメソッドは_transactionで明示的にトランザクションを張る。
+    """
+
+    def __init__(self, path: str):
+        """コンストラクタ。
+
+        データベースファイルを開き、テーブルがなければ作成する。
+
+        Args:
+            path (str): データベースファイルまでのパス。
+        """
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = pathlib.Path(path)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.executescript('''
+            CREATE TABLE IF NOT EXISTS rooms (
+                room_id INTEGER PRIMARY KEY,
+                room_name TEXT NOT NULL,
+                created_at TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS room_states (
+                room_id INTEGER PRIMARY KEY,
+                epoch TEXT NOT NULL,
+                accessible_index INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS messages (
+                room_id INTEGER NOT NULL,
+                seq INTEGER NOT NULL,
+                body TEXT NOT NULL,
+                PRIMARY KEY (room_id, seq)
+            );
+            CREATE TABLE IF NOT EXISTS sequences (
+                name TEXT PRIMARY KEY,
+                value INTEGER NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS rooms_room_name ON rooms (room_name);
+            CREATE INDEX IF NOT EXISTS rooms_created_at ON rooms (created_at);
+        ''')
+        _LOGGER.info(f"room store opened: {self.path}")
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        """コネクションのロックを取り、書き込みロックを取ったトランザクションを張る。
+
+        ブロック内の文をまとめてコミットし、例外が発生した場合はロールバックする。
+
+        Yields:
+            sqlite3.Connection: コネクション。
+        """
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                yield self._conn
+            except BaseException:
+                self._conn.execute('ROLLBACK')
+                raise
+            self._conn.execute('COMMIT')
+
+    def load_rooms(self) -> list[tuple[int, str, datetime]]:
+        """BaseRoomStore.load_roomsを参照。"""
+        with self._lock:
+            rows = self._conn.execute('SELECT room_id, room_name, created_at FROM rooms ORDER BY room_id').fetchall()
+        return [(room_id, room_name, datetime.fromisoformat(created_at)) for room_id, room_name, created_at in rows]
+
+    def allocate_room_id(self) -> int:
+        """BaseRoomStore.allocate_room_idを参照。
+
+        払い出し済みの最大値をsequencesテーブルに保持し、書き込みロックを取ったトランザクションで更新するため、
+        複数ワーカーから同時に呼び出しても重複しない。
+        sequencesテーブルがない頃に作成したルームストアでは、既存のルームIDの最大値から払い出しを始める。
+        """
+        with self._transaction():
+            return self._increment_room_id()
+
+    def save_first_room(self, room_name: str, created_at: datetime) -> int | None:
+        """BaseRoomStore.save_first_roomを参照。
+
+        書き込みロックを取ったトランザクションの中で、ルームがないことの確認、ルームIDの払い出し、保存を行う。
+        """
+        with self._transaction():
+            if self._conn.execute('SELECT 1 FROM rooms LIMIT 1').fetchone() is not None:
+                return None
+            room_id = self._increment_room_id()
+            self._conn.execute(
+                'INSERT INTO rooms (room_id, room_name, created_at) VALUES (?, ?, ?)',
+                (room_id, room_name, created_at.isoformat()))
+        return room_id
+
+    def _increment_room_id(self) -> int:
+        """払い出し済みのルームIDの最大値を1つ進めて返す。書き込みロックを取ったトランザクションの中で呼び出す。
+
+        Returns:
+            int: ルームID。
+        """
+        self._conn.execute(
+            "INSERT OR IGNORE INTO sequences (name, value) "
+            "SELECT 'room_id', COALESCE(MAX(room_id), 0) FROM rooms")
+        self._conn.execute("UPDATE sequences SET value = value + 1 WHERE name = 'room_id'")
+        room_id, = self._conn.execute("SELECT value FROM sequences WHERE name = 'room_id'").fetchone()
+        return room_id
+
+    def save_room(self, room_id: int, room_name: str, created_at: datetime):
+        """BaseRoomStore.save_roomを参照。"""
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO rooms (room_id, room_name, created_at) VALUES (?, ?, ?)',
+                (room_id, room_name, created_at.isoformat()))
+
+    def delete_room(self, room_id: int):
+        """BaseRoomStore.delete_roomを参照。"""
+        with self._transaction():
+            self._conn.execute('DELETE FROM rooms WHERE room_id = ?', (room_id,))
+            self._conn.execute('DELETE FROM room_states WHERE room_id = ?', (room_id,))
+            self._conn.execute('DELETE FROM messages WHERE room_id = ?', (room_id,))
+
+    def reset_messages(self, room_id: int, epoch: str):
+        """BaseRoomStore.reset_messagesを参照。"""
+        with self._transaction():
+            self._conn.execute('DELETE FROM messages WHERE room_id = ?', (room_id,))
+            self._conn.execute(
+                'INSERT OR REPLACE INTO room_states (room_id, epoch, accessible_index) VALUES (?, ?, -1)',
+                (room_id, epoch))
+
+    def append_message(self, room_id: int, seq: int, message_json: str):
+        """BaseRoomStore.append_messageを参照。"""
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO messages (room_id, seq, body) VALUES (?, ?, ?)',
+                (room_id, seq, message_json))
+
+    def set_accessible_index(self, room_id: int, accessible_index: int):
+        """BaseRoomStore.set_accessible_indexを参照。"""
+        with self._lock:
+            self._conn.execute(
+                'UPDATE room_states SET accessible_index = ? WHERE room_id = ?',
+                (accessible_index, room_id))
+
+    def load_messages(self, room_id: int, start_seq: int = 0) -> StoredMessages | None:
+        """BaseRoomStore.load_messagesを参照。"""
+        with self._lock:
+            state = self._conn.execute(
+                'SELECT epoch, accessible_index FROM room_states WHERE room_id = ?', (room_id,)).fetchone()
+            if state is None:
+                return None
+            rows = self._conn.execute(
+                'SELECT body FROM messages WHERE room_id = ? AND seq >= ? ORDER BY seq', (room_id, start_seq)).fetchall()
+        epoch, accessible_index = state
+        return StoredMessages(epoch=epoch, messages=[body for body, in rows], accessible_index=accessible_index)
+
+
+def create_room_store() -> BaseRoomStore:
+    """環境変数の設定に従ってルームストアを生成する。
+
+    環境変数ROOM_STOREが`memory`の場合はMemoryRoomStoreを、`sqlite`の場合はSQLiteRoomStoreを生成する。
+    SQLiteのファイルパスは環境変数ROOM_STORE_PATHで指定する。
+
+    Returns:
+        BaseRoomStore: ルームストア。
+    """
+    store_type = os.getenv('ROOM_STORE', DEFAULT_ROOM_STORE)
+    if store_type == 'memory':
+        return MemoryRoomStore()
+    elif store_type == 'sqlite':
+        return SQLiteRoomStore(os.getenv('ROOM_STORE_PATH', DEFAULT_ROOM_STORE_PATH))
+    else:
+        raise ValueError(f'unknown ROOM_STORE: {store_type}')
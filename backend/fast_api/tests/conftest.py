@@ -0,0 +1,6 @@
+import pathlib
+import sys
+
+
+# テストからbackend/fast_api直下のモジュールをインポートできるようにする
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
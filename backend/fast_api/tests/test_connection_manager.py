@@ -0,0 +1,66 @@
+import asyncio
+import json
+
+from connection_manager import ConnectionManager, Message
+
+
+class RecordingChannel:
+    """送信したフレームを記録する送信チャネル。"""
+
+    def __init__(self):
+        """コンストラクタ。"""
+        self.frames: list[dict] = []
+
+    def send(self, text: str):
+        """フレームを記録する。
+
+        Args:
+            text (str): 送信するフレームのJSON文字列。
+        """
+        self.frames.append(json.loads(text))
+
+
+def apply_stream_frame(text: str, frame: dict) -> str:
+    """フロントエンドのapplyStreamFrameと同じく、オフセットが一致するストリームフレームだけを適用する。
+
+    Args:
+        text (str): 手元の生成中の発言の本文。
+        frame (dict): ストリームフレーム。
+
+    Returns:
+        str: フレーム適用後の本文。
+    """
+    if len(text.encode('utf-16-le')) // 2 != frame['offset']:
+        return text
+    return text + frame['delta']
+
+
+def test_stream_resumes_when_next_catches_up():
+    """「次へ（Next）」より先に届いた差分が、閲覧済みになった時点でまとめて送信され、以降の差分が続きとして適用できること。"""
+    async def scenario() -> list[dict]:
+        manager = ConnectionManager(room_id=1)
+        channel = RecordingChannel()
+        manager.channels[object()] = channel
+
+        # 1人目の発言が確定し、閲覧される前に2人目の発言の生成が始まる
+        await manager.push_message(Message(type='message', user_name='A', msg_text='最初の発言'))
+        await manager.push_message_delta('B', 'こんに')
+        await manager.push_message_delta('B', 'ちは😀')
+        assert channel.frames == []  # 未閲覧のメッセージがあるため、差分は送信しない
+
+        # 「次へ（Next）」で1人目の発言を閲覧可能にすると、2人目のそれまでの発言が送信される
+        await manager.add_accessible_message()
+        # 以降の差分は続きとして送信される
+        await manager.push_message_delta('B', '世界')
+        return channel.frames
+
+    frames = asyncio.run(scenario())
+
+    assert [frame['frame'] for frame in frames] == ['delta', 'stream', 'stream']
+    assert frames[0]['messages'][0]['msg_text'] == '最初の発言'
+    assert frames[1]['user_name'] == 'B'
+    assert frames[1]['offset'] == 0
+    text = ''
+    for frame in frames[1:]:
+        text = apply_stream_frame(text, frame)
+    assert text == 'こんにちは😀世界'
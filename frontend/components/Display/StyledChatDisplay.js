@@ -4,7 +4,7 @@ import StyledChatMessageInputBox from "../Chat/StyledChatMessageInputBox";
 import StyledChatMessageViewer from "../Chat/StyledChatMessageViewer";
 import StyledSettingAndPanelistContainer from "../SettingAndPanelist/StyledSettingAndPanelContainer";
 import useWebSocket from "../../hooks/useWebSocket";
-import useRequestNextMessage from "../../hooks/useRequestNextMessage";
+import useRequestNextMessage, { NEXT_MESSAGE_INTERVAL_MS } from "../../hooks/useRequestNextMessage";
 import useSendAdditionalMessage from "../../hooks/useSendAdditionalMessage";
 import { defaultDiscussionContext, DiscussionContext } from "../../contexts/DiscussionContext";
 import { useRouter } from "next/router"
@@ -73,7 +73,7 @@ export default function StyledChatDisplay({ roomId, chatRoomMode }) {
     // メッセージ入力ボックスを無効化
     setIsMessageBoxDisabled(true);
     // 次のデータをリクエスト
-    timerId = setInterval(() => requestNextMessage(roomId), 1000);  // 追加議論はキャッシュ非対応なので1000ミリ秒間隔
+    timerId = setInterval(() => requestNextMessage(roomId), NEXT_MESSAGE_INTERVAL_MS);  // 追加議論はキャッシュ非対応なので通常の間隔
   };
 
   /* メッセージが更新されたときの処理 */
@@ -4,7 +4,7 @@ import StyledHeader from "../StyledHeader";
 import StyledPanelistsDisplay from "./StyledPanelistsDisplay";
 import StyledSettingPanel from "./StyledSettingPanel";
 import useAgendaList from "../../hooks/useAgendaList";
-import useRequestNextMessage from "../../hooks/useRequestNextMessage";
+import useRequestNextMessage, { NEXT_MESSAGE_INTERVAL_MS, CACHED_NEXT_MESSAGE_INTERVAL_MS } from "../../hooks/useRequestNextMessage";
 import useConfigList from "../../hooks/useConfigList";
 import useStartDiscussion from "../../hooks/useStartDiscussion";
 import { DiscussionContext } from "../../contexts/DiscussionContext";
@@ -111,7 +111,7 @@ export default function StyledSettingAndPanelistContainer({
     if (autoRequestNextMessage) {
       timerId = setInterval(
         () => requestNextMessage(roomId),
-        existCache ? 3000 : 1000
+        existCache ? CACHED_NEXT_MESSAGE_INTERVAL_MS : NEXT_MESSAGE_INTERVAL_MS
       );
     } else {
       requestNextMessage(roomId);
@@ -1,5 +1,20 @@
 import { useCallback, useState } from 'react';
 
+/**
+ * 次のメッセージ要求の間隔(ミリ秒) \
+ * 議論の表示のペースを決める。サーバはメッセージの生成を表示のペースに合わせて待たないため、ここで調整する。 \
+ * 環境変数`NEXT_PUBLIC_NEXT_MESSAGE_INTERVAL_MS`で変更可能。
+ * @type {number}
+ */
+export const NEXT_MESSAGE_INTERVAL_MS = Number(process.env.NEXT_PUBLIC_NEXT_MESSAGE_INTERVAL_MS ?? 1000);
+
+/**
+ * キャッシュを再生する議論での、次のメッセージ要求の間隔(ミリ秒) \
+ * 環境変数`NEXT_PUBLIC_CACHED_NEXT_MESSAGE_INTERVAL_MS`で変更可能。
+ * @type {number}
+ */
+export const CACHED_NEXT_MESSAGE_INTERVAL_MS = Number(process.env.NEXT_PUBLIC_CACHED_NEXT_MESSAGE_INTERVAL_MS ?? 3000);
+
 /**
  * 次のメッセージ要求関数の型
  * @callback RequestNextMessage
@@ -1,4 +1,10 @@
-import { useEffect, useState } from 'react';
+import { useEffect, useRef, useState } from 'react';
+
+// 予期せぬ切断時に再接続するまでの待ち時間（ミリ秒）。再接続に失敗するたびに倍にし、上限で頭打ちにする
+const RECONNECT_DELAY_MS = 1000;
+const MAX_RECONNECT_DELAY_MS = 30000;
+// 接続できないまま再接続を試みる回数の上限
+const MAX_RECONNECT_ATTEMPTS = 10;
 
 /**
  * メッセージ送信関数の型
@@ -15,10 +21,52 @@ import { useEffect, useState } from 'react';
  * @property {Object} closeEventArg - 2 切断イベント時の引数
  */
 
+/**
+ * ストリームフレームを適用したメッセージリストを作成する。 \
+ * 生成中の発言は`streaming`フラグ付きのメッセージとしてリストの末尾に置く。 \
+ * 差分の開始位置が手元の発言と合わない場合（途中のフレームを取りこぼした場合など）は、何もしない。
+ * @param {Object[]} messages - メッセージリスト
+ * @param {Object} frame - ストリームフレーム
+ * @returns {Object[]} ストリームフレーム適用後のメッセージリスト
+ */
+function applyStreamFrame(messages, frame) {
+  const last = messages[messages.length - 1];
+  const base = (last && last.streaming) ? messages.slice(0, -1) : messages;
+  const text = (last && last.streaming && last.user_name === frame.user_name) ? last.msg_text : "";
+  if (text.length !== frame.offset) return messages;
+  return [...base, {
+    type: frame.type,
+    user_name: frame.user_name,
+    user_img: frame.user_img,
+    msg_text: text + frame.delta,
+    streaming: true,
+  }];
+}
+
+/**
+ * スナップショット・差分フレームを適用したメッセージリストを作成する。 \
+ * スナップショットの場合は、フレームのメッセージでリストを置き換える。 \
+ * 差分の場合は、フレームのメッセージのうち未受信のシーケンス番号のものをリストに追加する。 \
+ * ただし、世代番号(epoch)が変わっていた場合は、メッセージDBがリセットされているので空のリストに追加する。 \
+ * いずれの場合も、生成中の発言は確定したメッセージで置き換わるので取り除く。
+ * @param {Object[]} messages - メッセージリスト
+ * @param {string|null} epoch - 手元のメッセージリストの世代番号
+ * @param {Object} frame - スナップショットまたは差分フレーム
+ * @returns {Object[]} フレーム適用後のメッセージリスト
+ */
+function applyMessageFrame(messages, epoch, frame) {
+  if (frame.frame === "snapshot") return frame.messages;
+  const base = (epoch === frame.epoch) ? messages.filter(msg_i => !msg_i.streaming) : [];
+  const lastSeq = base.length > 0 ? base[base.length - 1].seq : -1;
+  return [...base, ...frame.messages.filter(msg_i => msg_i.seq > lastSeq)];
+}
+
 /**
  * Webソケット提供フック \
  * Webソケットで取得したメッセージを提供する。 \
  * それらのメッセージは、このフックの中で状態管理されるので、呼び出し元はWebソケット受信によるメッセージの更新を気にしなくて済む。 \
+ * 予期せぬ切断時は再接続し、取りこぼしたメッセージだけをサーバから受け取る。 \
+ * 再接続の間隔は失敗するたびに伸ばし（指数バックオフ）、上限回数に達したら再接続をやめる。 \
  * その他、メッセージ送信用の関数と切断イベント時の引数を提供する。 \
  * ただし、メッセージ送信用の関数は使われない想定のものになっている。 \
  * 切断イベント時の引数は、複数の実行者が入室した際のエラー処理等で利用されている。
@@ -31,33 +79,69 @@ export default function useWebSocket(url){
   const [ ws, setWs ] = useState(null);
   const [ closeEventArg, setCloseEventArg] = useState(null);
 
+  // 再接続時に送る、受信済みメッセージの世代番号と最後のシーケンス番号
+  const epochRef = useRef(null);
+  const lastSeqRef = useRef(null);
+
   /* ページ表示時に実行する処理を登録 */
   useEffect(() => {
-    const socket = new WebSocket(url);
-    setWs(socket);
+    let socket = null;
+    let reconnectTimerId = null;
+    let reconnectAttempts = 0;
+    let isUnmounted = false;
 
-    // 接続時に実行する動作を設定
-    socket.onopen = () => {
-      console.log("WebSocket connection opened");
-    };
+    const connect = () => {
+      // 受信済みのメッセージがあれば、取りこぼした差分だけを送ってもらうようにパラメータを付与
+      const resyncParams = (epochRef.current != null && lastSeqRef.current != null)
+        ? `&epoch=${epochRef.current}&last_seq=${lastSeqRef.current}` : "";
+      socket = new WebSocket(url + resyncParams);
+      setWs(socket);
 
-    // メッセージ受信時に実行する動作を設定
-    socket.onmessage = (event) => {
-      setMessages(JSON.parse(event.data));    // jsonにパースしたデータを格納
-    };
+      // 接続時に実行する動作を設定
+      socket.onopen = () => {
+        console.log("WebSocket connection opened");
+        reconnectAttempts = 0;  // 接続できたので再接続の間隔を元に戻す
+      };
 
-    // エラー発生時に実行する動作を設定
-    socket.onerror = (error) => {
-      console.error("WebSocket error:", error);
-    };
+      // メッセージ受信時に実行する動作を設定
+      socket.onmessage = (event) => {
+        const data = JSON.parse(event.data);    // jsonにパース
+        if (data.frame === "snapshot" || data.frame === "delta") {
+          setMessages((prev) => {
+            const next = applyMessageFrame(prev, epochRef.current, data);
+            epochRef.current = data.epoch;
+            lastSeqRef.current = next.length > 0 ? next[next.length - 1].seq : null;
+            return next;
+          });
+        } else if (data.frame === "stream") {
+          setMessages((prev) => applyStreamFrame(prev, data));  // 生成中の発言を末尾に反映
+        }
+      };
 
-    // 切断時に実行する動作を設定
-    socket.onclose = (event) => {
-      setCloseEventArg(event);
-    }
+      // エラー発生時に実行する動作を設定
+      socket.onerror = (error) => {
+        console.error("WebSocket error:", error);
+      };
+
+      // 切断時に実行する動作を設定
+      socket.onclose = (event) => {
+        setCloseEventArg(event);
+        // サーバによる接続拒否(1008)やアンマウント以外の切断では、上限回数まで間隔を伸ばしながら再接続する
+        if (!isUnmounted && event.code !== 1008 && reconnectAttempts < MAX_RECONNECT_ATTEMPTS) {
+          const delay = Math.min(RECONNECT_DELAY_MS * 2 ** reconnectAttempts, MAX_RECONNECT_DELAY_MS);
+          reconnectAttempts += 1;
+          reconnectTimerId = setTimeout(connect, delay);
+        }
+      }
+    };
+    connect();
 
     // コンポーネントのアンマウント時に実行する動作を設定
-    return () => socket.close();
+    return () => {
+      isUnmounted = true;
+      clearTimeout(reconnectTimerId);
+      socket.close();
+    };
   }, [url]);
 
 